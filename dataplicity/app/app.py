@@ -51,6 +51,8 @@ class App(object):
 
     def __init__(self):
         self._conf = None
+        # Clients made for a sub-command, closed when it returns
+        self._clients = []
         self.subcommands = {name: cls(self)
                             for name, cls in SubCommandMeta.registry.items()}
 
@@ -104,8 +106,18 @@ class App(object):
         if path is None:
             raise ProjectNotFoundError('unable to locate dataplicity.conf for project')
         client = Client(path, log=log, create_m2m=create_m2m)
+        self._clients.append(client)
         return client
 
+    def close_clients(self):
+        """Close clients made for a sub-command, so queued events are written"""
+        while self._clients:
+            client = self._clients.pop()
+            try:
+                client.close()
+            except Exception:
+                logging.getLogger('dataplicity').exception('error closing client')
+
     @property
     def conf(self):
         if self._conf is None:
@@ -123,7 +135,10 @@ class App(object):
         subcommand.args = args
 
         try:
-            return subcommand.run() or 0
+            try:
+                return subcommand.run() or 0
+            finally:
+                self.close_clients()
         except Exception as e:
             if self.args.debug:
                 raise
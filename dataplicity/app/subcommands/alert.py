@@ -23,16 +23,12 @@ class Alert(SubCommand):
         level = args.level
 
         with remote.batch() as batch:
-            batch.call_with_id('auth_result',
-                               'device.check_auth',
-                               device_class=client.device_class,
-                               serial=client.serial,
-                               auth_token=client.auth_token)
+            client.session.authenticate(batch, call_id='auth_result')
             batch.call_with_id("add_alert_result",
                                "device.add_alert",
                                title=title,
                                text=text)
-        if not batch.get_result('auth_result'):
+        if not client.session.check(batch, call_id='auth_result'):
             print("Unable to authenticate with the Dataplicity server, check username and password")
             return -1
         if batch.get_result('add_alert_result'):
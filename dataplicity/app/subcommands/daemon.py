@@ -57,8 +57,9 @@ class Daemon(object):
     def exit(self, command=None):
         """Exit daemon now, and run optional command"""
         self.exit_command = command
+        # The main loop stops the tasks before closing the client, so that samples
+        # and events written by tasks as they finish are stored
         self.exit_event.set()
-        self.client.close()
 
     def start(self):
 
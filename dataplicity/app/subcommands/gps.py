@@ -31,16 +31,12 @@ class GPS(SubCommand):
             return -1
 
         with remote.batch() as batch:
-            batch.call_with_id('auth_result',
-                               'device.check_auth',
-                               device_class=client.device_class,
-                               serial=client.serial,
-                               auth_token=client.auth_token)
+            client.session.authenticate(batch, call_id='auth_result')
             batch.call_with_id("add_gps_result",
                                "device.add_gps_coords",
                                lat=lat,
                                lng=lng)
-        if not batch.get_result('auth_result'):
+        if not client.session.check(batch, call_id='auth_result'):
             print("Unable to authenticate with the Dataplicity server, check username and password")
             return -1
         if batch.get_result('add_gps_result'):
@@ -68,11 +68,7 @@ class Publish(SubCommand):
 
         print("uploading firmware...")
         with remote.batch() as batch:
-            batch.call_with_id('auth_result',
-                               'device.check_auth',
-                               device_class=device_class_name,
-                               serial=client.serial,
-                               auth_token=client.auth_token)
+            client.session.authenticate(batch, call_id='auth_result')
             batch.call_with_id("publish_result",
                                "device.publish",
                                device_class=device_class_name,
@@ -83,7 +79,7 @@ class Publish(SubCommand):
                                password=password,
                                replace=args.replace)
 
-        batch.get_result('auth_result')
+        client.session.check(batch, call_id='auth_result')
         try:
             publish_result = batch.get_result('publish_result')
         except JSONRPCError as e:
@@ -66,27 +66,20 @@ class Register(SubCommand):
         samplers = client.samplers.enumerate_samplers()
         if samplers:
             with remote.batch() as batch:
-                batch.call_with_id('auth_result',
-                                   'device.check_auth',
-                                   device_class=client.device_class,
-                                   serial=client.serial,
-                                   auth_token=client.auth_token)
+                client.session.authenticate(batch, call_id='auth_result')
                 batch.call_with_id("create_samplers_result",
                                    "device.create_samplers",
                                    sampler_names=samplers)
-            if not batch.get_result('auth_result'):
+            if not client.session.check(batch, call_id='auth_result'):
                 print("Unable to authenticate with the Dataplicity server, check username and password")
                 return -1
             batch.get_result('create_samplers_result')
 
         with remote.batch() as batch:
-            batch.call_with_id('auth_result',
-                               'device.check_auth',
-                               device_class=client.device_class,
-                               serial=client.serial,
-                               auth_token=client.auth_token)
+            client.session.authenticate(batch, call_id='auth_result')
             batch.call_with_id('url_result',
                                'device.get_manage_url')
+        client.session.check(batch, call_id='auth_result')
         url = batch.get_result('url_result')
 
         print("Run 'dataplicity manage' or visit {} to manage your device".format(url))
@@ -27,18 +27,14 @@ class Sample(SubCommand):
         timestamp = mktime(datetime.datetime.utcnow().timetuple())
 
         with remote.batch() as batch:
-            batch.call_with_id('auth_result',
-                               'device.check_auth',
-                               device_class=client.device_class,
-                               serial=client.serial,
-                               auth_token=client.auth_token)
+            client.session.authenticate(batch, call_id='auth_result')
             batch.call_with_id("add_sample_result",
                                "device.add_samples",
                                device_class=client.device_class,
                                serial=client.serial,
                                sampler_name=sampler,
                                samples=[[timestamp, value]])
-        if not batch.get_result('auth_result'):
+        if not client.session.check(batch, call_id='auth_result'):
             print("Unable to authenticate with the Dataplicity server, check username and password")
             return -1
         if batch.get_result('add_sample_result'):
@@ -39,11 +39,7 @@ class UpdateUI(SubCommand):
         sys.stdout.write("uploading UI for firmware {:010}...\n".format(version))
 
         with remote.batch() as batch:
-            batch.call_with_id('auth_result',
-                               'device.check_auth',
-                               device_class=device_class_name,
-                               serial=client.serial,
-                               auth_token=client.auth_token)
+            client.session.authenticate(batch, call_id='auth_result')
             batch.call_with_id('update_ui_result',
                                'device.update_ui',
                                device_class=device_class_name,
@@ -52,7 +48,7 @@ class UpdateUI(SubCommand):
             batch.call_with_id('url_result',
                                'device.get_manage_url')
 
-        batch.get_result('auth_result')
+        client.session.check(batch, call_id='auth_result')
         try:
             batch.get_result('update_ui_result')
         except JSONRPCError as e:
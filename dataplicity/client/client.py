@@ -5,11 +5,12 @@ from dataplicity.client import settings, serial
 from dataplicity.client.task import TaskManager
 from dataplicity.client.sampler import SamplerManager
 from dataplicity.client.livesettings import LiveSettingsManager
-from dataplicity.client.timeline import TimelineManager
+from dataplicity.client.timeline import TimelineManager, Timeline
 from dataplicity.client.m2m import M2MManager
+from dataplicity.client.session import Session
 from dataplicity.rc.manager import RCManager
 from dataplicity.client.exceptions import ForceRestart
-from dataplicity.jsonrpc import JSONRPC
+from dataplicity.jsonrpc import JSONRPC, RemoteError, ErrorCode
 from dataplicity import constants
 from dataplicity import firmware
 
@@ -109,7 +110,12 @@ class Client(object):
             self.push_url = conf.get('server',
                                      'push_url',
                                      constants.PUSH_URL)
-            self.remote = JSONRPC(self.rpc_url)
+            self.remote = JSONRPC(self.rpc_url,
+                                  pool=conf.get_bool('server', 'keep_alive', True),
+                                  gzip=conf.get_bool('server', 'gzip', False),
+                                  gzip_threshold=conf.get_integer('server', 'gzip_threshold', 1024),
+                                  gzip_level=conf.get_integer('server', 'gzip_level', 1),
+                                  chunked=conf.get_bool('server', 'chunked', False))
 
             self.serial = conf.get('device', 'serial', None)
             if self.serial is None:
@@ -124,6 +130,7 @@ class Client(object):
                 self.subdomain = conf.get('device', 'company', None)
 
             self._auth_token = conf.get('device', 'auth')
+            self.session = Session.init_from_conf(self, conf)
             self.auto_register_info = conf.get('device', 'auto_device_text', None)
 
             # Run this first, so it can work asynchronously
@@ -144,6 +151,7 @@ class Client(object):
 
             self.sample_now = self.samplers.sample_now
             self.sample = self.samplers.sample
+            self.sample_many = self.samplers.sample_many
 
             self.get_timeline = self.timelines.get_timeline
         except:
@@ -157,6 +165,15 @@ class Client(object):
                 self.m2m.close()
             except Exception:
                 self.log.exception('error closing m2m')
+        try:
+            self.samplers.close()
+        except Exception:
+            self.log.exception('error closing samplers')
+        try:
+            self.timelines.close()
+        except Exception:
+            self.log.exception('error closing timelines')
+        self.remote.close()
 
     def connect_wait(self, closing_event, sync_func):
         def do_wait():
@@ -227,12 +244,9 @@ class Client(object):
             try:
                 with self.remote.batch() as batch:
                     # Authenticate
-                    batch.call_with_id('authenticate_result',
-                                       'device.check_auth',
-                                       device_class=self.device_class,
-                                       serial=self.serial,
-                                       auth_token=self.auth_token)
+                    self.session.authenticate(batch)
                     batch.notify('m2m.associate', identity = identity or '')
+                self.session.check(batch)
                 return identity
             except:
                 self.log.exception('unable to set m2m identity')
@@ -290,16 +304,13 @@ class Client(object):
             raise ForceRestart("new firmware")
 
         samplers_updated = []
+        rollups_updated = []
+        timelines_updated = []
         random.seed()
         sync_id = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in xrange(12))
         with self.remote.batch() as batch:
             # Authenticate
-            batch.call_with_id('authenticate_result',
-                               'device.check_auth',
-                               device_class=self.device_class,
-                               serial=self.serial,
-                               auth_token=self.auth_token,
-                               sync_id=sync_id)
+            self.session.authenticate(batch, sync_id=sync_id)
 
             # Tell the server which firmware we're running
             batch.call_with_id('set_firmware_result',
@@ -312,40 +323,54 @@ class Client(object):
                                    'device.check_firmware',
                                    current_version=self.current_firmware_version)
 
-            # Add samples
+            # Add the first chunk of samples from each sampler
             for sampler_name in self.samplers.enumerate_samplers():
                 sampler = self.samplers.get_sampler(sampler_name)
-                samples = sampler.snapshot_samples()
-                if samples:
-                    batch.call_with_id("samples.{}".format(sampler_name),
-                                       "device.add_samples",
-                                       device_class=self.device_class,
-                                       serial=self.serial,
-                                       sampler_name=sampler_name,
-                                       samples=samples)
-                    samplers_updated.append(sampler_name)
+                rollup = sampler.get_sync_rollup()
+                if rollup is not None:
+                    # Too many samples waiting, send a summary instead
+                    records = sampler.snapshot_rollup(rollup)
+                    if records:
+                        batch.call_with_id("samples.{}".format(sampler_name),
+                                           "device.add_samples",
+                                           device_class=self.device_class,
+                                           serial=self.serial,
+                                           sampler_name=sampler_name,
+                                           **rollup.get_sync_params(records))
+                        rollups_updated.append(sampler_name)
+                        continue
+                chunks = sampler.iter_snapshot(self.samplers.get_chunk_samples(sampler))
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    position, samples = chunk
+                    self._add_samples_call(batch, sampler_name, sampler, samples)
+                    samplers_updated.append((sampler_name, position, chunks))
                 else:
                     sampler.remove_snapshot()
 
             # Update conf
-            conf_map = self.livesettings.contents_map
+            conf_method, conf_params = self.livesettings.get_sync_call()
             batch.call_with_id("conf_result",
-                               "device.update_conf_map",
-                               conf_map=conf_map)
+                               conf_method,
+                               **conf_params)
 
-            # Update timeline(s)
+            # Send the first page of events from each timeline
             if self.timelines:
+                self.timelines.flush()
+                write_stats = self.timelines.get_write_stats()
+                if write_stats is not None:
+                    self.log.debug("event writer: {depth} queued (max {max_depth}), {written} written, "
+                                   "{dropped} dropped, latency {mean_latency:.3f}s (max {max_latency:.3f}s)".format(**write_stats))
                 for timeline in self.timelines:
-                    batch.call_with_id('timeline_result_{}'.format(timeline.name),
-                                       'device.add_events',
-                                       name=timeline.name,
-                                       events=timeline.get_events())
+                    events = self.timelines.get_sync_page(timeline)
+                    self._add_events_call(batch, timeline, events)
+                    timelines_updated.append((timeline, events))
 
             if self.m2m is not None:
                 self.m2m.on_sync(batch)
 
         # get_result will throw exceptions with (hopefully) helpful error messages if they fail
-        batch.get_result('authenticate_result')
+        self.session.check(batch)
 
         # If the server doesn't have the current firmware, we don't want to break the rest of the sync
         try:
@@ -353,38 +378,40 @@ class Client(object):
         except Exception as e:
             self.log.warning("unable to set firmware ({})".format(e))
 
-        # Remove snapshots that were successfully synced
-        # Unsuccessful snapshots remain on disk, so the next sync will re-attempt them.
-        for sampler_name in samplers_updated:
-            sampler = self.samplers.get_sampler(sampler_name)
-            try:
-                if not batch.get_result("samples.{}".format(sampler_name)):
-                    self.log("failed to get sampler results '{}'".format(sampler_name))
-            except Exception as e:
-                self.log.exception("error adding samples to {} ({})".format(sampler_name, e))
-            else:
-                sampler.remove_snapshot()
-
-        try:
-            changed_conf = batch.get_result("conf_result")
-        except:
-            self.log.exception('error sending settings')
-        else:
-            if changed_conf:
-                self.livesettings.update(changed_conf, self.tasks)
-                changed_conf_names = ", ".join(sorted(changed_conf.keys()))
-                self.log.debug("settings file(s) changed: {}".format(changed_conf_names))
+        # Raw samples summarized by a rollup are discarded once the rollup is synced
+        for sampler_name in rollups_updated:
+            if self._check_samples_result(batch, sampler_name):
+                self.samplers.get_sampler(sampler_name).remove_snapshot()
 
-        for timeline in self.timelines:
+        # Acknowledge chunks that were successfully synced, then send the remaining chunks.
+        # Unacknowledged samples remain on disk, so the next sync will resume from the last acknowledged chunk.
+        for sampler_name, position, chunks in samplers_updated:
+            sampler = self.samplers.get_sampler(sampler_name)
             try:
-                timeline_result = batch.get_result('timeline_result_{}'.format(timeline.name))
-            except:
-                self.log.exception('error sending timeline')
-            else:
-                timeline.clear_events(timeline_result)
+                if self._check_samples_result(batch, sampler_name):
+                    sampler.ack_snapshot(position)
+                    if self._sync_sample_chunks(sampler_name, sampler, chunks):
+                        sampler.remove_snapshot()
+            finally:
+                chunks.close()
+
+        changed_conf = self._check_conf_result(batch, conf_method, conf_params)
+        if changed_conf:
+            self.livesettings.update(changed_conf, self.tasks)
+            changed_conf_names = ", ".join(sorted(changed_conf.keys()))
+            self.log.debug("settings file(s) changed: {}".format(changed_conf_names))
+
+        # Clear events the server acknowledged, then send the remaining pages
+        for timeline, events in timelines_updated:
+            if self._check_events_result(batch, timeline, events) and events:
+                self._sync_event_pages(timeline, Timeline.get_cursor(events[-1]))
 
         ellapsed = time() - start
         self.log.debug('sync complete {:0.2f}s'.format(ellapsed))
+        connection_stats = self.remote.get_stats()
+        if connection_stats is not None:
+            self.log.debug("{requests} requests, {handshakes} handshakes ({connect_time:0.2f}s), "
+                           "{reused} reused connections (saved ~{time_saved:0.2f}s)".format(**connection_stats))
 
         if self.check_firmware:
             firmware_result = batch.get_result('firmware_result')
@@ -401,6 +428,118 @@ class Client(object):
                 self.log.info('firmware installed in "{}"'.format(install_path))
                 self.get_comms().restart()
 
+    def _add_samples_call(self, batch, sampler_name, sampler, samples):
+        """Add a call to send samples to a batch"""
+        batch.call_with_id("samples.{}".format(sampler_name),
+                           "device.add_samples",
+                           device_class=self.device_class,
+                           serial=self.serial,
+                           sampler_name=sampler_name,
+                           **sampler.get_sync_params(samples))
+
+    def _check_samples_result(self, batch, sampler_name):
+        """Check samples were added successfully"""
+        try:
+            if not batch.get_result("samples.{}".format(sampler_name)):
+                self.log.warning("failed to get sampler results '{}'".format(sampler_name))
+                return False
+        except Exception as e:
+            self.log.exception("error adding samples to {} ({})".format(sampler_name, e))
+            return False
+        return True
+
+    def _sync_sample_chunks(self, sampler_name, sampler, chunks):
+        """Send remaining chunks of a sampler snapshot, one request per chunk.
+        Returns True if every chunk was acknowledged.
+
+        """
+        for position, samples in chunks:
+            try:
+                with self.remote.batch() as batch:
+                    self.session.authenticate(batch)
+                    self._add_samples_call(batch, sampler_name, sampler, samples)
+                self.session.check(batch)
+            except Exception as e:
+                self.log.warning("unable to send samples to {} ({}), will resume on next sync".format(sampler_name, e))
+                return False
+            if not self._check_samples_result(batch, sampler_name):
+                return False
+            sampler.ack_snapshot(position)
+        return True
+
+    def _add_events_call(self, batch, timeline, events):
+        """Add a call to send a page of events to a batch"""
+        batch.call_with_id('timeline_result_{}'.format(timeline.name),
+                           'device.add_events',
+                           name=timeline.name,
+                           **self.timelines.get_sync_params(events))
+
+    def _check_events_result(self, batch, timeline, events):
+        """Clear the events the server acknowledged, return False if the events weren't sent"""
+        try:
+            timeline_result = batch.get_result('timeline_result_{}'.format(timeline.name))
+        except:
+            self.log.exception('error sending timeline')
+            return False
+        self.timelines.clear_synced(timeline, events, timeline_result)
+        return True
+
+    def _check_conf_result(self, batch, method, params):
+        """Check the result of syncing settings, and return settings changed on the server"""
+        try:
+            result = batch.get_result("conf_result")
+        except RemoteError as e:
+            if method == "device.check_conf_hashes" and e.code == ErrorCode.method_not_found:
+                self.log.debug("server doesn't support settings hashes, will send full settings")
+                self.livesettings.hashes = False
+            else:
+                self.log.exception('error sending settings')
+            return None
+        except:
+            self.log.exception('error sending settings')
+            return None
+        if method == "device.update_conf_map":
+            self.livesettings.ack_contents(params['conf_map'])
+            return result
+        result = result or {}
+        changed_conf = result.get('conf_map') or {}
+        mismatch = self.livesettings.ack_hashes(params['conf_hashes'], result.get('mismatch') or [])
+        if mismatch:
+            # The server's copy differs from ours, and we didn't send the contents
+            self.log.debug("settings file(s) out of date on server: {}".format(", ".join(sorted(mismatch))))
+            conf_map = self.livesettings.get_contents_map(mismatch)
+            try:
+                with self.remote.batch() as batch:
+                    self.session.authenticate(batch)
+                    batch.call_with_id('conf_result',
+                                       'device.update_conf_map',
+                                       conf_map=conf_map)
+                self.session.check(batch)
+                changed_conf.update(batch.get_result('conf_result') or {})
+            except Exception as e:
+                self.log.warning("unable to send settings ({}), will retry on next sync".format(e))
+            else:
+                self.livesettings.ack_contents(conf_map)
+        return changed_conf
+
+    def _sync_event_pages(self, timeline, cursor):
+        """Send the events after `cursor` from a timeline, one request per page"""
+        while 1:
+            events = self.timelines.get_sync_page(timeline, cursor=cursor)
+            if not events:
+                break
+            try:
+                with self.remote.batch() as batch:
+                    self.session.authenticate(batch)
+                    self._add_events_call(batch, timeline, events)
+                self.session.check(batch)
+            except Exception as e:
+                self.log.warning("unable to send events from timeline '{}' ({}), will resume on next sync".format(timeline.name, e))
+                break
+            if not self._check_events_result(batch, timeline, events):
+                break
+            cursor = Timeline.get_cursor(events[-1])
+
     def deploy(self):
         """Deploy latest firmware"""
         self.log.info("requesting firmware...")
@@ -411,18 +550,14 @@ class Client(object):
                                name=self.name or self.serial,
                                serial=self.serial,
                                device_class_name=self.device_class)
-            batch.call_with_id('auth_result',
-                               'device.check_auth',
-                               device_class=self.device_class,
-                               serial=self.serial,
-                               auth_token=self.auth_token)
+            self.session.authenticate(batch, call_id='auth_result')
             batch.call_with_id('firmware_result',
                                'device.get_firmware')
+        self.session.check(batch, call_id='auth_result')
         try:
             batch.get_result('register_result')
         except Exception as e:
             self.log.warning(e)
-        batch.get_result('auth_result')
 
         fw = batch.get_result('firmware_result')
         if not fw['firmware']:
@@ -0,0 +1,233 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Compressed encoding for blocks of samples
+
+Based on the time series compression described in "Gorilla: A Fast, Scalable, In-Memory
+Time Series Database" (Pelkonen et al, 2015). Timestamps are stored as millisecond
+integers encoded as the difference between consecutive deltas, and values are stored as
+64 bit floats XORed with the previous value. Periodic samples of slowly changing values
+encode to a few bits per sample.
+
+A block consists of a header with the sample count, the first timestamp and the first
+value, followed by the bit stream for the remaining samples.
+
+"""
+
+import struct
+
+_header_struct = struct.Struct(b'<IqQ')
+_float_struct = struct.Struct(b'<d')
+_int_struct = struct.Struct(b'<Q')
+
+# Delta of delta buckets; (control bits, control bit count, value bit count)
+_dod_buckets = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+    (0b11110, 5, 32),
+    (0b11111, 5, 64)
+]
+_dod_value_bits = [value_bits for _control, _control_bits, value_bits in _dod_buckets]
+
+
+class EncodingError(ValueError):
+    pass
+
+
+def _float_to_bits(value):
+    return _int_struct.unpack(_float_struct.pack(value))[0]
+
+
+def _bits_to_float(bits):
+    return _float_struct.unpack(_int_struct.pack(bits))[0]
+
+
+def _leading_zeros(value):
+    return 64 - value.bit_length()
+
+
+def _trailing_zeros(value):
+    return (value & -value).bit_length() - 1
+
+
+class BitWriter(object):
+    """Writes a stream of bits"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        """Write the lower `bits` of an unsigned integer"""
+        acc = (self._acc << bits) | value
+        bits += self._bits
+        data = self.data
+        while bits >= 8:
+            bits -= 8
+            data.append((acc >> bits) & 0xff)
+        self._acc = acc & ((1 << bits) - 1)
+        self._bits = bits
+
+    def getvalue(self):
+        """Get the bytes written, padded to a whole byte"""
+        data = bytearray(self.data)
+        if self._bits:
+            data.append((self._acc << (8 - self._bits)) & 0xff)
+        return bytes(data)
+
+
+class BitReader(object):
+    """Reads a stream of bits"""
+
+    def __init__(self, data, pos=0):
+        self.data = bytearray(data)
+        self.pos = pos
+        self._acc = 0
+        self._bits = 0
+
+    def read(self, bits):
+        """Read an unsigned integer of the given number of bits"""
+        acc = self._acc
+        available = self._bits
+        data = self.data
+        try:
+            while available < bits:
+                acc = (acc << 8) | data[self.pos]
+                self.pos += 1
+                available += 8
+        except IndexError:
+            raise EncodingError("unexpected end of block")
+        available -= bits
+        self._acc = acc & ((1 << available) - 1)
+        self._bits = available
+        return acc >> available
+
+
+def to_milliseconds(timestamp):
+    """Convert a timestamp in seconds to integer milliseconds"""
+    return int(round(timestamp * 1000.0))
+
+
+def encode_block(timestamps, values):
+    """Encode sequences of timestamps (in seconds) and numeric values in to a block.
+
+    Timestamps are stored to millisecond precision.
+
+    """
+    count = len(timestamps)
+    if count != len(values):
+        raise EncodingError("timestamps and values must be the same length")
+    if not count:
+        return _header_struct.pack(0, 0, 0)
+
+    timestamp_iter = iter(timestamps)
+    value_iter = iter(values)
+    previous_time = to_milliseconds(next(timestamp_iter))
+    previous_bits = _float_to_bits(float(next(value_iter)))
+    header = _header_struct.pack(count, previous_time, previous_bits)
+
+    writer = BitWriter()
+    write = writer.write
+    previous_delta = 0
+    previous_leading = previous_trailing = None
+
+    for timestamp, value in zip(timestamp_iter, value_iter):
+        # Timestamp
+        timestamp = to_milliseconds(timestamp)
+        delta = timestamp - previous_time
+        dod = delta - previous_delta
+        previous_time = timestamp
+        previous_delta = delta
+        if dod == 0:
+            write(0, 1)
+        else:
+            for control, control_bits, value_bits in _dod_buckets:
+                limit = 1 << (value_bits - 1)
+                if -limit <= dod < limit:
+                    write(control, control_bits)
+                    write(dod & ((1 << value_bits) - 1), value_bits)
+                    break
+            else:
+                raise EncodingError("timestamp out of range")
+
+        # Value
+        bits = _float_to_bits(float(value))
+        xor = bits ^ previous_bits
+        previous_bits = bits
+        if xor == 0:
+            write(0, 1)
+            continue
+        leading = min(_leading_zeros(xor), 31)
+        trailing = _trailing_zeros(xor)
+        if previous_leading is not None and leading >= previous_leading and trailing >= previous_trailing:
+            # Meaningful bits fit in the previous window
+            write(0b10, 2)
+            write(xor >> previous_trailing, 64 - previous_leading - previous_trailing)
+        else:
+            meaningful = 64 - leading - trailing
+            write(0b11, 2)
+            write(leading, 5)
+            write(meaningful & 0x3f, 6)
+            write(xor >> trailing, meaningful)
+            previous_leading = leading
+            previous_trailing = trailing
+
+    return header + writer.getvalue()
+
+
+def decode_block(data, offset=0):
+    """Decode a block in to a list of timestamps (in seconds), and a list of float values.
+
+    Returns a tuple of (timestamps, values).
+
+    """
+    try:
+        count, previous_time, previous_bits = _header_struct.unpack_from(data, offset)
+    except struct.error:
+        raise EncodingError("block header is truncated")
+    if not count:
+        return [], []
+    timestamps = [previous_time / 1000.0]
+    values = [_bits_to_float(previous_bits)]
+
+    reader = BitReader(data, offset + _header_struct.size)
+    read = reader.read
+    previous_delta = 0
+    previous_leading = previous_trailing = 0
+
+    for _ in range(count - 1):
+        if read(1) == 0:
+            dod = 0
+        else:
+            # Control bits are a run of up to five 1s
+            ones = 1
+            while ones < 5 and read(1):
+                ones += 1
+            value_bits = _dod_value_bits[ones - 1]
+            dod = read(value_bits)
+            if dod >= 1 << (value_bits - 1):
+                dod -= 1 << value_bits
+        previous_delta += dod
+        previous_time += previous_delta
+        timestamps.append(previous_time / 1000.0)
+
+        if read(1) == 0:
+            values.append(values[-1])
+            continue
+        if read(1) == 0:
+            xor = read(64 - previous_leading - previous_trailing) << previous_trailing
+        else:
+            leading = read(5)
+            meaningful = read(6) or 64
+            trailing = 64 - leading - meaningful
+            xor = read(meaningful) << trailing
+            previous_leading = leading
+            previous_trailing = trailing
+        previous_bits ^= xor
+        values.append(_bits_to_float(previous_bits))
+
+    return timestamps, values
+
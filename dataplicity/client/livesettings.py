@@ -4,6 +4,11 @@ from __future__ import print_function
 """
 Settings synced with the server
 
+The exported contents of each settings file, and its SHA-256 hash, are cached until the
+file is reloaded or rewritten. A sync sends the hashes, and the full contents only of the
+files that changed since the server last acknowledged them (or that the server reports
+don't match its copy).
+
 """
 
 from dataplicity.client.settings import read_contents
@@ -11,6 +16,7 @@ from dataplicity import atomicwrite
 from dataplicity.compat import iteritems
 
 from io import BytesIO
+import hashlib
 import os
 from os.path import join
 from threading import RLock
@@ -24,9 +30,10 @@ log = logging.getLogger('dataplicity')
 class LiveSettingsManager(object):
     """Manages settings files that may be modified by the server"""
 
-    def __init__(self, path, device_class):
+    def __init__(self, path, device_class, hashes=True):
         self.path = path
         self.device_class = device_class
+        self.hashes = hashes
         self._settings = {}
         self.lock = RLock()
         super(LiveSettingsManager, self).__init__()
@@ -35,10 +42,11 @@ class LiveSettingsManager(object):
     def init_from_conf(cls, client, conf):
         settings_path = conf.get_path('device', 'settings', None)
         device_class = conf.get('device', 'class')
+        hashes = conf.get_bool('device', 'settings_hashes', True)
         if settings_path is None:
-            manager = LiveSettingsManager(None, device_class)
+            manager = LiveSettingsManager(None, device_class, hashes=hashes)
         else:
-            manager = LiveSettingsManager(settings_path, device_class)
+            manager = LiveSettingsManager(settings_path, device_class, hashes=hashes)
             for section, name in conf.qualified_sections('settings'):
                 if not conf.get_bool(section, 'enabled', True):
                     continue
@@ -89,6 +97,45 @@ class LiveSettingsManager(object):
         return {name: conf.contents
                 for name, conf in iteritems(self._settings)}
 
+    def get_contents_map(self, names):
+        """Get a dict that maps the given conf names on to the file contents"""
+        return {name: self._settings[name].contents for name in names}
+
+    def get_sync_call(self):
+        """Get the method and parameters that sync settings with the server.
+
+        Settings files changed on disk are reloaded first. If `hashes` is True, only the
+        contents of files that changed since the server last acknowledged them are sent.
+
+        """
+        with self.lock:
+            for settings in self._settings.values():
+                settings.check(reload=True)
+            if not self.hashes:
+                return "device.update_conf_map", {"conf_map": self.contents_map}
+            conf_hashes = {name: settings.content_hash
+                           for name, settings in iteritems(self._settings)}
+            conf_map = {name: settings.contents
+                        for name, settings in iteritems(self._settings)
+                        if settings.content_hash != settings.synced_hash}
+            return "device.check_conf_hashes", {"conf_hashes": conf_hashes, "conf_map": conf_map}
+
+    def ack_hashes(self, conf_hashes, mismatch):
+        """Record the hashes the server acknowledged, return names the server has no match for"""
+        mismatch = [name for name in mismatch if name in self._settings]
+        with self.lock:
+            for name, sha256 in iteritems(conf_hashes):
+                if name in self._settings:
+                    self._settings[name].synced_hash = None if name in mismatch else sha256
+        return mismatch
+
+    def ack_contents(self, conf_map):
+        """Record the contents the server received in full"""
+        with self.lock:
+            for name, contents in iteritems(conf_map):
+                if name in self._settings:
+                    self._settings[name].synced_hash = get_hash(contents)
+
     def startup(self, tasks):
         if self._settings:
             for name, conf in iteritems(self._settings):
@@ -101,9 +148,18 @@ class LiveSettingsManager(object):
             for name, conf in iteritems(conf_map):
                 settings = self._settings[name]
                 settings.write(conf)
+                # The contents came from the server, so needn't be sent back
+                settings.synced_hash = settings.content_hash
                 tasks.send_signal_from('settings_update', name, name, settings.settings)
 
 
+def get_hash(contents):
+    """Get the SHA-256 hash of settings contents, as hex"""
+    if not isinstance(contents, bytes):
+        contents = contents.encode('utf-8')
+    return hashlib.sha256(contents).hexdigest()
+
+
 class LiveSettings(object):
     """Settings object that may be updated by the server"""
 
@@ -113,13 +169,32 @@ class LiveSettings(object):
         self._settings = None
         self.timestamp = None
         self._contents = None
+        # Cached (contents, sha256) of the export, None when it needs regenerating
+        self._export = None
+        # Hash of the contents the server last acknowledged
+        self.synced_hash = None
 
     def __repr__(self):
         return '<settings "{}">'.format(self.path)
 
+    @property
+    def dirty(self):
+        """Check if the exported contents need regenerating"""
+        return self._export is None
+
+    def _get_export(self):
+        if self._export is None:
+            contents = self.export()
+            self._export = (contents, get_hash(contents))
+        return self._export
+
     @property
     def contents(self):
-        return self.export()
+        return self._get_export()[0]
+
+    @property
+    def content_hash(self):
+        return self._get_export()[1]
 
     @property
     def settings(self):
@@ -173,6 +248,7 @@ class LiveSettings(object):
             timestamp = self.get_timestamp()
             self._contents, self._settings = read_contents(self.path, blank=True)
             self.timestamp = timestamp
+            self._export = None
         except Exception:
             log.exception('Error reading live settings from "{}"'.format(self.path))
             return False
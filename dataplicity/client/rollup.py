@@ -0,0 +1,146 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Rollups summarize samples over fixed intervals (min / max / mean / count)
+
+Rollups are maintained as samples arrive, so the work per sample is constant and the
+samples file is never re-read. Completed intervals are appended to a rollup file,
+which is snapshotted and synced in the same way as the samples file.
+
+"""
+
+from dataplicity import errors
+
+import os
+from os.path import join, exists
+from threading import RLock
+import struct
+import re
+
+
+_interval_units = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_interval(interval):
+    """Parse an interval such as '30s', '1m' or '1h', and return the number of seconds"""
+    match = re.match(r'^\s*(\d+)\s*([smhd]?)\s*$', interval)
+    if match is None:
+        raise errors.ConfigError("'{}' is not a valid interval (try something like 30s, 1m or 1h)".format(interval))
+    count, unit = match.groups()
+    seconds = int(count) * _interval_units[unit or 's']
+    if not seconds:
+        raise errors.ConfigError("rollup interval must be greater than zero")
+    return seconds
+
+
+class Rollup(object):
+    """Summarizes samples over a fixed interval"""
+
+    record_struct = struct.Struct(b'<ddddI')
+    header = b"rollup v1\n<ddddI\n"
+
+    def __init__(self, path, name, interval):
+        self.name = name
+        self.interval = interval
+        self.rollup_path = join(path, 'rollup_{}.smp'.format(name))
+        self.rollup_snapshot_path = self.rollup_path + '.snapshot'
+        self.lock = RLock()
+        self._rollup_file = None
+        self._reset_bucket(None)
+
+    def __repr__(self):
+        return "<rollup {} ({}s)>".format(self.name, self.interval)
+
+    def _reset_bucket(self, bucket):
+        self._bucket = bucket
+        self._min = None
+        self._max = None
+        self._total = 0.0
+        self._count = 0
+
+    def _write_bucket(self):
+        """Write the current bucket to the rollup file"""
+        if not self._count:
+            return
+        if self._rollup_file is None:
+            if not exists(self.rollup_path):
+                with open(self.rollup_path, 'wb') as f:
+                    f.write(self.header)
+            self._rollup_file = open(self.rollup_path, 'ab')
+        self._rollup_file.write(self.record_struct.pack(self._bucket,
+                                                        self._min,
+                                                        self._max,
+                                                        self._total / self._count,
+                                                        self._count))
+        self._rollup_file.flush()
+
+    def add(self, timestamp, value):
+        """Add a sample to the rollup"""
+        bucket = timestamp - (timestamp % self.interval)
+        with self.lock:
+            if bucket != self._bucket:
+                self._write_bucket()
+                self._reset_bucket(bucket)
+            if self._count:
+                if value < self._min:
+                    self._min = value
+                if value > self._max:
+                    self._max = value
+            else:
+                self._min = self._max = value
+            self._total += value
+            self._count += 1
+
+    def close(self):
+        """Write the current (incomplete) bucket and close the rollup file"""
+        with self.lock:
+            self._write_bucket()
+            self._reset_bucket(None)
+            if self._rollup_file is not None:
+                self._rollup_file.close()
+                self._rollup_file = None
+
+    def take_snapshot(self):
+        """Move completed buckets to the snapshot file, if there isn't already a snapshot"""
+        with self.lock:
+            if self._rollup_file is not None:
+                self._rollup_file.close()
+                self._rollup_file = None
+            if exists(self.rollup_path) and not exists(self.rollup_snapshot_path):
+                os.rename(self.rollup_path, self.rollup_snapshot_path)
+
+    def read_records(self, rollup_path=None):
+        """Read a list of (bucket start, min, max, mean, count) tuples"""
+        if rollup_path is None:
+            rollup_path = self.rollup_path
+        try:
+            with open(rollup_path, 'rb') as f:
+                f.readline()
+                f.readline()
+                data = f.read()
+        except IOError:
+            return []
+        record_size = self.record_struct.size
+        unpack_from = self.record_struct.unpack_from
+        return [unpack_from(data, offset)
+                for offset in range(0, len(data) - len(data) % record_size, record_size)]
+
+    def snapshot_records(self):
+        """Read the records in the snapshot"""
+        return self.read_records(self.rollup_snapshot_path)
+
+    def remove_snapshot(self):
+        try:
+            os.remove(self.rollup_snapshot_path)
+        except OSError:
+            pass
+
+    def get_sync_params(self, records):
+        """Get parameters to send rollup records to device.add_samples"""
+        return {"samples": [[start, mean] for start, _min, _max, mean, _count in records],
+                "rollup": {"tier": self.name,
+                           "interval": self.interval,
+                           "min": [record[1] for record in records],
+                           "max": [record[2] for record in records],
+                           "count": [record[4] for record in records]}}
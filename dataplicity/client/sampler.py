@@ -2,14 +2,52 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 from dataplicity import errors
-from dataplicity.compat import py2bytes
+from dataplicity import atomicwrite
+from dataplicity.client import gorilla
+from dataplicity.client.rollup import Rollup, parse_interval
+from dataplicity.client.segments import SegmentStore
+from dataplicity.client import sqlitestore
+from dataplicity.client.timeindex import TimeIndex
+from dataplicity.compat import py2bytes, implements_bool, text_type
+from dataplicity.jsonrpc import StreamedValue
 
 from time import time
+from base64 import b64encode
 import os
 from os.path import join, getsize, abspath, dirname, exists
-from functools import partial
 from threading import RLock
+from itertools import islice
+from array import array
 import struct
+import json
+import mmap
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+log = logging.getLogger('dataplicity')
+
+# maps storage names on to a sampler class
+_sampler_registry = {}
+
+# encodings for samples sent to the server
+SYNC_ENCODINGS = ('json', 'gorilla')
+
+# Approximate (worst case) bytes per sample in a sync request, for each encoding
+SYNC_SAMPLE_BYTES = {'json': 48, 'gorilla': 24}
+
+
+def register_sampler(storage):
+    """Class decorator to register a sampler storage class"""
+    def class_deco(cls):
+        cls.storage = storage
+        _sampler_registry[storage] = cls
+        return cls
+    return class_deco
 
 
 class SamplerError(Exception):
@@ -20,10 +58,190 @@ class NoSamplerError(KeyError):
     pass
 
 
+def _array_typecode(code):
+    """Get an array typecode that can store values of the given struct code, or None"""
+    if code in 'fd':
+        return 'd'
+    size = struct.calcsize(py2bytes('<' + code))
+    for typecode in ('bhilq' if code.islower() else 'BHILQ'):
+        try:
+            if array(py2bytes(typecode)).itemsize >= size:
+                return typecode
+        except ValueError:
+            # 'q' is not available on all Pythons
+            pass
+    return None
+
+
+def _numpy_dtype(code):
+    """Get a numpy dtype string for a struct code"""
+    size = struct.calcsize(py2bytes('<' + code))
+    if code in 'fd':
+        kind = 'f'
+    elif code.islower():
+        kind = 'i'
+    else:
+        kind = 'u'
+    return '<{}{}'.format(kind, size)
+
+
+def _column_args(column, values):
+    """Get the arguments to construct a column of the same type"""
+    if isinstance(column, array):
+        return (column.typecode, values)
+    return (values,)
+
+
+def _make_column(code, values=()):
+    typecode = _array_typecode(code)
+    if typecode is None:
+        return list(values)
+    return array(py2bytes(typecode), values)
+
+
+@implements_bool
+class Samples(object):
+    """A columnar sequence of samples, with timestamps and values stored in separate arrays.
+
+    Iterating yields (timestamp, value) tuples. Use `jsonify` to get a JSON serializable list.
+
+    """
+
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    def __repr__(self):
+        return "<samples ({})>".format(len(self))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __bool__(self):
+        return len(self.timestamps) > 0
+
+    def __iter__(self):
+        return zip(self.timestamps, self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Samples(self.timestamps[index], self.values[index])
+        return (self.timestamps[index], self.values[index])
+
+    @classmethod
+    def decode(cls, sample_format, data):
+        """Decode packed samples from a bytes object"""
+        sample_format = sample_format.lstrip('<')
+        time_format, value_format = sample_format[0], sample_format[1:]
+        sample_struct = struct.Struct(py2bytes('<' + sample_format))
+        sample_size = sample_struct.size
+        # Ignore any incomplete sample at the end
+        data = data[:len(data) - len(data) % sample_size]
+
+        if numpy is not None:
+            dtype = numpy.dtype([(str('t'), _numpy_dtype(time_format)),
+                                 (str('v'), _numpy_dtype(value_format))])
+            records = numpy.frombuffer(data, dtype=dtype)
+            return cls(records['t'], records['v'])
+
+        typecode = _array_typecode(time_format)
+        if time_format == value_format and typecode is not None and \
+                array(py2bytes(typecode)).itemsize * 2 == sample_size:
+            # Timestamps and values are the same type, so decode in one go
+            interleaved = array(py2bytes(typecode))
+            if hasattr(interleaved, 'frombytes'):
+                interleaved.frombytes(data)
+            else:
+                interleaved.fromstring(data)
+            if sys.byteorder == 'big':
+                interleaved.byteswap()
+            return cls(interleaved[0::2], interleaved[1::2])
+
+        if hasattr(sample_struct, 'iter_unpack'):
+            samples = sample_struct.iter_unpack(data)
+        else:
+            unpack_from = sample_struct.unpack_from
+            samples = (unpack_from(data, offset) for offset in range(0, len(data), sample_size))
+        timestamps = _make_column(time_format)
+        values = _make_column(value_format)
+        append_timestamp = timestamps.append
+        append_value = values.append
+        for timestamp, value in samples:
+            append_timestamp(timestamp)
+            append_value(value)
+        return cls(timestamps, values)
+
+    def jsonify(self):
+        """Get the samples as a list of [timestamp, value] lists"""
+        timestamps = self.timestamps
+        values = self.values
+        # Convert arrays to Python types in one go
+        if hasattr(timestamps, 'tolist'):
+            timestamps = timestamps.tolist()
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        return [[timestamp, value] for timestamp, value in zip(timestamps, values)]
+
+    def between(self, start=None, end=None):
+        """Get the samples with timestamps in the range start <= t <= end (either may be None)"""
+        timestamps = self.timestamps
+        if numpy is not None and isinstance(timestamps, numpy.ndarray):
+            mask = numpy.ones(len(timestamps), dtype=bool)
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps <= end
+            return Samples(timestamps[mask], self.values[mask])
+        selected = [index for index, timestamp in enumerate(timestamps)
+                    if (start is None or timestamp >= start) and (end is None or timestamp <= end)]
+        if len(selected) == len(timestamps):
+            return self
+        values = self.values
+        return Samples(type(timestamps)(*_column_args(timestamps, [timestamps[index] for index in selected])),
+                       type(values)(*_column_args(values, [values[index] for index in selected])))
+
+    @classmethod
+    def join(cls, samples_list):
+        """Join a sequence of Samples objects"""
+        samples_list = [samples for samples in samples_list if samples]
+        if not samples_list:
+            return cls([], [])
+        if len(samples_list) == 1:
+            return samples_list[0]
+        if numpy is not None and isinstance(samples_list[0].timestamps, numpy.ndarray):
+            return cls(numpy.concatenate([samples.timestamps for samples in samples_list]),
+                       numpy.concatenate([samples.values for samples in samples_list]))
+        timestamps = samples_list[0].timestamps[:]
+        values = samples_list[0].values[:]
+        for samples in samples_list[1:]:
+            timestamps.extend(samples.timestamps)
+            values.extend(samples.values)
+        return cls(timestamps, values)
+
+    def summarize(self):
+        """Get a tuple of (min, max, mean, count) for the values, or None if there are no samples"""
+        count = len(self)
+        if not count:
+            return None
+        values = self.values
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        return (min(values), max(values), float(sum(values)) / count, count)
+
+
 class SamplerManager(object):
-    def __init__(self, path):
+    def __init__(self, path, chunk_samples=1000, chunk_bytes=64 * 1024):
         self.path = path
+        self.chunk_samples = chunk_samples
+        self.chunk_bytes = chunk_bytes
         self.samplers = {}
+        self._segment_store = None
+
+    def get_segment_store(self, path):
+        """Get the segment store shared by samplers with 'segment' storage"""
+        if self._segment_store is None:
+            self._segment_store = SegmentStore(path)
+        return self._segment_store
 
     def get_sampler(self, sampler_name):
         """Get a named sampler"""
@@ -37,7 +255,10 @@ class SamplerManager(object):
     def init_from_conf(cls, client, conf):
 
         samplers_path = conf.get('samplers', 'path', '/tmp/dataplicity/samplers/')
-        sampler_manager = cls(samplers_path)
+        chunk_samples = conf.get_integer('samplers', 'chunk_samples', 1000)
+        chunk_bytes = conf.get_integer('samplers', 'chunk_bytes', 64 * 1024)
+        default_storage = conf.get('samplers', 'storage', 'file')
+        sampler_manager = cls(samplers_path, chunk_samples=chunk_samples, chunk_bytes=chunk_bytes)
 
         for section, name in conf.qualified_sections('sampler'):
             if not conf.get_bool(section, 'enabled', True):
@@ -45,19 +266,60 @@ class SamplerManager(object):
             time_format = conf.get(section, 'time_format', 'd')
             value_format = conf.get(section, 'value_format', 'd')
             max_samples = conf.get_integer(section, 'max_sample', 10000)
-            path = join(dirname(conf.path), samplers_path, client.device_class, name)
+            storage = conf.get(section, 'storage', default_storage)
             try:
-                os.makedirs(path)
-            except OSError:
-                pass
+                sampler_cls = _sampler_registry[storage]
+            except KeyError:
+                raise errors.ConfigError("[{}]/storage should be one of {}".format(section, ", ".join(sorted(_sampler_registry))))
+            flush_samples = conf.get_integer(section, 'flush_samples', sampler_cls.default_flush_samples)
+            flush_interval = conf.get_integer(section, 'flush_interval', 0)
+            fsync = conf.get_bool(section, 'fsync', False)
+            sync_encoding = conf.get(section, 'sync_encoding', 'json')
+            if sync_encoding not in SYNC_ENCODINGS:
+                raise errors.ConfigError("[{}]/sync_encoding should be one of {}".format(section, ", ".join(SYNC_ENCODINGS)))
+            rollups = conf.get_list(section, 'rollups', [])
+            sync_tier = conf.get(section, 'sync_tier', 'raw')
+            sync_tier_backlog = conf.get_integer(section, 'sync_tier_backlog', 0)
+            deadband = conf.get_float(section, 'deadband') if conf.has_setting(section, 'deadband') else None
+            deadband_relative = conf.get_float(section, 'deadband_relative') \
+                if conf.has_setting(section, 'deadband_relative') else None
+            heartbeat = conf.get_float(section, 'heartbeat', 0)
+            index_samples = conf.get_integer(section, 'index_samples', 256)
+            extra = {}
+            if storage == 'segment':
+                # Samplers share segment files, rather than a directory each
+                segments_path = join(dirname(conf.path), samplers_path, client.device_class, '.segments')
+                extra['store'] = sampler_manager.get_segment_store(segments_path)
+                path = join(segments_path, name)
+            elif storage == 'sqlite':
+                extra['database'] = sqlitestore.get_database(client, conf)
+                path = join(dirname(conf.path), samplers_path, client.device_class, name)
             else:
-                client.log.debug("created {}".format(path))
+                path = join(dirname(conf.path), samplers_path, client.device_class, name)
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass
+                else:
+                    client.log.debug("created {}".format(path))
 
-            sampler = Sampler(path,
-                              name,
-                              time_format=time_format,
-                              value_format=value_format,
-                              max_samples=max_samples)
+            sampler = sampler_cls(path,
+                                  name,
+                                  time_format=time_format,
+                                  value_format=value_format,
+                                  max_samples=max_samples,
+                                  flush_samples=flush_samples,
+                                  flush_interval=flush_interval,
+                                  fsync=fsync,
+                                  sync_encoding=sync_encoding,
+                                  rollups=rollups,
+                                  sync_tier=sync_tier,
+                                  sync_tier_backlog=sync_tier_backlog,
+                                  deadband=deadband,
+                                  deadband_relative=deadband_relative,
+                                  heartbeat=heartbeat,
+                                  index_samples=index_samples,
+                                  **extra)
             sampler_manager.add_sampler(name, sampler)
             client.log.debug("initialized sampler '{}'".format(name))
         return sampler_manager
@@ -76,21 +338,132 @@ class SamplerManager(object):
         """Add a sample to the given sampler, with the current time"""
         self.get_sampler(sampler_name).add_sample(time(), value)
 
+    def sample_many(self, sampler_name, samples):
+        """Add an iterable of (timestamp, value) samples to the given sampler.
+        Returns the number of samples added.
+
+        """
+        return self.get_sampler(sampler_name).add_samples(samples)
+
     def enumerate_samplers(self):
         """Get the names of all the samplers"""
         return sorted(self.samplers.keys())
 
+    def get_chunk_samples(self, sampler):
+        """Get the maximum number of samples to send in a single request"""
+        sample_bytes = SYNC_SAMPLE_BYTES[sampler.sync_encoding]
+        return max(1, min(self.chunk_samples, self.chunk_bytes // sample_bytes))
+
+    def close(self):
+        """Flush and close all samplers"""
+        for sampler in self.samplers.values():
+            sampler.close()
+        if self._segment_store is not None:
+            self._segment_store.close()
+
+
+class SamplesJSON(StreamedValue):
+    """Samples sent as a JSON list of [timestamp, value] lists, encoded in blocks as the
+    request is written, rather than converted to a list in one go.
+
+    If the size is required before sending, the encoded blocks are kept.
+
+    """
+
+    block_samples = 1024
+
+    def __init__(self, samples):
+        self.samples = samples
+        self._blocks = None
+
+    def __repr__(self):
+        return "SamplesJSON({!r})".format(self.samples)
+
+    def _iter_blocks(self):
+        samples = self.samples
+        block_samples = self.block_samples
+        yield b'['
+        for start in range(0, len(samples), block_samples):
+            block_json = json.dumps(samples[start:start + block_samples].jsonify(), separators=(',', ':'))
+            if start:
+                yield b','
+            yield block_json[1:-1].encode('utf-8')
+        yield b']'
+
+    @property
+    def json_size(self):
+        if self._blocks is None:
+            self._blocks = list(self._iter_blocks())
+        return sum(len(block) for block in self._blocks)
+
+    def iter_json(self):
+        if self._blocks is not None:
+            return iter(self._blocks)
+        return self._iter_blocks()
+
 
+@register_sampler('file')
 class Sampler(object):
-    def __init__(self, path, name, time_format='d', value_format='d', max_samples=1000):
+    """Stores samples in a flat binary file.
+
+    The samples file is kept open between samples. Writes are flushed to the OS every
+    `flush_samples` samples, or when `flush_interval` milliseconds have elapsed since the
+    last flush (checked as samples arrive), and always before a snapshot is taken.
+    If `fsync` is True, every flush is also committed to disk.
+
+    `sync_encoding` selects how samples are sent to the server; 'json' sends a list of
+    [timestamp, value] pairs, 'gorilla' sends a base64 encoded compressed block.
+
+    `rollups` is a list of intervals (e.g. ['1m', '1h']) to summarize samples over. If
+    `sync_tier` names one of those rollups, the rollup is synced in place of the raw
+    samples when there are more than `sync_tier_backlog` samples waiting to be synced.
+
+    If `deadband` or `deadband_relative` is set, a sample is only stored if its value differs
+    from the last stored value by more than `deadband`, or `deadband_relative` times the
+    last value, or if more than `heartbeat` seconds have passed since the last stored sample.
+    A deadband of 0 stores only samples that change.
+
+    A sparse time index of blocks of `index_samples` samples is kept alongside the samples
+    file, so that `query` and `aggregate` only decode the blocks that overlap a time range.
+
+    """
+
+    samples_filename = 'samples.smp'
+    default_flush_samples = 1
+    # Storage maintains a time index
+    indexed = True
+
+    def __init__(self, path, name, time_format='d', value_format='d', max_samples=1000,
+                 flush_samples=1, flush_interval=0, fsync=False, sync_encoding='json',
+                 rollups=None, sync_tier='raw', sync_tier_backlog=0,
+                 deadband=None, deadband_relative=None, heartbeat=0, index_samples=256):
         self.path = abspath(path)
         self.name = name
         self.time_format = time_format
         self.value_format = value_format
         self.max_samples = max_samples
+        self.flush_samples = max(1, flush_samples)
+        self.flush_interval = flush_interval / 1000.0
+        self.fsync = fsync
+        self.sync_encoding = sync_encoding
+        self.rollups = [Rollup(path, name, parse_interval(name)) for name in (rollups or [])]
+        self.sync_tier = sync_tier
+        self.sync_tier_backlog = sync_tier_backlog
+        if sync_tier != 'raw' and sync_tier not in [rollup.name for rollup in self.rollups]:
+            raise errors.ConfigError("sync_tier should be 'raw' or one of the rollups")
+        self.deadband = deadband or 0.0
+        self.deadband_relative = deadband_relative or 0.0
+        self.heartbeat = heartbeat
+        self.filtered = deadband is not None or deadband_relative is not None
+        # Last stored (timestamp, value), for the deadband filter
+        self._last_sample = None
 
-        self.samples_path = join(path, 'samples.smp')
-        self.samples_snapshot_path = join(path, 'samples.smp.snapshot')
+        self.samples_path = join(path, self.samples_filename)
+        self.samples_snapshot_path = join(path, self.samples_filename + '.snapshot')
+        self.samples_snapshot_offset_path = self.samples_snapshot_path + '.offset'
+        self.samples_index_path = self.samples_path + '.idx'
+        self.samples_snapshot_index_path = self.samples_snapshot_path + '.idx'
+        self.index_samples = max(1, index_samples)
 
         sample_format = self.sample_format = '<' + time_format + value_format
         sample_struct = self.sample_struct = struct.Struct(py2bytes(sample_format))
@@ -102,6 +475,17 @@ class Sampler(object):
 
         self.lock = RLock()
 
+        # Open samples file, and number of samples it contains
+        self._samples_file = None
+        self._sample_count = None
+        # Time index for the samples file
+        self._index = None
+        # Time index for the snapshot, which isn't written once the snapshot is taken
+        self._snapshot_index = None
+        # Samples written since the last flush
+        self._pending = 0
+        self._flush_time = time()
+
         self.check_create()
         super(Sampler, self).__init__()
 
@@ -118,10 +502,89 @@ class Sampler(object):
         # Second line contains struct format
         return f.readline().rstrip(b'\n')
 
+    @property
+    def sample_count(self):
+        """Number of samples in the current samples file"""
+        with self.lock:
+            if self._sample_count is None:
+                self._open()
+            return self._sample_count
+
     @property
     def full(self):
         """Check if the sampler has more than the maximum number of samples"""
-        return getsize(self.samples_path) >= self.max_file_size
+        return self.sample_count >= self.max_samples
+
+    def _open(self):
+        """Open the samples file for appending, if it isn't already open"""
+        if self._samples_file is None:
+            self.check_create()
+            self._samples_file = open(self.samples_path, 'ab')
+            size = getsize(self.samples_path)
+            self._sample_count = max(0, size - len(self.header)) // self.sample_size
+            self._pending = 0
+            self._flush_time = time()
+            self._index = self._load_index(self.samples_index_path, self.samples_path, self._sample_count)
+        return self._samples_file
+
+    def _load_index(self, index_path, samples_path, sample_count, write=True):
+        """Load (or rebuild) the time index for a samples file"""
+        index = TimeIndex(index_path, self.index_samples, self.sample_format)
+        index.load(sample_count,
+                   lambda start, count: self.read_samples(samples_path, start=start, count=count),
+                   write=write)
+        return index
+
+    def _get_snapshot_index(self):
+        """Get the time index for the snapshot, loaded once and kept in memory"""
+        if self._snapshot_index is None:
+            snapshot_count = max(0, getsize(self.samples_snapshot_path) - len(self.header)) // self.sample_size
+            self._snapshot_index = self._load_index(self.samples_snapshot_index_path,
+                                                    self.samples_snapshot_path,
+                                                    snapshot_count,
+                                                    write=False)
+        return self._snapshot_index
+
+    def _close(self):
+        """Flush and close the samples file"""
+        if self._samples_file is not None:
+            try:
+                self._flush()
+            finally:
+                self._samples_file.close()
+                self._samples_file = None
+                self._sample_count = None
+                if self._index is not None:
+                    self._index.close()
+                    self._index = None
+
+    def _flush(self):
+        """Flush pending writes"""
+        if self._samples_file is not None and self._pending:
+            self._samples_file.flush()
+            if self.fsync:
+                os.fsync(self._samples_file.fileno())
+        self._pending = 0
+        self._flush_time = time()
+
+    def _written(self, count):
+        """Record samples written since the last flush, and flush if the policy requires it"""
+        self._pending += count
+        if self._pending >= self.flush_samples or \
+                (self.flush_interval and time() - self._flush_time >= self.flush_interval):
+            self._flush()
+
+    def flush(self):
+        """Flush any samples that haven't yet been written to disk"""
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        """Close the samples file (it will be re-opened on the next sample)"""
+        with self.lock:
+            self._close()
+        for rollup in self.rollups:
+            rollup.close()
 
     def check_create(self):
         """Create an empty sampler if it doesn't already exist"""
@@ -130,23 +593,31 @@ class Sampler(object):
                 with open(self.samples_path, 'wb') as f:
                     f.write(self.header)
 
-    def read_samples(self, samples_path=None):
-        """Read and unpack all the samples in to a list of tuples (timestamp, value)"""
+    def read_samples(self, samples_path=None, start=0, count=None):
+        """Read and unpack samples in to a Samples object.
+
+        If `start` is given, skip that many samples. If `count` is given, read at most that many samples.
+
+        """
         # N.B. Doesn't lock
         if samples_path is None:
             samples_path = self.samples_path
+            self.flush()
         with open(samples_path, 'rb') as f:
             sample_format = self._read_header(f).decode('utf-8')
-            sample_struct = struct.Struct(py2bytes(sample_format))
-            sample_size = sample_struct.size
-            read_sample = partial(f.read, sample_size)
-            unpack = sample_struct.unpack
-            samples = [unpack(sample) for sample in iter(read_sample, b'')]
-        return samples
+            sample_size = struct.calcsize(py2bytes(sample_format))
+            if start:
+                f.seek(start * sample_size, os.SEEK_CUR)
+            if count is None:
+                data = f.read()
+            else:
+                data = f.read(count * sample_size)
+        return Samples.decode(sample_format, data)
 
     def reset(self):
         """Reset samples"""
         with self.lock:
+            self._close()
             with open(self.samples_path, 'wb') as f:
                 f.write(self.header)
 
@@ -155,32 +626,880 @@ class Sampler(object):
         A return value of False indicates the sampler file has reached the maximum number of samples allowed.
 
         """
-        if self.full:
-            # Stop sampling when the file is full
-            return False
+        for rollup in self.rollups:
+            rollup.add(timestamp, value)
+        if self.filtered:
+            with self.lock:
+                if not self._check_deadband(timestamp, value, self._last_sample):
+                    return True
+                added = self._add_sample(timestamp, value)
+                if added:
+                    self._last_sample = (timestamp, value)
+            return added
+        return self._add_sample(timestamp, value)
+
+    def add_samples(self, samples):
+        """Add an iterable of (timestamp, value) samples (or a Samples object) with a single write.
+
+        Returns the number of samples added, which will be less than the number supplied
+        if the sampler became full.
+
+        """
+        if self.rollups:
+            samples = list(samples)
+            for rollup in self.rollups:
+                for timestamp, value in samples:
+                    rollup.add(timestamp, value)
+        if self.filtered:
+            with self.lock:
+                check_deadband = self._check_deadband
+                last_sample = self._last_sample
+                count = 0
+                stored = []
+                for sample in samples:
+                    count += 1
+                    if check_deadband(sample[0], sample[1], last_sample):
+                        stored.append(sample)
+                        last_sample = sample
+                added = self._add_samples(stored)
+                if added:
+                    self._last_sample = tuple(stored[added - 1])
+                # Samples dropped by the filter count as added
+                return count - (len(stored) - added)
+        return self._add_samples(samples)
+
+    def _check_deadband(self, timestamp, value, last_sample):
+        """Check if a sample should be stored, given the last stored sample"""
+        if last_sample is None:
+            return True
+        last_timestamp, last_value = last_sample
+        if self.heartbeat and timestamp - last_timestamp >= self.heartbeat:
+            return True
+        band = max(self.deadband, abs(last_value) * self.deadband_relative)
+        return abs(value - last_value) > band
+
+    def _add_sample(self, timestamp, value):
         with self.lock:
-            with open(self.samples_path, 'ab') as f:
-                f.write(self.sample_pack(timestamp, value))
+            samples_file = self._open()
+            if self._sample_count >= self.max_samples:
+                # Stop sampling when the file is full
+                return False
+            samples_file.write(self.sample_pack(timestamp, value))
+            self._sample_count += 1
+            self._index.add(timestamp, value)
+            self._written(1)
         return True
 
-    def snapshot_samples(self):
-        """Take a snapshot of samples for syncing, so that sampling may continue uninterrupted"""
+    def _add_samples(self, samples):
+        with self.lock:
+            samples_file = self._open()
+            available = max(0, self.max_samples - self._sample_count)
+            pack = self.sample_pack
+            samples = list(islice(samples, available))
+            data = b''.join([pack(timestamp, value) for timestamp, value in samples])
+            count = len(samples)
+            if count:
+                samples_file.write(data)
+                self._sample_count += count
+                self._index.add_samples(samples)
+                self._written(count)
+        return count
+
+    def _take_snapshot(self):
+        """Move the current samples to the snapshot file, if there isn't already a snapshot"""
         # A snapshot is a copy of the current samples file
         # Once it has been synced it can be deleted
         if not exists(self.samples_snapshot_path):
             with self.lock:
+                # Close the samples file so the next sample goes to a new file
+                self._close()
                 self.check_create()
                 if not exists(self.samples_snapshot_path):
                     os.rename(self.samples_path, self.samples_snapshot_path)
+                    if exists(self.samples_index_path):
+                        os.rename(self.samples_index_path, self.samples_snapshot_index_path)
+                    self._snapshot_index = None
+                    if self.indexed:
+                        self._get_snapshot_index()
+                    for rollup in self.rollups:
+                        rollup.take_snapshot()
                 self.check_create()
-        return self.read_samples(self.samples_snapshot_path)
+
+    def _read_snapshot_offset(self):
+        """Get the number of samples in the snapshot that have been acknowledged by the server"""
+        try:
+            with open(self.samples_snapshot_offset_path, 'rt') as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def snapshot_samples(self):
+        """Take a snapshot of samples for syncing, so that sampling may continue uninterrupted"""
+        self._take_snapshot()
+        return self.read_samples(self.samples_snapshot_path, start=self._read_snapshot_offset())
+
+    def iter_snapshot(self, chunk_samples):
+        """Take a snapshot, and yield (position, samples) for chunks of up to `chunk_samples`.
+
+        Samples already acknowledged with `ack_snapshot` are skipped.
+
+        """
+        self._take_snapshot()
+        position = self._read_snapshot_offset()
+        while 1:
+            samples = self.read_samples(self.samples_snapshot_path, start=position, count=chunk_samples)
+            if not samples:
+                break
+            position += len(samples)
+            yield position, samples
+
+    def ack_snapshot(self, position):
+        """Record that the snapshot has been synced up to a position returned by `iter_snapshot`"""
+        with atomicwrite.open(self.samples_snapshot_offset_path, 'wt') as f:
+            f.write(text_type(position))
 
     def remove_snapshot(self):
         """Remove any samples snapshot"""
+        with self.lock:
+            self._snapshot_index = None
+        for path in (self.samples_snapshot_path,
+                     self.samples_snapshot_offset_path,
+                     self.samples_snapshot_index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        for rollup in self.rollups:
+            rollup.remove_snapshot()
+
+    def _read_unsynced_snapshot(self):
+        """Read the snapshot samples the server hasn't acknowledged, without taking a snapshot"""
         try:
-            os.remove(self.samples_snapshot_path)
+            return self.read_samples(self.samples_snapshot_path, start=self._read_snapshot_offset())
+        except IOError:
+            # No snapshot
+            return None
+
+    @property
+    def backlog(self):
+        """Number of samples waiting to be synced"""
+        try:
+            snapshot_size = getsize(self.samples_snapshot_path) - len(self.header)
         except OSError:
-            pass
+            snapshot_size = 0
+        snapshot_count = max(0, snapshot_size // self.sample_size - self._read_snapshot_offset())
+        return self.sample_count + snapshot_count
+
+    def _iter_range(self, start, end, summarize=False):
+        """Yield unsynced Samples in the range start <= t <= end, from the snapshot and then the samples file.
+
+        If `summarize` is True, (min, max, total, count) tuples are yielded for index blocks
+        that are entirely inside the range, rather than decoding them.
+
+        """
+        with self.lock:
+            self.flush()
+            self._open()
+            files = []
+            if exists(self.samples_snapshot_path):
+                # Skip the samples the server has acknowledged
+                files.append((self.samples_snapshot_path, self._get_snapshot_index(), self._read_snapshot_offset()))
+            elif self._snapshot_index is not None:
+                # Removed by another sampler instance
+                self._snapshot_index = None
+            files.append((self.samples_path, self._index, 0))
+            for samples_path, index, offset in files:
+                block_samples = index.block_samples
+                blocks = [block for block in index.find_blocks(start, end) if (block + 1) * block_samples > offset]
+                while blocks:
+                    first = blocks[0]
+                    record = index.blocks[first]
+                    if summarize and first * block_samples >= offset and \
+                            (start is None or record[0] >= start) and (end is None or record[1] <= end):
+                        blocks.pop(0)
+                        yield (record[2], record[3], record[4], block_samples)
+                        continue
+                    # Read consecutive blocks in one go
+                    last = first
+                    while len(blocks) > last - first + 1 and blocks[last - first + 1] == last + 1:
+                        last += 1
+                    del blocks[:last - first + 1]
+                    read_start = max(first * block_samples, offset)
+                    yield self.read_samples(samples_path,
+                                            start=read_start,
+                                            count=(last + 1) * block_samples - read_start).between(start, end)
+                # Samples after the last complete block aren't in the index
+                yield self.read_samples(samples_path, start=max(index.indexed_samples, offset)).between(start, end)
+
+    def query(self, start=None, end=None):
+        """Get the unsynced samples with timestamps in the range start <= t <= end, as a Samples object.
+
+        Either `start` or `end` may be None for an open range.
+
+        """
+        if not self.indexed:
+            return Samples.join([self._read_unsynced_snapshot(), self.read_samples()]).between(start, end)
+        return Samples.join(list(self._iter_range(start, end)))
+
+    def aggregate(self, start=None, end=None):
+        """Get (min, max, mean, count) for the values of unsynced samples in the range
+        start <= t <= end, or None if there are no samples in the range."""
+        if not self.indexed:
+            return self.query(start, end).summarize()
+        minimum = maximum = None
+        total = 0.0
+        count = 0
+        for part in self._iter_range(start, end, summarize=True):
+            if isinstance(part, Samples):
+                summary = part.summarize()
+                if summary is None:
+                    continue
+                part_min, part_max, part_mean, part_count = summary
+                part_total = part_mean * part_count
+            else:
+                part_min, part_max, part_total, part_count = part
+            minimum = part_min if minimum is None else min(minimum, part_min)
+            maximum = part_max if maximum is None else max(maximum, part_max)
+            total += part_total
+            count += part_count
+        if not count:
+            return None
+        return (minimum, maximum, total / count, count)
+
+    def get_sync_rollup(self):
+        """Get the rollup that should be synced in place of raw samples, or None to sync raw samples"""
+        if self.sync_tier == 'raw' or self.backlog <= self.sync_tier_backlog:
+            return None
+        for rollup in self.rollups:
+            if rollup.name == self.sync_tier:
+                return rollup
+        return None
+
+    def snapshot_rollup(self, rollup):
+        """Take a snapshot, and return the rollup records it contains.
+
+        Once synced, `remove_snapshot` will discard the raw samples the rollup summarizes.
+
+        """
+        self._take_snapshot()
+        return rollup.snapshot_records()
+
+    def get_sync_params(self, samples):
+        """Get the parameters to send samples to device.add_samples"""
+        if self.sync_encoding == 'gorilla':
+            block = gorilla.encode_block(samples.timestamps, samples.values)
+            return {"samples": b64encode(block).decode('ascii'),
+                    "samples_encoding": "gorilla"}
+        return {"samples": SamplesJSON(samples)}
+
+
+@register_sampler('ring')
+class RingSampler(Sampler):
+    """Stores samples in a fixed size memory mapped ring buffer.
+
+    Rather than rejecting samples when full, the oldest samples are overwritten.
+
+    After the text header is a binary header with three counters; the total number of
+    samples written (head), the number of samples that have been synced (tail), and the
+    head at the time of the last snapshot. Sample n is stored in slot n % max_samples.
+
+    """
+
+    samples_filename = 'samples.ring'
+    indexed = False
+    counters_struct = struct.Struct(b'<QQQ')
+
+    @property
+    def header(self):
+        return b"sampler ring v1\n" + self.sample_format.encode('utf-8') + b'\n'
+
+    @property
+    def data_offset(self):
+        return len(self.header) + self.counters_struct.size
+
+    @property
+    def ring_file_size(self):
+        return self.data_offset + self.sample_size * self.max_samples
+
+    def check_create(self):
+        """Create an empty ring buffer if it doesn't exist, or it has a different format"""
+        with self.lock:
+            if exists(self.samples_path):
+                with open(self.samples_path, 'rb') as f:
+                    header = f.read(len(self.header))
+                if header == self.header and getsize(self.samples_path) == self.ring_file_size:
+                    return
+                log.warning("sampler '%s' has changed format, discarding samples", self.name)
+            with open(self.samples_path, 'wb') as f:
+                f.write(self.header)
+                f.write(self.counters_struct.pack(0, 0, 0))
+                f.truncate(self.ring_file_size)
+
+    def _open(self):
+        if self._samples_file is None:
+            self.check_create()
+            self._samples_file = open(self.samples_path, 'r+b')
+            self._map = mmap.mmap(self._samples_file.fileno(), 0)
+            self._pending = 0
+            self._flush_time = time()
+        return self._map
+
+    def _close(self):
+        if self._samples_file is not None:
+            try:
+                self._flush()
+            finally:
+                self._map.close()
+                self._map = None
+                self._samples_file.close()
+                self._samples_file = None
+
+    def _flush(self):
+        if self._samples_file is not None and self._pending and self.fsync:
+            self._map.flush()
+        self._pending = 0
+        self._flush_time = time()
+
+    def _read_counters(self):
+        head, tail, snapshot = self.counters_struct.unpack_from(self._open(), len(self.header))
+        # Samples older than max_samples have been overwritten
+        return head, max(tail, head - self.max_samples), snapshot
+
+    def _write_counters(self, head, tail, snapshot):
+        self.counters_struct.pack_into(self._open(), len(self.header), head, tail, snapshot)
+
+    def _read_window(self, start, end):
+        """Read samples from start up to (but not including) end"""
+        ring = self._open()
+        data_offset = self.data_offset
+        sample_size = self.sample_size
+        data = []
+        # The window is at most two contiguous regions of the ring
+        while start < end:
+            slot = start % self.max_samples
+            count = min(end - start, self.max_samples - slot)
+            offset = data_offset + slot * sample_size
+            data.append(ring[offset:offset + count * sample_size])
+            start += count
+        return Samples.decode(self.sample_format, b''.join(data))
+
+    @property
+    def sample_count(self):
+        with self.lock:
+            head, tail, _snapshot = self._read_counters()
+            return head - tail
+
+    @property
+    def full(self):
+        """A ring buffer is never full"""
+        return False
+
+    def _add_sample(self, timestamp, value):
+        """Add a sample, overwriting the oldest sample if the buffer is full. Always returns True."""
+        with self.lock:
+            ring = self._open()
+            head, tail, snapshot = self._read_counters()
+            offset = self.data_offset + (head % self.max_samples) * self.sample_size
+            self.sample_struct.pack_into(ring, offset, timestamp, value)
+            self._write_counters(head + 1, tail, snapshot)
+            self._written(1)
+        return True
+
+    def _add_samples(self, samples):
+        """Add samples with a single update of the counters, returns the number of samples added"""
+        pack = self.sample_pack
+        packed = [pack(timestamp, value) for timestamp, value in samples]
+        count = len(packed)
+        # Only the most recent samples fit in the ring
+        data = b''.join(packed[-self.max_samples:])
+        sample_size = self.sample_size
+        with self.lock:
+            ring = self._open()
+            head, tail, snapshot = self._read_counters()
+            position = head + count - len(data) // sample_size
+            offset = 0
+            # Copy in to at most two contiguous regions of the ring
+            while offset < len(data):
+                slot = position % self.max_samples
+                size = min(len(data) - offset, (self.max_samples - slot) * sample_size)
+                ring_offset = self.data_offset + slot * sample_size
+                ring[ring_offset:ring_offset + size] = data[offset:offset + size]
+                offset += size
+                position += size // sample_size
+            self._write_counters(head + count, tail, snapshot)
+            self._written(count)
+        return count
+
+    def read_samples(self, samples_path=None):
+        """Read all the samples that have not yet been synced"""
+        with self.lock:
+            head, tail, _snapshot = self._read_counters()
+            return self._read_window(tail, head)
+
+    def reset(self):
+        with self.lock:
+            head, _tail, _snapshot = self._read_counters()
+            self._write_counters(head, head, head)
+
+    def _take_snapshot(self):
+        """Mark the end of the snapshot, and return the (tail, head) window"""
+        with self.lock:
+            head, tail, _snapshot = self._read_counters()
+            self._write_counters(head, tail, head)
+            self._flush()
+            for rollup in self.rollups:
+                rollup.take_snapshot()
+            return tail, head
+
+    def snapshot_samples(self):
+        """Read the samples that have not yet been synced, and mark the end of the snapshot"""
+        with self.lock:
+            tail, head = self._take_snapshot()
+            return self._read_window(tail, head)
+
+    def iter_snapshot(self, chunk_samples):
+        """Mark the end of the snapshot, and yield (position, samples) for chunks of the window"""
+        position, head = self._take_snapshot()
+        while position < head:
+            with self.lock:
+                # Skip anything overwritten since the snapshot was taken
+                position = max(position, self._read_counters()[1])
+                end = min(position + chunk_samples, head)
+                if position >= end:
+                    break
+                samples = self._read_window(position, end)
+            position = end
+            yield position, samples
+
+    def ack_snapshot(self, position):
+        """Mark the samples up to position as synced"""
+        with self.lock:
+            head, tail, snapshot = self._read_counters()
+            self._write_counters(head, max(tail, position), snapshot)
+
+    def remove_snapshot(self):
+        """Mark the samples in the last snapshot as synced"""
+        with self.lock:
+            head, tail, snapshot = self._read_counters()
+            self._write_counters(head, max(tail, snapshot), snapshot)
+        for rollup in self.rollups:
+            rollup.remove_snapshot()
+
+    def _read_unsynced_snapshot(self):
+        # The unsynced samples in the snapshot are read with the rest of the window
+        return None
+
+    @property
+    def backlog(self):
+        return self.sample_count
+
+
+@register_sampler('gorilla')
+class GorillaSampler(Sampler):
+    """Stores samples in compressed blocks (see dataplicity.client.gorilla).
+
+    Samples are held in memory until the block is flushed, so `flush_samples` is the
+    number of samples per block. Timestamps are stored to millisecond precision.
+
+    """
+
+    samples_filename = 'samples.gor'
+    indexed = False
+    default_flush_samples = 120
+    block_length_struct = struct.Struct(b'<I')
+
+    def __init__(self, *args, **kwargs):
+        self._block_timestamps = []
+        self._block_values = []
+        super(GorillaSampler, self).__init__(*args, **kwargs)
+
+    @property
+    def header(self):
+        return b"sampler gorilla v1\n" + self.sample_format.encode('utf-8') + b'\n'
+
+    def _iter_blocks(self, f):
+        """Read length prefixed blocks from a file, ignoring an incomplete block at the end"""
+        length_size = self.block_length_struct.size
+        while 1:
+            length_bin = f.read(length_size)
+            if len(length_bin) < length_size:
+                break
+            length, = self.block_length_struct.unpack(length_bin)
+            block = f.read(length)
+            if len(block) < length:
+                break
+            yield block
+
+    def _count_samples(self, samples_path):
+        """Count the samples in a file, without decoding blocks"""
+        try:
+            with open(samples_path, 'rb') as f:
+                self._read_header(f)
+                # The first 4 bytes of a block are the sample count
+                return sum(struct.unpack_from(b'<I', block)[0] for block in self._iter_blocks(f))
+        except IOError:
+            return 0
+
+    @property
+    def backlog(self):
+        snapshot_count = self._count_samples(self.samples_snapshot_path) - self._read_snapshot_offset()
+        return self.sample_count + max(0, snapshot_count)
+
+    def _open(self):
+        if self._samples_file is None:
+            self.check_create()
+            self._sample_count = self._count_samples(self.samples_path)
+            self._samples_file = open(self.samples_path, 'ab')
+            self._sample_count += len(self._block_timestamps)
+            self._pending = len(self._block_timestamps)
+            self._flush_time = time()
+        return self._samples_file
+
+    def _flush(self):
+        if self._samples_file is not None and self._block_timestamps:
+            block = gorilla.encode_block(self._block_timestamps, self._block_values)
+            self._samples_file.write(self.block_length_struct.pack(len(block)) + block)
+            self._samples_file.flush()
+            if self.fsync:
+                os.fsync(self._samples_file.fileno())
+        del self._block_timestamps[:]
+        del self._block_values[:]
+        self._pending = 0
+        self._flush_time = time()
+
+    def _add_sample(self, timestamp, value):
+        with self.lock:
+            self._open()
+            if self._sample_count >= self.max_samples:
+                return False
+            self._block_timestamps.append(timestamp)
+            self._block_values.append(value)
+            self._sample_count += 1
+            self._written(1)
+        return True
+
+    def _add_samples(self, samples):
+        with self.lock:
+            self._open()
+            available = max(0, self.max_samples - self._sample_count)
+            count = 0
+            for timestamp, value in islice(samples, available):
+                self._block_timestamps.append(timestamp)
+                self._block_values.append(value)
+                count += 1
+            self._sample_count += count
+            self._written(count)
+        return count
+
+    def reset(self):
+        with self.lock:
+            del self._block_timestamps[:]
+            del self._block_values[:]
+            super(GorillaSampler, self).reset()
+
+    def read_samples(self, samples_path=None, start=0, count=None):
+        """Read and decode samples in to a Samples object"""
+        if samples_path is None:
+            samples_path = self.samples_path
+            self.flush()
+        timestamps = _make_column(self.time_format)
+        values = _make_column(self.value_format)
+        # Restore the types that were lost when encoded as floats
+        to_int = lambda value: int(round(value))
+        time_type = float if self.time_format in 'fd' else to_int
+        value_type = float if self.value_format in 'fd' else to_int
+        position = 0
+        with open(samples_path, 'rb') as f:
+            self._read_header(f)
+            for block in self._iter_blocks(f):
+                block_count, = struct.unpack_from(b'<I', block)
+                if position + block_count <= start:
+                    # Skip blocks without decoding
+                    position += block_count
+                    continue
+                block_timestamps, block_values = gorilla.decode_block(block)
+                block_start = max(0, start - position)
+                block_end = block_count if count is None else min(block_count, block_start + count - len(timestamps))
+                timestamps.extend(time_type(timestamp) for timestamp in block_timestamps[block_start:block_end])
+                values.extend(value_type(value) for value in block_values[block_start:block_end])
+                position += block_count
+                if count is not None and len(timestamps) >= count:
+                    break
+        return Samples(timestamps, values)
+
+
+@register_sampler('segment')
+class SegmentSampler(Sampler):
+    """Stores samples in segment files shared with other samplers (see dataplicity.client.segments).
+
+    Taking a snapshot rolls the active segment for every sampler in the store, and the
+    snapshot is read with a single scan. A sampler still syncing an earlier snapshot
+    doesn't roll the active segment, but doesn't prevent other samplers from doing so.
+    Snapshot segments are removed once every sampler has synced its samples.
+
+    """
+
+    indexed = False
+
+    def __init__(self, path, name, store=None, **kwargs):
+        if store is None:
+            raise SamplerError("segment storage requires a segment store")
+        self.store = store
+        super(SegmentSampler, self).__init__(path, name, **kwargs)
+        self.sampler_id = store.register(name, self.sample_format)
+        if self.rollups and not os.path.isdir(self.path):
+            # Rollups are still stored per sampler
+            os.makedirs(self.path)
+
+    def check_create(self):
+        """Segments are created by the store"""
+        pass
+
+    @property
+    def sample_count(self):
+        return self.store.count(self.sampler_id)
+
+    def _close(self):
+        self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self.store.flush(fsync=self.fsync)
+        self._pending = 0
+        self._flush_time = time()
+
+    def _add_sample(self, timestamp, value):
+        with self.lock:
+            if self.store.count(self.sampler_id) >= self.max_samples:
+                return False
+            self.store.append(self.sampler_id, self.sample_pack(timestamp, value))
+            self._written(1)
+        return True
+
+    def _add_samples(self, samples):
+        with self.lock:
+            available = max(0, self.max_samples - self.store.count(self.sampler_id))
+            pack = self.sample_pack
+            data = b''.join([pack(timestamp, value) for timestamp, value in islice(samples, available)])
+            count = self.store.append(self.sampler_id, data) if data else 0
+            if count:
+                self._written(count)
+        return count
+
+    def _decode(self, data, start=0, count=None):
+        sample_size = self.sample_size
+        end = len(data) if count is None else (start + count) * sample_size
+        return Samples.decode(self.sample_format, data[start * sample_size:end])
+
+    def read_samples(self, samples_path=None, start=0, count=None):
+        """Read the samples in the active segment"""
+        self.flush()
+        return self._decode(self.store.read_active(self.sampler_id), start, count)
+
+    def reset(self):
+        raise SamplerError("samplers with segment storage can not be reset")
+
+    def _take_snapshot(self):
+        with self.lock:
+            self._flush()
+            self.store.take_snapshot(self.sampler_id)
+            for rollup in self.rollups:
+                rollup.take_snapshot()
+
+    def snapshot_samples(self):
+        self._take_snapshot()
+        return self._decode(self.store.snapshot_data(self.sampler_id), self.store.get_ack(self.sampler_id))
+
+    def iter_snapshot(self, chunk_samples):
+        self._take_snapshot()
+        data = self.store.snapshot_data(self.sampler_id)
+        position = self.store.get_ack(self.sampler_id)
+        while 1:
+            samples = self._decode(data, position, chunk_samples)
+            if not samples:
+                break
+            position += len(samples)
+            yield position, samples
+
+    def ack_snapshot(self, position):
+        self.store.ack(self.sampler_id, position)
+
+    def _read_unsynced_snapshot(self):
+        return self._decode(self.store.snapshot_data(self.sampler_id), self.store.get_ack(self.sampler_id))
+
+    def remove_snapshot(self):
+        self.store.remove_snapshot(self.sampler_id)
+        for rollup in self.rollups:
+            rollup.remove_snapshot()
+
+    @property
+    def backlog(self):
+        snapshot_count = self.store.snapshot_count(self.sampler_id) - self.store.get_ack(self.sampler_id)
+        return self.sample_count + max(0, snapshot_count)
+
+
+@register_sampler('sqlite')
+class SQLiteSampler(Sampler):
+    """Stores samples in an SQLite database shared with other samplers and timelines
+    (see dataplicity.client.sqlitestore).
+
+    Samples are buffered and inserted `flush_samples` at a time in a single transaction.
+    Taking a snapshot marks the unsynced samples, which are deleted as they are acknowledged.
+    Timestamps and values are stored as floats.
+
+    """
+
+    indexed = False
+
+    def __init__(self, path, name, database=None, **kwargs):
+        if database is None:
+            raise SamplerError("sqlite storage requires a database")
+        self.database = database
+        self._rows = []
+        super(SQLiteSampler, self).__init__(path, name, **kwargs)
+        if self.rollups and not os.path.isdir(self.path):
+            # Rollups are still stored per sampler
+            os.makedirs(self.path)
+
+    def check_create(self):
+        pass
+
+    def _open(self):
+        if self._sample_count is None:
+            self._sample_count = self.database.query_value(
+                "SELECT COUNT(*) FROM samples WHERE sampler=? AND synced=0", (self.name,)) + len(self._rows)
+            self._flush_time = time()
+
+    @property
+    def sample_count(self):
+        with self.lock:
+            self._open()
+            return self._sample_count
+
+    def _close(self):
+        self._flush()
+        self._sample_count = None
+
+    def _flush(self):
+        if self._rows:
+            with self.database.transaction() as cursor:
+                cursor.executemany("INSERT INTO samples (sampler, timestamp, value) VALUES (?, ?, ?)", self._rows)
+            del self._rows[:]
+        self._pending = 0
+        self._flush_time = time()
+
+    def _add_sample(self, timestamp, value):
+        with self.lock:
+            self._open()
+            if self._sample_count >= self.max_samples:
+                return False
+            self._rows.append((self.name, timestamp, value))
+            self._sample_count += 1
+            self._written(1)
+        return True
+
+    def _add_samples(self, samples):
+        with self.lock:
+            self._open()
+            available = max(0, self.max_samples - self._sample_count)
+            name = self.name
+            rows = [(name, timestamp, value) for timestamp, value in islice(samples, available)]
+            count = len(rows)
+            if count:
+                self._rows.extend(rows)
+                self._sample_count += count
+                self._written(count)
+        return count
+
+    def _make_samples(self, rows):
+        """Make a Samples object from (timestamp, value) rows, restoring the sampler's types"""
+        to_int = lambda value: int(round(value))
+        time_type = float if self.time_format in 'fd' else to_int
+        value_type = float if self.value_format in 'fd' else to_int
+        return Samples(_make_column(self.time_format, [time_type(row[0]) for row in rows]),
+                       _make_column(self.value_format, [value_type(row[1]) for row in rows]))
+
+    def read_samples(self, samples_path=None, start=0, count=None):
+        """Read the samples that haven't been snapshotted"""
+        self.flush()
+        rows = self.database.query("SELECT timestamp, value FROM samples WHERE sampler=? AND synced=0 "
+                                   "ORDER BY id LIMIT ? OFFSET ?",
+                                   (self.name, -1 if count is None else count, start))
+        return self._make_samples(rows)
+
+    def reset(self):
+        with self.lock:
+            del self._rows[:]
+            self.database.execute("DELETE FROM samples WHERE sampler=? AND synced=0", (self.name,))
+            self._sample_count = None
+
+    def _take_snapshot(self):
+        with self.lock:
+            self._flush()
+            with self.database.transaction() as cursor:
+                cursor.execute("SELECT 1 FROM samples WHERE sampler=? AND synced=1 LIMIT 1", (self.name,))
+                if cursor.fetchone() is None:
+                    cursor.execute("UPDATE samples SET synced=1 WHERE sampler=? AND synced=0", (self.name,))
+                    self._sample_count = None
+                    for rollup in self.rollups:
+                        rollup.take_snapshot()
+
+    def _read_snapshot(self, position=0, count=None):
+        """Get a list of (id, timestamp, value) for samples in the snapshot after `position`"""
+        return self.database.query("SELECT id, timestamp, value FROM samples WHERE sampler=? AND synced=1 AND id>? "
+                                   "ORDER BY id LIMIT ?",
+                                   (self.name, position, -1 if count is None else count))
+
+    def snapshot_samples(self):
+        self._take_snapshot()
+        return self._make_samples([row[1:] for row in self._read_snapshot()])
+
+    def iter_snapshot(self, chunk_samples):
+        """Yield (position, samples), where position is the id of the last sample in the chunk"""
+        self._take_snapshot()
+        position = 0
+        while 1:
+            rows = self._read_snapshot(position, chunk_samples)
+            if not rows:
+                break
+            position = rows[-1][0]
+            yield position, self._make_samples([row[1:] for row in rows])
+
+    def ack_snapshot(self, position):
+        """Delete the samples in the snapshot up to position"""
+        self.database.execute("DELETE FROM samples WHERE sampler=? AND synced=1 AND id<=?", (self.name, position))
+
+    def remove_snapshot(self):
+        self.database.execute("DELETE FROM samples WHERE sampler=? AND synced=1", (self.name,))
+        for rollup in self.rollups:
+            rollup.remove_snapshot()
+
+    @property
+    def backlog(self):
+        snapshot_count = self.database.query_value("SELECT COUNT(*) FROM samples WHERE sampler=? AND synced=1",
+                                                   (self.name,))
+        return self.sample_count + snapshot_count
+
+    def query(self, start=None, end=None):
+        """Get the stored samples with timestamps in the range start <= t <= end"""
+        self.flush()
+        rows = self.database.query("SELECT timestamp, value FROM samples WHERE sampler=? AND timestamp>=? AND timestamp<=? "
+                                   "ORDER BY id",
+                                   (self.name,
+                                    float('-inf') if start is None else start,
+                                    float('inf') if end is None else end))
+        return self._make_samples(rows)
+
+    def aggregate(self, start=None, end=None):
+        self.flush()
+        row = self.database.query("SELECT MIN(value), MAX(value), AVG(value), COUNT(*) FROM samples "
+                                  "WHERE sampler=? AND timestamp>=? AND timestamp<=?",
+                                  (self.name,
+                                   float('-inf') if start is None else start,
+                                   float('inf') if end is None else end))[0]
+        if not row[3]:
+            return None
+        return tuple(row)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,340 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+A store that multiplexes samples from many samplers in to shared segment files
+
+Each record in a segment is a 2 byte sampler id followed by a sample packed in that
+sampler's format. Sampler ids are allocated in an index file, which has a line
+per id with the sampler name and sample format.
+
+Samples are appended to 'active.seg'. Taking a snapshot rolls the active segment
+to a numbered snapshot segment, which is read for syncing with a single sequential scan.
+
+The samples each sampler has synced from each snapshot are recorded separately, so a
+sampler that has synced everything may roll a new snapshot while another sampler is
+still syncing an older one. A snapshot segment is removed once every sampler has synced
+it. If a sampler falls more than `max_snapshots` snapshots behind, the oldest snapshot
+is discarded.
+
+"""
+
+from dataplicity import atomicwrite
+from dataplicity.compat import py2bytes, iteritems, text_type
+
+import os
+from os.path import join, exists, getsize
+from threading import RLock
+from collections import defaultdict
+import struct
+import json
+import re
+
+import logging
+log = logging.getLogger('dataplicity')
+
+
+class SegmentError(Exception):
+    pass
+
+
+class SegmentStore(object):
+    """Append-only segment files shared by many samplers"""
+
+    header = b"segments v1\n"
+    id_struct = struct.Struct(b'<H')
+    # The most snapshots kept for samplers that haven't synced
+    max_snapshots = 10
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = join(path, 'samplers.idx')
+        self.active_path = join(path, 'active.seg')
+        self.acks_path = join(path, 'snapshot.acks')
+        self.lock = RLock()
+
+        # Maps sampler id on to (name, sample size, sample format)
+        self._formats = {}
+        # Maps (name, sample format) on to a sampler id
+        self._ids = {}
+        # Ids registered by this process
+        self._registered = set()
+
+        self._active_file = None
+        self._counts = defaultdict(int)
+        # Maps snapshot number on to packed samples for each sampler, read on demand
+        self._snapshots = {}
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._read_index()
+        self._upgrade_snapshot()
+        self._snapshot_numbers = self._list_snapshots()
+
+    def __repr__(self):
+        return "SegmentStore({!r})".format(self.path)
+
+    def _read_index(self):
+        if not exists(self.index_path):
+            return
+        with open(self.index_path, 'rt') as f:
+            for line in f:
+                try:
+                    sampler_id, name, sample_format = line.split()
+                    sampler_id = int(sampler_id)
+                except ValueError:
+                    continue
+                self._formats[sampler_id] = (name, struct.calcsize(py2bytes(sample_format)), sample_format)
+                self._ids[(name, sample_format)] = sampler_id
+
+    def register(self, name, sample_format):
+        """Get the id for a sampler, allocating a new id if necessary"""
+        with self.lock:
+            sampler_id = self._ids.get((name, sample_format))
+            if sampler_id is None:
+                sampler_id = max(self._formats or [0]) + 1
+                if sampler_id >= 1 << 16:
+                    raise SegmentError("too many samplers in segment store")
+                with open(self.index_path, 'at') as f:
+                    f.write("{} {} {}\n".format(sampler_id, name, sample_format))
+                self._formats[sampler_id] = (name, struct.calcsize(py2bytes(sample_format)), sample_format)
+                self._ids[(name, sample_format)] = sampler_id
+            self._registered.add(sampler_id)
+            return sampler_id
+
+    def _scan(self, path):
+        """Read a segment, and return a dict that maps sampler id on to packed samples,
+        and the size of the valid data in the segment."""
+        samples = defaultdict(list)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return {}, 0
+        if not data.startswith(self.header):
+            return {}, 0
+        formats = self._formats
+        id_size = self.id_struct.size
+        unpack_id = self.id_struct.unpack_from
+        pos = len(self.header)
+        end = len(data)
+        while pos + id_size <= end:
+            sampler_id, = unpack_id(data, pos)
+            try:
+                sample_size = formats[sampler_id][1]
+            except KeyError:
+                log.warning("unknown sampler id %s in %s", sampler_id, path)
+                break
+            sample_end = pos + id_size + sample_size
+            if sample_end > end:
+                break
+            samples[sampler_id].append(data[pos + id_size:sample_end])
+            pos = sample_end
+        return {sampler_id: b''.join(packed) for sampler_id, packed in iteritems(samples)}, pos
+
+    def _open(self):
+        """Open the active segment, counting the samples it contains"""
+        if self._active_file is None:
+            if exists(self.active_path):
+                samples, valid_size = self._scan(self.active_path)
+            else:
+                samples, valid_size = {}, 0
+            if not valid_size:
+                with open(self.active_path, 'wb') as f:
+                    f.write(self.header)
+            elif valid_size < getsize(self.active_path):
+                # Discard an incomplete record at the end of the segment
+                with open(self.active_path, 'r+b') as f:
+                    f.truncate(valid_size)
+            self._counts.clear()
+            for sampler_id, packed in iteritems(samples):
+                self._counts[sampler_id] = len(packed) // self._formats[sampler_id][1]
+            self._active_file = open(self.active_path, 'ab')
+        return self._active_file
+
+    def count(self, sampler_id):
+        """Get the number of samples in the active segment for a sampler"""
+        with self.lock:
+            self._open()
+            return self._counts[sampler_id]
+
+    def append(self, sampler_id, data):
+        """Append packed samples for a sampler"""
+        sample_size = self._formats[sampler_id][1]
+        id_bin = self.id_struct.pack(sampler_id)
+        count = len(data) // sample_size
+        if count == 1:
+            records = id_bin + data
+        else:
+            records = b''.join([id_bin + data[offset:offset + sample_size]
+                                for offset in range(0, count * sample_size, sample_size)])
+        with self.lock:
+            self._open().write(records)
+            self._counts[sampler_id] += count
+        return count
+
+    def flush(self, fsync=False):
+        """Flush the active segment, and optionally commit it to disk"""
+        with self.lock:
+            if self._active_file is not None:
+                self._active_file.flush()
+                if fsync:
+                    os.fsync(self._active_file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self._active_file is not None:
+                self.flush()
+                self._active_file.close()
+                self._active_file = None
+
+    def read_active(self, sampler_id):
+        """Read the packed samples for a sampler in the active segment"""
+        with self.lock:
+            self.flush()
+            samples, _valid_size = self._scan(self.active_path)
+        return samples.get(sampler_id, b'')
+
+    def _snapshot_path(self, number):
+        return join(self.path, "snapshot.{}.seg".format(number))
+
+    def _list_snapshots(self):
+        """Get a sorted list of snapshot numbers"""
+        numbers = []
+        for filename in os.listdir(self.path):
+            match = re.match(r'^snapshot\.(\d+)\.seg$', filename)
+            if match is not None:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _upgrade_snapshot(self):
+        """Number a snapshot written by an earlier version, which kept a single snapshot"""
+        legacy_path = join(self.path, 'snapshot.seg')
+        if not exists(legacy_path):
+            return
+        try:
+            with open(self.acks_path, 'rt') as f:
+                acks = json.load(f)
+        except (IOError, ValueError):
+            acks = {}
+        os.rename(legacy_path, self._snapshot_path(1))
+        self._write_acks({int(sampler_id): {1: position} for sampler_id, position in iteritems(acks)})
+
+    def _scan_snapshot(self, number):
+        """Get a dict that maps sampler id on to packed samples in a snapshot"""
+        if number not in self._snapshots:
+            self._snapshots[number], _valid_size = self._scan(self._snapshot_path(number))
+        return self._snapshots[number]
+
+    def _count(self, number, sampler_id):
+        """Get the number of samples for a sampler in a snapshot"""
+        return len(self._scan_snapshot(number).get(sampler_id, b'')) // self._formats[sampler_id][1]
+
+    def _is_pending(self, sampler_id, acks, numbers=None):
+        """Check if a sampler has samples in snapshots that it hasn't synced"""
+        sampler_acks = acks.get(sampler_id, {})
+        return any(sampler_acks.get(number, 0) < self._count(number, sampler_id)
+                   for number in (self._snapshot_numbers if numbers is None else numbers))
+
+    def take_snapshot(self, sampler_id):
+        """Roll the active segment to a new snapshot, unless the sampler is still syncing an
+        earlier snapshot (which it will finish before new samples are synced)."""
+        with self.lock:
+            if self._is_pending(sampler_id, self._read_acks()):
+                return
+            self._open()
+            if not any(self._counts.values()):
+                return
+            self.close()
+            number = self._snapshot_numbers[-1] + 1 if self._snapshot_numbers else 1
+            os.rename(self.active_path, self._snapshot_path(number))
+            self._counts.clear()
+            self._snapshot_numbers.append(number)
+            if len(self._snapshot_numbers) > self.max_snapshots:
+                self._discard_snapshot(self._snapshot_numbers[0])
+
+    def _discard_snapshot(self, number):
+        """Remove the oldest snapshot, which samplers haven't synced"""
+        acks = self._read_acks()
+        names = sorted(self._formats[sampler_id][0] for sampler_id in self._registered
+                       if self._is_pending(sampler_id, acks, [number]))
+        log.warning("discarding unsynced samples in snapshot %s for sampler(s) %s", number, ", ".join(names))
+        self._remove_snapshots([number], acks)
+
+    def _remove_snapshots(self, numbers, acks):
+        """Remove snapshot segments, and their acks"""
+        for number in numbers:
+            try:
+                os.remove(self._snapshot_path(number))
+            except OSError:
+                pass
+            self._snapshot_numbers.remove(number)
+            self._snapshots.pop(number, None)
+            for sampler_acks in acks.values():
+                sampler_acks.pop(number, None)
+        if self._snapshot_numbers:
+            self._write_acks(acks)
+        else:
+            try:
+                os.remove(self.acks_path)
+            except OSError:
+                pass
+
+    def snapshot_data(self, sampler_id):
+        """Get the packed samples for a sampler in the snapshots"""
+        with self.lock:
+            return b''.join(self._scan_snapshot(number).get(sampler_id, b'')
+                            for number in self._snapshot_numbers)
+
+    def snapshot_count(self, sampler_id):
+        """Get the number of samples for a sampler in the snapshots"""
+        with self.lock:
+            return sum(self._count(number, sampler_id) for number in self._snapshot_numbers)
+
+    def _read_acks(self):
+        """Read a dict that maps sampler id on to a dict of the number of samples
+        acknowledged in each snapshot"""
+        try:
+            with open(self.acks_path, 'rt') as f:
+                acks = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return {int(sampler_id): {int(number): position for number, position in iteritems(sampler_acks)}
+                for sampler_id, sampler_acks in iteritems(acks)}
+
+    def _write_acks(self, acks):
+        with atomicwrite.open(self.acks_path, 'wt') as f:
+            f.write(json.dumps({text_type(sampler_id): {text_type(number): position
+                                                        for number, position in iteritems(sampler_acks)}
+                                for sampler_id, sampler_acks in iteritems(acks)}))
+
+    def get_ack(self, sampler_id):
+        """Get the number of samples in the snapshots the server has acknowledged"""
+        with self.lock:
+            sampler_acks = self._read_acks().get(sampler_id, {})
+            return sum(min(sampler_acks.get(number, 0), self._count(number, sampler_id))
+                       for number in self._snapshot_numbers)
+
+    def ack(self, sampler_id, position):
+        """Record that the first `position` samples for a sampler in the snapshots are synced"""
+        with self.lock:
+            acks = self._read_acks()
+            sampler_acks = acks[sampler_id] = {}
+            for number in self._snapshot_numbers:
+                acked = min(position, self._count(number, sampler_id))
+                sampler_acks[number] = acked
+                position -= acked
+            self._write_acks(acks)
+
+    def remove_snapshot(self, sampler_id):
+        """Mark all of a sampler's samples in the snapshots as synced, and remove snapshots
+        that every registered sampler has synced."""
+        with self.lock:
+            if not self._snapshot_numbers:
+                return
+            self.ack(sampler_id, self.snapshot_count(sampler_id))
+            acks = self._read_acks()
+            synced = [number for number in self._snapshot_numbers
+                      if not any(self._is_pending(pending_id, acks, [number]) for pending_id in self._registered)]
+            if synced:
+                self._remove_snapshots(synced, acks)
@@ -0,0 +1,125 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Authentication of batches of calls to the server
+
+Every batch begins with a call that authenticates the device. By default that is
+device.check_auth, which sends the serial and auth token for the server to verify.
+
+In session mode, the first batch calls device.open_session, which verifies the auth token
+and returns a short-lived session token. Later batches call device.check_session with just
+the session token. If the session token is rejected (or has expired), the batch is sent
+again with full authentication, which opens a new session.
+
+"""
+
+from dataplicity.jsonrpc import JSONRPCError, ErrorCode
+
+from threading import Lock
+from time import time
+
+import logging
+log = logging.getLogger('dataplicity')
+
+
+class Session(object):
+    """Authenticates batches, reusing a session token if `enabled` is True"""
+
+    # Stop using a session token this many seconds before it expires
+    expiry_margin = 10.0
+
+    def __init__(self, client, enabled=False):
+        self.client = client
+        self.enabled = enabled
+        self.token = None
+        self.expires = None
+        self.lock = Lock()
+
+    def __repr__(self):
+        return "<session {}>".format('enabled' if self.enabled else 'disabled')
+
+    @classmethod
+    def init_from_conf(cls, client, conf):
+        return cls(client, enabled=conf.get_bool('server', 'sessions', False))
+
+    def _get_token(self):
+        """Get the current session token, or None if there isn't a valid session"""
+        with self.lock:
+            if self.token is not None and time() < self.expires - self.expiry_margin:
+                return self.token
+            self.token = None
+            return None
+
+    def _open(self, token, expires):
+        with self.lock:
+            self.token = token
+            self.expires = time() + expires
+        log.debug("opened session, expires in {}s".format(expires))
+
+    def _expire(self, token):
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+    def _get_call(self, params):
+        """Get the method and params for an authentication call"""
+        token = self._get_token()
+        if token is not None:
+            return 'device.check_session', dict(params, session=token)
+        client = self.client
+        return ('device.open_session' if self.enabled else 'device.check_auth',
+                dict(params,
+                     device_class=client.device_class,
+                     serial=client.serial,
+                     auth_token=client.auth_token))
+
+    def authenticate(self, batch, call_id='authenticate_result', **params):
+        """Add an authentication call to a batch"""
+        method, params = self._get_call(params)
+        batch.call_with_id(call_id, method, **params)
+
+    def _find_call(self, batch, call_id):
+        for call in batch.calls:
+            if call.get('id') == call_id:
+                return call
+        raise KeyError("No such call_id in batch")
+
+    def _reauthenticate(self, batch, call_id):
+        """Replace the authentication call in a sent batch, and send it again"""
+        call = self._find_call(batch, call_id)
+        params = {k: v for k, v in call['params'].items()
+                  if k not in ('session', 'device_class', 'serial', 'auth_token')}
+        call['method'], call['params'] = self._get_call(params)
+        batch.methods[call_id] = call['method']
+        batch.send()
+
+    def check(self, batch, call_id='authenticate_result'):
+        """Check the authentication result of a sent batch, and return it.
+
+        If the session token was rejected, the batch is sent again with full authentication.
+
+        """
+        method = batch.methods[call_id]
+        try:
+            result = batch.get_result(call_id)
+        except JSONRPCError as e:
+            if method == 'device.open_session' and e.code == ErrorCode.method_not_found:
+                log.debug("server doesn't support sessions, using check_auth")
+                self.enabled = False
+            elif method == 'device.check_session':
+                log.debug("session token rejected ({}), re-authenticating".format(e))
+                self._expire(self._find_call(batch, call_id)['params']['session'])
+            else:
+                raise
+            self._reauthenticate(batch, call_id)
+            return self.check(batch, call_id)
+        if method == 'device.check_session' and not result:
+            log.debug("session expired, re-authenticating")
+            self._expire(self._find_call(batch, call_id)['params']['session'])
+            self._reauthenticate(batch, call_id)
+            return self.check(batch, call_id)
+        if method == 'device.open_session':
+            self._open(result['session'], result['expires'])
+            return True
+        return result
@@ -0,0 +1,124 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+An SQLite database for sampler and timeline storage
+
+A single database per device class stores samples, events and attachments. The
+database is opened in WAL mode, so syncing doesn't block writing new samples or events.
+
+"""
+
+from dataplicity import constants
+from dataplicity import errors
+
+import os
+from os.path import join, abspath
+from threading import RLock
+from contextlib import contextmanager
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+import logging
+log = logging.getLogger('dataplicity')
+
+
+_schema = [
+    """CREATE TABLE IF NOT EXISTS samples (
+        id INTEGER PRIMARY KEY,
+        sampler TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        value REAL NOT NULL,
+        synced INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS samples_sync ON samples (sampler, synced, id)",
+    "CREATE INDEX IF NOT EXISTS samples_time ON samples (sampler, timestamp)",
+    """CREATE TABLE IF NOT EXISTS events (
+        timeline TEXT NOT NULL,
+        event_id TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (timeline, event_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS events_time ON events (timeline, timestamp, event_id)",
+    """CREATE TABLE IF NOT EXISTS attachments (
+        timeline TEXT NOT NULL,
+        blob TEXT NOT NULL,
+        chunk INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (timeline, blob, chunk)
+    )"""
+]
+
+# Databases opened by this process, keyed on path
+_databases = {}
+_databases_lock = RLock()
+
+
+class Database(object):
+    """An SQLite connection shared between threads"""
+
+    def __init__(self, path):
+        if sqlite3 is None:
+            raise errors.ConfigError("sqlite storage requires Python's sqlite3 module")
+        self.path = path
+        self.lock = RLock()
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            with self.connection:
+                for statement in _schema:
+                    self.connection.execute(statement)
+
+    def __repr__(self):
+        return "Database({!r})".format(self.path)
+
+    @contextmanager
+    def transaction(self):
+        """Lock the database for this thread, and yield a cursor in a transaction"""
+        with self.lock:
+            with self.connection:
+                yield self.connection.cursor()
+
+    def execute(self, sql, params=()):
+        """Execute a statement in its own transaction"""
+        with self.transaction() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def query(self, sql, params=()):
+        """Get a list of rows for a query"""
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def query_value(self, sql, params=()):
+        """Get the first column of the first row for a query"""
+        with self.lock:
+            row = self.connection.execute(sql, params).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def binary(data):
+    """Wrap bytes for an SQLite BLOB column"""
+    return sqlite3.Binary(data)
+
+
+def get_database(client, conf):
+    """Get the database for the client's device class, opening it if necessary"""
+    path = conf.get('sqlite', 'path', constants.SQLITE_PATH)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    db_path = abspath(join(path, '{}.db'.format(client.device_class)))
+    with _databases_lock:
+        if db_path not in _databases:
+            _databases[db_path] = Database(db_path)
+            client.log.debug("opened database {}".format(db_path))
+        return _databases[db_path]
@@ -0,0 +1,184 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+A sparse time index for a samples file
+
+Samples are divided in to fixed size blocks, and for each complete block the index
+stores the minimum and maximum timestamp, and the minimum, maximum and total of the
+values. A query can binary search the index to find the blocks that overlap a time
+range, and aggregates can use the stored values for blocks entirely inside the range.
+
+The index is derived from the samples file, and is rebuilt if it is missing or
+doesn't match the samples. The index file begins with a check line, containing the
+sample format, the block size, and the timestamp of the first sample, so an index
+left over from a different samples file isn't used.
+
+"""
+
+from bisect import bisect_left, bisect_right
+from threading import RLock
+import struct
+
+
+class TimeIndex(object):
+    """Block min / max timestamps (and value summaries) for a samples file"""
+
+    record_struct = struct.Struct(b'<ddddd')
+    header = b"time index v2\n"
+
+    def __init__(self, index_path, block_samples=256, sample_format=''):
+        self.index_path = index_path
+        self.block_samples = block_samples
+        self.sample_format = sample_format
+        self.lock = RLock()
+        self._index_file = None
+        # Timestamp of the first sample, and if the check line has been written to the index file
+        self._first_timestamp = None
+        self._check_written = False
+        # (min time, max time, min value, max value, total) for each complete block
+        self.blocks = []
+        # Running maximum of the block max times, which is sorted
+        self._max_times = []
+        # Minimum of the min times from each block to the end, computed on demand
+        self._suffix_min_times = None
+        self._reset_block()
+
+    def __repr__(self):
+        return "<timeindex {} ({} blocks)>".format(self.index_path, len(self.blocks))
+
+    def _reset_block(self):
+        self._block = None
+        self._block_count = 0
+
+    def _make_check(self, first_timestamp):
+        """Get the line that identifies the samples file an index describes"""
+        return "{} {} {!r}\n".format(self.sample_format, self.block_samples, float(first_timestamp)).encode('utf-8')
+
+    def _read_records(self, check):
+        try:
+            with open(self.index_path, 'rb') as f:
+                if f.read(len(self.header)) != self.header or f.readline() != check:
+                    return []
+                data = f.read()
+        except IOError:
+            return []
+        record_size = self.record_struct.size
+        unpack_from = self.record_struct.unpack_from
+        return [unpack_from(data, offset)
+                for offset in range(0, len(data) - len(data) % record_size, record_size)]
+
+    def load(self, sample_count, read_samples, write=True):
+        """Load the index for a samples file containing `sample_count` samples.
+
+        `read_samples(start, count)` should return a Samples object, and is used to index
+        any samples missing from the index file. If `write` is False, the index file is
+        only read, and samples missing from it are indexed in memory.
+
+        """
+        with self.lock:
+            self.close()
+            block_samples = self.block_samples
+            complete = sample_count // block_samples
+            if sample_count:
+                self._first_timestamp = read_samples(0, 1)[0][0]
+                records = self._read_records(self._make_check(self._first_timestamp))[:complete]
+            else:
+                self._first_timestamp = None
+                records = []
+            indexed = len(records) * block_samples
+            self.blocks = []
+            self._max_times = []
+            self._suffix_min_times = None
+            self._reset_block()
+            for record in records:
+                self._add_block(record)
+            if write:
+                # Write the index file afresh, and index samples that were missing from it
+                self._index_file = open(self.index_path, 'wb')
+                self._check_written = False
+                if records:
+                    self._write_check()
+                    self._index_file.write(b''.join(self.record_struct.pack(*record) for record in records))
+            if indexed < sample_count:
+                self.add_samples(read_samples(indexed, sample_count - indexed))
+
+    def _add_block(self, record):
+        self.blocks.append(record)
+        max_time = record[1]
+        if self._max_times and self._max_times[-1] > max_time:
+            max_time = self._max_times[-1]
+        self._max_times.append(max_time)
+        self._suffix_min_times = None
+
+    def _write_check(self):
+        self._index_file.write(self.header)
+        self._index_file.write(self._make_check(self._first_timestamp))
+        self._check_written = True
+
+    def add(self, timestamp, value):
+        """Index the next sample"""
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        block = self._block
+        if block is None:
+            self._block = [timestamp, timestamp, value, value, value]
+        else:
+            if timestamp < block[0]:
+                block[0] = timestamp
+            if timestamp > block[1]:
+                block[1] = timestamp
+            if value < block[2]:
+                block[2] = value
+            if value > block[3]:
+                block[3] = value
+            block[4] += value
+        self._block_count += 1
+        if self._block_count >= self.block_samples:
+            record = tuple(self._block)
+            self._add_block(record)
+            if self._index_file is not None:
+                if not self._check_written:
+                    self._write_check()
+                self._index_file.write(self.record_struct.pack(*record))
+            self._reset_block()
+
+    def add_samples(self, samples):
+        """Index an iterable of (timestamp, value) samples"""
+        add = self.add
+        with self.lock:
+            for timestamp, value in samples:
+                add(timestamp, value)
+
+    def close(self):
+        with self.lock:
+            if self._index_file is not None:
+                self._index_file.close()
+                self._index_file = None
+
+    @property
+    def indexed_samples(self):
+        """Number of samples in complete blocks"""
+        return len(self.blocks) * self.block_samples
+
+    def find_blocks(self, start=None, end=None):
+        """Get a list of the complete blocks that may contain samples in the range start <= t <= end"""
+        with self.lock:
+            first = 0 if start is None else bisect_left(self._max_times, start)
+            if end is None:
+                last = len(self.blocks)
+            else:
+                if self._suffix_min_times is None:
+                    suffix_min_times = []
+                    min_time = None
+                    for record in reversed(self.blocks):
+                        if min_time is None or record[0] < min_time:
+                            min_time = record[0]
+                        suffix_min_times.append(min_time)
+                    suffix_min_times.reverse()
+                    self._suffix_min_times = suffix_min_times
+                # Blocks from here on all have samples after the end of the range
+                last = bisect_right(self._suffix_min_times, end)
+            return [block for block in range(first, last)
+                    if (start is None or self.blocks[block][1] >= start) and
+                       (end is None or self.blocks[block][0] <= end)]
@@ -6,20 +6,39 @@ Creates a database of timestamped events.
 
 """
 
+from dataplicity import atomicwrite
 from dataplicity import constants
-from dataplicity.compat import text_type, itervalues
+from dataplicity import errors
+from dataplicity.compat import text_type, itervalues, scandir
+from dataplicity.jsonrpc import Base64File, Base64Chunks, gzip_compress
+from dataplicity.client import sqlitestore
 
+import os
 import os.path
-from os.path import splitext
+from os.path import splitext, join, getsize, exists
 from time import time
 from random import randint
 from json import dumps, loads
-from operator import itemgetter
-from base64 import b64encode
 from os.path import basename
+from collections import OrderedDict, deque
+from threading import RLock, Thread, Condition
+from contextlib import contextmanager
+from io import BytesIO
+from base64 import b64encode
+import weakref
+import atexit
+import hashlib
+import heapq
+import shutil
+import struct
+import re
+import zlib
 
-from fs.osfs import OSFS
-from fs.errors import FSError
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where only one process should write to a timeline
+    fcntl = None
 
 import logging
 log = logging.getLogger('dataplicity')
@@ -27,6 +46,9 @@ log = logging.getLogger('dataplicity')
 # maps event types to an event class
 _event_registry = {}
 
+# maps storage names on to a timeline class
+_timeline_registry = {}
+
 
 def register_event(event_type):
     """Class decorator to register a new event class"""
@@ -37,6 +59,15 @@ def register_event(event_type):
     return class_deco
 
 
+def register_timeline(storage):
+    """Class decorator to register a timeline storage class"""
+    def class_deco(cls):
+        cls.storage = storage
+        _timeline_registry[storage] = cls
+        return cls
+    return class_deco
+
+
 class TimelineError(Exception):
     pass
 
@@ -53,6 +84,36 @@ class TimelineFullError(TimelineError):
     pass
 
 
+# Events are stored as compact JSON, or as zlib compressed JSON following this tag.
+# Events stored as JSON by earlier versions (which start with '{') load unchanged.
+EVENT_TAG_ZLIB = b'\x00z1'
+
+# Events smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = 256
+
+
+def encode_event(event, compress=False):
+    """Encode an event for storage"""
+    event_json = dumps(event, separators=(',', ':')).encode('utf-8')
+    if compress and len(event_json) >= COMPRESS_MIN_SIZE:
+        compressed = EVENT_TAG_ZLIB + zlib.compress(event_json)
+        if len(compressed) < len(event_json):
+            return compressed
+    return event_json
+
+
+def decode_event(event_bin):
+    """Decode an event stored with `encode_event` (or as JSON)"""
+    if isinstance(event_bin, text_type):
+        event_bin = event_bin.encode('utf-8')
+    event_bin = bytes(event_bin)
+    if event_bin.startswith(EVENT_TAG_ZLIB):
+        event_bin = zlib.decompress(event_bin[len(EVENT_TAG_ZLIB):])
+    elif event_bin.startswith(b'\x00'):
+        raise TimelineError("unknown event encoding")
+    return loads(event_bin.decode('utf-8'))
+
+
 class Event(object):
     """base class for events"""
 
@@ -93,26 +154,39 @@ class Event(object):
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is None:
             self.write()
+        else:
+            # The event won't be written, so its attachments aren't required
+            self.timeline._remove_attachments(self.attachments)
 
     def attach_file(self, filename, name=None, ext=None):
         """Attach a file to this event"""
         if name is None:
             name = filename
         with open(filename, 'rb') as f:
-            data_bin = f.read()
-        return self.attach_bytes(data_bin, filename=filename, name=name)
+            return self.attach_stream(f, filename=filename, name=name, ext=ext)
 
     def attach_bytes(self, data_bin, filename=None, name=None, ext=None):
         """Attach binary data to this event"""
+        blob, sha256 = self.timeline._write_blob(self.event_id, len(self.attachments), data_bin)
+        return self._add_attachment(blob, sha256, filename, name, ext)
+
+    def attach_stream(self, f, filename=None, name=None, ext=None):
+        """Attach the contents of a file object to this event, without reading it all in to memory"""
+        blob, sha256 = self.timeline._copy_blob(self.event_id, len(self.attachments), f)
+        return self._add_attachment(blob, sha256, filename, name, ext)
+
+    def _add_attachment(self, blob, sha256, filename, name, ext):
+        """Add an attachment stored in a blob file"""
         if ext is None and filename is not None:
             ext = splitext(filename)[-1]
-        data_b64 = b64encode(data_bin)
         if filename is not None:
             filename_base = basename(filename)
         else:
             filename_base = None
+        # The data is read from the blob file when the event is synced
         attachment = {
-            "data": data_b64,
+            "blob": blob,
+            "sha256": sha256,
             "encoding": 'base64',
             "name": name or filename_base,
             "filename": filename_base,
@@ -123,6 +197,7 @@ class Event(object):
 
     def write(self):
         """Write the event (called automatically)"""
+        self.timeline._commit_blobs(self.attachments)
         self.timeline._write_event(self.event_id, self)
         return self
 
@@ -158,11 +233,173 @@ class ImageEvent(Event):
                 "attachments": self.attachments}
 
 
+def _unlink_all(paths):
+    """Remove files, ignoring files that don't exist"""
+    remove = os.remove
+    for path in paths:
+        try:
+            remove(path)
+        except OSError:
+            pass
+
+
+# Event writers with a running thread, closed (writing queued events) when the process exits
+_running_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(_running_writers):
+        try:
+            writer.close()
+        except Exception:
+            log.exception('error closing event writer')
+
+
+class EventWriter(object):
+    """Writes events to timeline storage in a background thread.
+
+    Events are queued, so writing an event doesn't wait for storage. When the queue holds
+    `max_queue` events, `policy` decides what happens to another event; 'block' waits
+    for space in the queue, 'drop_new' discards the new event, and 'drop_oldest'
+    discards the oldest queued event.
+
+    Queued events are written when the writer is closed, or when the process exits.
+
+    """
+
+    policies = ('block', 'drop_new', 'drop_oldest')
+
+    def __init__(self, max_queue=1000, policy='block'):
+        if policy not in self.policies:
+            raise ValueError("policy should be one of {}".format(", ".join(self.policies)))
+        self.max_queue = max_queue
+        self.policy = policy
+        self._queue = deque()
+        self._condition = Condition()
+        self._writing = 0
+        self._closed = False
+        self._thread = None
+        # Metrics
+        self.max_depth = 0
+        self.written = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __repr__(self):
+        return "<eventwriter ({} queued)>".format(len(self._queue))
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="event-writer")
+            self._thread.daemon = True
+            self._thread.start()
+            _running_writers.add(self)
+
+    def put(self, timeline, event_id, event, new):
+        """Queue an event to be written, return False if the event was dropped"""
+        dropped = None
+        with self._condition:
+            if self._closed:
+                raise TimelineError("event writer is closed")
+            if len(self._queue) >= self.max_queue:
+                if self.policy == 'drop_new':
+                    dropped = (timeline, event_id, event, new)
+                elif self.policy == 'drop_oldest':
+                    dropped = self._queue.popleft()[:4]
+                else:
+                    while len(self._queue) >= self.max_queue:
+                        self._condition.wait()
+            if dropped is not None:
+                self.dropped += 1
+            queued = dropped is None or self.policy == 'drop_oldest'
+            if queued:
+                self._queue.append((timeline, event_id, event, new, time()))
+                self.max_depth = max(self.max_depth, len(self._queue))
+                self._start()
+                self._condition.notify_all()
+        if dropped is not None:
+            dropped_timeline, dropped_id, dropped_event, dropped_new = dropped
+            dropped_timeline._drop_event(dropped_id, dropped_event, dropped_new)
+        return queued
+
+    def _run(self):
+        condition = self._condition
+        while 1:
+            with condition:
+                while not self._queue and not self._closed:
+                    condition.wait()
+                if not self._queue:
+                    return
+                timeline, event_id, event, _new, queued_time = self._queue.popleft()
+                self._writing += 1
+                condition.notify_all()
+            try:
+                timeline._store_event(event_id, event)
+            except Exception:
+                log.exception("error writing event %s to timeline '%s'", event_id, timeline.name)
+            finally:
+                latency = time() - queued_time
+                with condition:
+                    self._writing -= 1
+                    self.written += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                    condition.notify_all()
+
+    @property
+    def depth(self):
+        """Number of events waiting to be written"""
+        return len(self._queue) + self._writing
+
+    def flush(self):
+        """Wait for queued events to be written"""
+        with self._condition:
+            while self._queue or self._writing:
+                self._condition.wait()
+
+    def close(self):
+        """Write queued events, and stop the writer thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        _running_writers.discard(self)
+
+    def get_stats(self):
+        """Get a dict of metrics"""
+        with self._condition:
+            return {"depth": self.depth,
+                    "max_depth": self.max_depth,
+                    "written": self.written,
+                    "dropped": self.dropped,
+                    "mean_latency": self.total_latency / self.written if self.written else 0.0,
+                    "max_latency": self.max_latency}
+
+
 class TimelineManager(object):
-    """Manages a collection of timelines"""
+    """Manages a collection of timelines
+
+    If `attachment_refs` is True, an attachment the server has acknowledged before (or which
+    was sent earlier in the same request) is sent as its SHA-256 hash, without the data.
+    The hashes of the last `max_synced_blobs` acknowledged attachments are remembered.
 
-    def __init__(self, path):
+    """
+
+    max_synced_blobs = 1000
+
+    def __init__(self, path, sync_events=100, sync_bytes=1024 * 1024, sync_gzip=False, writer=None, attachment_refs=False):
         self.path = path
+        self.sync_events = sync_events
+        self.sync_bytes = sync_bytes
+        self.sync_gzip = sync_gzip
+        self.writer = writer
+        self.attachment_refs = attachment_refs
+        self.synced_blobs_path = os.path.join(path, 'synced_blobs')
+        self._synced_blobs = None
         self.timelines = {}
 
     def __nonzero__(self):
@@ -175,19 +412,131 @@ class TimelineManager(object):
     def init_from_conf(cls, client, conf):
         timelines_path = conf.get('timelines', 'path', constants.TIMELINE_PATH)
         timelines_path = os.path.join(timelines_path, client.device_class)
-        timeline_manager = cls(timelines_path)
+        default_storage = conf.get('timelines', 'storage', 'file')
+        sync_events = conf.get_integer('timelines', 'sync_events', 100)
+        sync_bytes = conf.get_integer('timelines', 'sync_bytes', 1024 * 1024)
+        sync_gzip = conf.get_bool('timelines', 'sync_gzip', False)
+        default_compress = conf.get_bool('timelines', 'compress', False)
+        writer = None
+        if conf.get_bool('timelines', 'write_behind', False):
+            write_policy = conf.get('timelines', 'write_policy', 'block')
+            if write_policy not in EventWriter.policies:
+                raise errors.ConfigError("[timelines]/write_policy should be one of {}".format(", ".join(EventWriter.policies)))
+            writer = EventWriter(max_queue=conf.get_integer('timelines', 'write_queue', 1000),
+                                 policy=write_policy)
+        timeline_manager = cls(timelines_path,
+                               sync_events=sync_events,
+                               sync_bytes=sync_bytes,
+                               sync_gzip=sync_gzip,
+                               writer=writer,
+                               attachment_refs=conf.get_bool('timelines', 'attachment_refs', False))
 
         for section, name in conf.qualified_sections('timeline'):
-            max_events = conf.get(section, 'max_events', None)
-            timeline_manager.new_timeline(name, max_events=max_events)
+            max_events = conf.get_integer(section, 'max_events') if conf.has_setting(section, 'max_events') else None
+            storage = conf.get(section, 'storage', default_storage)
+            if storage not in _timeline_registry:
+                raise errors.ConfigError("[{}]/storage should be one of {}".format(section, ", ".join(sorted(_timeline_registry))))
+            options = {'overwrite_slots': conf.get_bool(section, 'overwrite_slots', True),
+                       'compress': conf.get_bool(section, 'compress', default_compress)}
+            if storage == 'log':
+                options['segment_size'] = conf.get_integer(section, 'segment_size', LogTimeline.default_segment_size)
+            elif storage == 'sqlite':
+                options['database'] = sqlitestore.get_database(client, conf)
+            timeline_manager.new_timeline(name, max_events=max_events, storage=storage, **options)
         return timeline_manager
 
-    def new_timeline(self, name, max_events=None):
+    def new_timeline(self, name, max_events=None, storage='file', **options):
         """Create a new timeline and store it"""
         path = os.path.join(self.path, name)
-        timeline = Timeline(path, name, max_events=max_events)
+        timeline_cls = _timeline_registry[storage]
+        timeline = timeline_cls(path, name, max_events=max_events, **options)
+        timeline.writer = self.writer
         self.timelines[timeline.name] = timeline
 
+    def flush(self):
+        """Wait for queued events to be written"""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def get_write_stats(self):
+        """Get metrics for the event writer, or None if events are written synchronously"""
+        if self.writer is None:
+            return None
+        return self.writer.get_stats()
+
+    def close(self):
+        """Write any events held in memory"""
+        for timeline in self.timelines.values():
+            timeline.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def get_sync_page(self, timeline, cursor=None):
+        """Get the next page of events from a timeline to sync"""
+        return timeline.get_events(cursor=cursor, max_count=self.sync_events, max_bytes=self.sync_bytes)
+
+    def get_sync_params(self, events):
+        """Get the parameters to send a page of events.
+
+        If `sync_gzip` is set, pages without attachments are sent as base64 encoded gzipped
+        JSON. Attachments are streamed from storage, and are typically compressed already.
+
+        """
+        if self.attachment_refs:
+            self._refer_attachments(events)
+        if self.sync_gzip and not any(event.get('attachments') for event in events):
+            events_json = dumps(events, separators=(',', ':')).encode('utf-8')
+            if len(events_json) >= COMPRESS_MIN_SIZE:
+                return {"events": b64encode(gzip_compress(events_json)).decode('ascii'),
+                        "encoding": "gzip"}
+        return {"events": events}
+
+    def _get_synced_blobs(self):
+        """Get an OrderedDict of the hashes of acknowledged attachments"""
+        if self._synced_blobs is None:
+            self._synced_blobs = OrderedDict()
+            try:
+                with open(self.synced_blobs_path, 'rt') as f:
+                    for line in f:
+                        self._synced_blobs[line.strip()] = None
+            except IOError:
+                pass
+        return self._synced_blobs
+
+    def _refer_attachments(self, events):
+        """Replace the data of attachments the server already has with a reference to the hash"""
+        synced_blobs = self._get_synced_blobs()
+        sent = set()
+        for event in events:
+            for attachment in event.get('attachments', []):
+                sha256 = attachment.get('sha256')
+                if sha256 is None:
+                    continue
+                if sha256 in synced_blobs or sha256 in sent:
+                    attachment.pop('data', None)
+                    attachment['encoding'] = 'sha256'
+                else:
+                    sent.add(sha256)
+
+    def clear_synced(self, timeline, events, event_ids):
+        """Clear events the server has acknowledged, and remember the hashes of their attachments"""
+        event_ids = set(event_ids)
+        hashes = [attachment['sha256']
+                  for event in events if event.get('event_id') in event_ids
+                  for attachment in event.get('attachments', []) if attachment.get('sha256')]
+        timeline.clear_events(event_ids)
+        if hashes and self.attachment_refs:
+            synced_blobs = self._get_synced_blobs()
+            for sha256 in hashes:
+                synced_blobs.pop(sha256, None)
+                synced_blobs[sha256] = None
+            while len(synced_blobs) > self.max_synced_blobs:
+                synced_blobs.popitem(last=False)
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with atomicwrite.open(self.synced_blobs_path, 'wt') as f:
+                f.write(''.join('{}\n'.format(sha256) for sha256 in synced_blobs))
+
     def get_timeline(self, timeline_name):
         try:
             timeline = self.timelines[timeline_name]
@@ -197,23 +546,306 @@ class TimelineManager(object):
             return timeline
 
 
+@register_timeline('file')
 class Timeline(object):
-    """A timeline is a sequence of timestamped events."""
+    """A timeline is a sequence of timestamped events.
+
+    Events are stored as a file per event, encoded with `encode_event`. If `compress` is
+    True, larger events are compressed with zlib.
+
+    The ids of stored events are read once, and kept up to date as events are written and
+    cleared, so the number of events can be checked against `max_events` without touching disk.
+    The timestamp of each event is also kept, once the event has been read or written, so a
+    page of events may be selected without reading every stored event.
+
+    If `overwrite_slots` is True, overwrite events (without attachments) are held in memory
+    and only the latest value for each event id is written, when events are read for a sync
+    or the timeline is closed. An event with the same content as the last event written
+    to the slot (ignoring the timestamp) is skipped.
+
+    If `writer` is set to an `EventWriter`, other events are queued and written in the
+    background.
+
+    """
 
-    def __init__(self, path, name, max_events=None):
+    blob_chunk_size = 64 * 1024
+    # Blobs are staged under this extension until their event is written
+    staged_blob_ext = '.new'
+    # Staged blobs older than this (in seconds) are from events that were never written
+    stale_blob_age = 60 * 60
+    writer = None
+
+    def __init__(self, path, name, max_events=None, overwrite_slots=False, compress=False):
         self.path = path
         self.name = name
-        self.fs = OSFS(path, create=True)
         self.max_events = max_events
+        self.overwrite_slots = overwrite_slots
+        self.compress = compress
+        self.blobs_path = join(path, 'blobs')
+        # Attachment content, named by SHA-256, which blobs are hard links to
+        self.content_path = join(path, 'content')
+        self.lock = RLock()
+        # Maps event id on to the latest overwrite event, and a hash of its content
+        self._slots = OrderedDict()
+        self._slot_hashes = {}
+        # Maps event id on to timestamp, for events that have been read or written
+        self._timestamps = {}
+        # Maps blob name on to the SHA-256 of its content, for blobs that have been read or written
+        self._blob_hashes = {}
+        self.init_storage()
+        self._event_ids = self._read_event_ids()
+        self._remove_stale_blobs()
+
+    def init_storage(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Created by another thread or process
+                pass
+
+    def _list_event_files(self):
+        """Get a list of event filenames"""
+        try:
+            if scandir is not None:
+                return [entry.name for entry in scandir(self.path) if entry.name.endswith('.json')]
+            return [filename for filename in os.listdir(self.path) if filename.endswith('.json')]
+        except OSError:
+            return []
+
+    def _read_event_ids(self):
+        """Get a set of the ids of stored events"""
+        return set(filename[:-5] for filename in self._list_event_files())
 
     def __repr__(self):
-        return "Timeline({!r}, {!r}, max_events={!r})".format(self.path, self.name, self.max_events)
+        return "{}({!r}, {!r}, max_events={!r})".format(type(self).__name__, self.path, self.name, self.max_events)
+
+    def count_events(self):
+        """Get the number of stored events"""
+        return len(self._event_ids)
+
+    def _blob_path(self, blob):
+        return join(self.blobs_path, blob)
+
+    def _open_blob(self, event_id, index):
+        """Open a new blob file for an attachment, return the blob name and file"""
+        if not os.path.isdir(self.blobs_path):
+            try:
+                os.makedirs(self.blobs_path)
+            except OSError:
+                # Created by another thread or process
+                pass
+        blob = self._staged_blob_name(event_id, index)
+        return blob, open(self._blob_path(blob), 'wb')
+
+    def _staged_blob_name(self, event_id, index):
+        return "{}.{}{}".format(event_id, index, self.staged_blob_ext)
+
+    def _commit_blob(self, blob):
+        """Give a staged blob its final name, and return the name"""
+        committed = blob[:-len(self.staged_blob_ext)]
+        try:
+            os.rename(self._blob_path(blob), self._blob_path(committed))
+        except OSError:
+            log.warning("attachment '%s' is missing", blob)
+        sha256 = self._blob_hashes.pop(blob, None)
+        if sha256 is not None:
+            self._blob_hashes[committed] = sha256
+        return committed
+
+    def _commit_blobs(self, attachments):
+        """Commit the staged blobs for the attachments of an event that is being written"""
+        for attachment in attachments:
+            blob = attachment.get('blob')
+            if blob is not None and blob.endswith(self.staged_blob_ext):
+                attachment['blob'] = self._commit_blob(blob)
+
+    def _remove_stale_blobs(self):
+        """Remove staged blobs left by events that were never written"""
+        try:
+            blobs = os.listdir(self.blobs_path)
+        except OSError:
+            return
+        expires = time() - self.stale_blob_age
+        for blob in blobs:
+            if not blob.endswith(self.staged_blob_ext):
+                continue
+            try:
+                stale = os.path.getmtime(self._blob_path(blob)) < expires
+            except OSError:
+                continue
+            if stale:
+                log.debug("removing attachment '%s' from an event that wasn't written", blob)
+                self._remove_blob(blob)
+
+    def _content_file_path(self, sha256):
+        return join(self.content_path, sha256)
+
+    def _link_content(self, blob, sha256):
+        """Make a blob a link to stored content with the same hash, return False if there is no such content"""
+        content_path = self._content_file_path(sha256)
+        if not exists(content_path):
+            return False
+        blob_path = self._blob_path(blob)
+        temp_path = blob_path + '.link'
+        try:
+            os.link(content_path, temp_path)
+            os.rename(temp_path, blob_path)
+        except (OSError, AttributeError):
+            # Removed by another thread, or the filesystem doesn't support hard links
+            return False
+        return True
+
+    def _store_content(self, blob, sha256):
+        """Store a blob as content, so blobs with the same hash may link to it"""
+        if not os.path.isdir(self.content_path):
+            try:
+                os.makedirs(self.content_path)
+            except OSError:
+                pass
+        try:
+            os.link(self._blob_path(blob), self._content_file_path(sha256))
+        except (OSError, AttributeError):
+            # The blob isn't shared
+            pass
+
+    def _write_blob(self, event_id, index, data):
+        """Store attachment data in a blob file, and return the blob name and SHA-256 of the data.
+
+        If an identical blob is stored, the new blob is a hard link to it rather than a copy.
+
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        blob = self._staged_blob_name(event_id, index)
+        if not self._link_content(blob, sha256):
+            blob, f = self._open_blob(event_id, index)
+            with f:
+                f.write(data)
+            self._store_content(blob, sha256)
+        self._set_blob_hash(blob, sha256)
+        return blob, sha256
+
+    def _copy_blob(self, event_id, index, src_file):
+        """Copy a file object to a blob file, and return the blob name and SHA-256 of the data"""
+        blob, f = self._open_blob(event_id, index)
+        content_hash = hashlib.sha256()
+        with f:
+            while 1:
+                chunk = src_file.read(self.blob_chunk_size)
+                if not chunk:
+                    break
+                content_hash.update(chunk)
+                f.write(chunk)
+        sha256 = content_hash.hexdigest()
+        if not self._link_content(blob, sha256):
+            self._store_content(blob, sha256)
+        self._set_blob_hash(blob, sha256)
+        return blob, sha256
+
+    def _set_blob_hash(self, blob, sha256):
+        """Remember the hash of a blob, so its content may be found when it is removed"""
+        self._blob_hashes[blob] = sha256
+
+    def _hash_blob(self, blob):
+        """Get the SHA-256 of the data in a blob file"""
+        content_hash = hashlib.sha256()
+        with open(self._blob_path(blob), 'rb') as f:
+            while 1:
+                chunk = f.read(self.blob_chunk_size)
+                if not chunk:
+                    break
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def _unlink_blob(self, blob):
+        """Remove a blob file, return the SHA-256 of its content if it was the last link to stored content"""
+        blob_path = self._blob_path(blob)
+        sha256 = self._blob_hashes.pop(blob, None)
+        try:
+            links = os.stat(blob_path).st_nlink
+            if links == 2 and sha256 is None:
+                # The hash is read from the event when it is synced, so this is rare
+                sha256 = self._hash_blob(blob)
+            os.remove(blob_path)
+        except OSError:
+            return None
+        return sha256 if links == 2 else None
+
+    def _collect_content(self, hashes):
+        """Remove stored content with the given hashes, if no blob links to it"""
+        for sha256 in hashes:
+            path = self._content_file_path(sha256)
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _remove_blob(self, blob):
+        sha256 = self._unlink_blob(blob)
+        if sha256 is not None:
+            self._collect_content([sha256])
+
+    def _remove_attachments(self, attachments):
+        """Remove the blobs for a list of attachments"""
+        for attachment in attachments:
+            if 'blob' in attachment:
+                self._remove_blob(attachment['blob'])
+
+    def _remove_blobs(self, event_ids):
+        """Remove the attachment blobs for events"""
+        # Scan the blobs directory once, rather than checking for blobs for every event
+        try:
+            if scandir is not None:
+                blobs = [entry.name for entry in scandir(self.blobs_path)]
+            else:
+                blobs = os.listdir(self.blobs_path)
+        except OSError:
+            return
+        event_ids = set(event_ids)
+        hashes = []
+        for blob in blobs:
+            if blob.rpartition('.')[0] in event_ids:
+                sha256 = self._unlink_blob(blob)
+                if sha256 is not None:
+                    hashes.append(sha256)
+        self._collect_content(hashes)
+
+    def _get_blob_size(self, blob):
+        """Get the size of a blob, or None if it doesn't exist"""
+        try:
+            return getsize(self._blob_path(blob))
+        except OSError:
+            return None
+
+    def _get_blob_data(self, blob):
+        """Get a StreamedValue for the contents of a blob, or None if it doesn't exist"""
+        try:
+            return Base64File(self._blob_path(blob))
+        except OSError:
+            return None
+
+    def _stream_attachments(self, event):
+        """Replace blob references in an event with data that is streamed from the blob file"""
+        attachments = []
+        for attachment in event.get('attachments', []):
+            blob = attachment.pop('blob', None)
+            if blob is not None:
+                if attachment.get('sha256'):
+                    self._set_blob_hash(blob, attachment['sha256'])
+                attachment['data'] = self._get_blob_data(blob)
+                if attachment['data'] is None:
+                    log.warning("attachment '%s' is missing from event %s", blob, event.get('event_id'))
+                    continue
+            attachments.append(attachment)
+        event['attachments'] = attachments
+        return event
 
     def new_event(self, event_type, timestamp=None, *args, **kwargs):
         """Create and return an event, to be used as a context manager"""
         if self.max_events is not None:
-            size = len(self.fs.listdir(wildcard="*.json"))
-            if size >= self.max_events:
+            # Writing an event with an existing id replaces it, so doesn't add to the count
+            if len(self._event_ids) >= self.max_events and kwargs.get('event_id') not in self._event_ids:
                 raise TimelineFullError("The timeline has reached its maximum size")
 
         if timestamp is None:
@@ -234,57 +866,616 @@ class Timeline(object):
         """Create a new photo object"""
         event = self.new_event('IMAGE', **kwargs)
 
-        if hasattr(file, 'getvalue'):
-            bytes = file.getvalue()
+        if hasattr(file, 'getbuffer'):
+            # Avoid a copy of an in-memory file
+            event.attach_bytes(file.getbuffer(), name='photo', filename=filename, ext=ext)
+        elif hasattr(file, 'getvalue'):
+            event.attach_bytes(file.getvalue(), name='photo', filename=filename, ext=ext)
+        elif isinstance(file, text_type):
+            with open(file, 'rb') as f:
+                event.attach_stream(f, name='photo', filename=filename, ext=ext)
         elif file is not None:
-            if isinstance(file, text_type):
-                with open(file, 'rb') as f:
-                    bytes = f.read()
-            else:
-                bytes = file.read()
+            event.attach_stream(file, name='photo', filename=filename, ext=ext)
         else:
-            if bytes is None:
-                raise ValueError("A value for 'file' or 'bytes' is required")
-        event.attach_bytes(bytes, name='photo', filename=filename, ext=ext)
+            raise ValueError("A value for 'file' is required")
+        return event
+
+    @classmethod
+    def get_cursor(cls, event):
+        """Get the cursor for an event, events are returned in cursor order"""
+        return [event['timestamp'], event['event_id']]
+
+    def get_events(self, sort=True, cursor=None, max_count=None, max_bytes=None):
+        """Get accumulated events.
+
+        If `cursor` is given, only events after the cursor (as returned by `get_cursor`) are returned.
+        If `max_count` or `max_bytes` is given, events are returned in timestamp order up to
+        that many events, or approximately that many bytes of JSON. At least one event is
+        returned, if there are any after the cursor.
+
+        Attachment data is a `Base64File`, which is read from disk as the sync request is sent.
+
+        """
+        self.flush_slots()
+        if self.writer is not None:
+            self.writer.flush()
+        get_cursor = self.get_cursor
+        events = self._iter_stored_events(cursor=cursor, max_count=max_count)
+        if cursor is not None:
+            cursor = list(cursor)
+            events = (event for event in events if get_cursor(event) > cursor)
+        if max_count is not None:
+            # Only keep max_count events in memory
+            events = heapq.nsmallest(max_count, events, key=get_cursor)
+        elif sort or max_bytes is not None:
+            events = sorted(events, key=get_cursor)
+        else:
+            events = list(events)
+        if max_bytes is not None:
+            page_bytes = 0
+            for count, event in enumerate(events):
+                page_bytes += self._get_event_size(event)
+                if count and page_bytes > max_bytes:
+                    del events[count:]
+                    break
+        return [self._stream_attachments(event) for event in events]
+
+    def _iter_stored_events(self, cursor=None, max_count=None):
+        """Yield the stored events.
+
+        Storage may use `cursor` and `max_count` to skip events that won't be returned
+        from `get_events`.
+
+        """
+        event_filenames = self._list_event_files()
+        # Events may have been written or cleared by another process
+        event_ids = [filename[:-5] for filename in event_filenames]
+        self._event_ids = set(event_ids)
+        if max_count is None:
+            for event_id in event_ids:
+                event = self._read_event(event_id)
+                if event is not None:
+                    yield event
+            return
+        with self.lock:
+            timestamps = self._timestamps
+            for event_id in [event_id for event_id in timestamps if event_id not in self._event_ids]:
+                del timestamps[event_id]
+            unread = [event_id for event_id in event_ids if event_id not in timestamps]
+        # Events written by another process are read once to get their timestamp
+        for event_id in unread:
+            self._read_event(event_id)
+        with self.lock:
+            keys = [(timestamp, event_id) for event_id, timestamp in self._timestamps.items()]
+        if cursor is not None:
+            cursor = tuple(cursor)
+            keys = [key for key in keys if key > cursor]
+        for _timestamp, event_id in heapq.nsmallest(max_count, keys):
+            event = self._read_event(event_id)
+            if event is not None:
+                yield event
+
+    def _read_event(self, event_id):
+        """Read and decode a stored event, or return None if it doesn't exist"""
+        try:
+            with open(join(self.path, "{}.json".format(event_id)), 'rb') as f:
+                event_bin = f.read()
+        except IOError:
+            # Cleared by another process
+            return None
+        event = decode_event(event_bin)
+        with self.lock:
+            self._timestamps[event_id] = event['timestamp']
         return event
 
-    def get_events(self, sort=True):
-        """Get all accumulated events"""
-        events = []
-        for event_filename in self.fs.listdir(wildcard="*.json"):
-            with self.fs.open(event_filename, 'rb') as f:
-                event = loads(f.read().decode('utf-8'))
-                events.append(event)
-        if sort:
-            # sort by timestamp
-            events.sort(key=itemgetter('timestamp'))
-        return events
+    def _get_event_size(self, event):
+        """Get the approximate size of an event (including attachments) when encoded"""
+        size = len(dumps(event, separators=(',', ':')))
+        for attachment in event.get('attachments', []):
+            if 'blob' in attachment:
+                size += (self._get_blob_size(attachment['blob']) or 0) * 4 // 3
+        return size
 
     def clear_all(self):
         """Clear all stored events"""
-        for filename in self.fs.listdir(wildcard="*.json"):
-            try:
-                self.fs.remove(filename)
-            except FSError:
-                pass
+        _unlink_all(join(self.path, filename) for filename in self._list_event_files())
+        self._event_ids.clear()
+        with self.lock:
+            self._timestamps.clear()
+        self._clear_slots()
+        self._blob_hashes.clear()
+        shutil.rmtree(self.blobs_path, ignore_errors=True)
+        shutil.rmtree(self.content_path, ignore_errors=True)
 
     def clear_events(self, event_ids):
         """Clear any events that have been processed"""
-        for event_id in event_ids:
-            filename = "{}.json".format(event_id)
-            try:
-                self.fs.remove(filename)
-            except FSError:
-                pass
+        event_ids = list(event_ids)
+        path = self.path
+        _unlink_all(join(path, "{}.json".format(event_id)) for event_id in event_ids)
+        self._event_ids.difference_update(event_ids)
+        with self.lock:
+            for event_id in event_ids:
+                self._timestamps.pop(event_id, None)
+        self._remove_blobs(event_ids)
 
     def _write_event(self, event_id, event):
         if hasattr(event, 'to_data'):
             event = event.to_data()
         event['event_id'] = event_id
-        event_json = dumps(event, indent=4).encode('utf-8')
-        filename = "{}.json".format(event_id)
-        with self.fs.open(filename, 'wb') as f:
-            f.write(event_json)
+        if self.overwrite_slots and event.get('overwrite', False) and not event.get('attachments'):
+            self._hold_event(event_id, event)
+        elif self.writer is not None:
+            self._queue_event(event_id, event)
+        else:
+            self._store_event(event_id, event)
+
+    def _queue_event(self, event_id, event):
+        """Queue an event to be written in the background"""
+        with self.lock:
+            new = event_id not in self._event_ids
+            # Counted now, so max_events includes queued events
+            self._event_ids.add(event_id)
+        self.writer.put(self, event_id, event, new)
+
+    def _drop_event(self, event_id, event, new):
+        """Discard a queued event that won't be written"""
+        log.warning("event queue is full, dropped event %s from timeline '%s'", event_id, self.name)
+        self._remove_attachments(event.get('attachments', []))
+        if new:
+            with self.lock:
+                self._event_ids.discard(event_id)
+
+    def _hold_event(self, event_id, event):
+        """Hold an overwrite event in memory, unless it is the same as the last event in the slot"""
+        content = event.copy()
+        content.pop('timestamp', None)
+        content_hash = hashlib.sha1(dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+        with self.lock:
+            if self._slot_hashes.get(event_id) == content_hash:
+                return
+            self._slot_hashes[event_id] = content_hash
+            self._slots[event_id] = event
+            self._event_ids.add(event_id)
+
+    def _clear_slots(self):
+        with self.lock:
+            self._slots.clear()
+            self._slot_hashes.clear()
+
+    def flush_slots(self):
+        """Write overwrite events held in memory"""
+        with self.lock:
+            slots = list(self._slots.items())
+            self._slots.clear()
+            for event_id, event in slots:
+                self._store_event(event_id, event)
+
+    def close(self):
+        """Write any events held in memory"""
+        self.flush_slots()
+
+    def _store_event(self, event_id, event):
+        """Write event data to storage"""
+        with open(join(self.path, "{}.json".format(event_id)), 'wb') as f:
+            f.write(encode_event(event, compress=self.compress))
+        with self.lock:
+            self._timestamps[event_id] = event['timestamp']
+        self._event_ids.add(event_id)
+
+
+@register_timeline('log')
+class LogTimeline(Timeline):
+    """Stores events as length prefixed records appended to rolling segment files.
+
+    Clearing events appends a tombstone record, and when enough of the stored records
+    are dead, the segments are compacted in a background thread. Segments are replayed
+    in order, so a later record for an event id replaces an earlier one.
+
+    Records are appended by opening the segment for each write, with a shared lock (where
+    fcntl is available) so that other processes may write to the timeline. Compaction
+    takes an exclusive lock.
+
+    Live events are indexed by timestamp and position in the segments. The index is kept
+    up to date by replaying only the records appended since it was last read, so a page
+    of events is read without decoding (or holding in memory) every stored event.
+
+    """
+
+    default_segment_size = 1024 * 1024
+    record_header_struct = struct.Struct(b'<IB')
+    RECORD_EVENT = 0
+    RECORD_TOMBSTONE = 1
+    # Compact when there are at least this many dead records, and more dead than live
+    compact_threshold = 100
+
+    def __init__(self, path, name, max_events=None, overwrite_slots=False, compress=False, segment_size=None):
+        self.segment_size = segment_size or self.default_segment_size
+        super(LogTimeline, self).__init__(path, name,
+                                          max_events=max_events,
+                                          overwrite_slots=overwrite_slots,
+                                          compress=compress)
+
+    def init_storage(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._lock_file = open(join(self.path, '.lock'), 'ab')
+        self._compact_thread = None
+        segments = self._list_segments()
+        self._segment = segments[-1] if segments else 1
+        self._dead = 0
+        self._reset_index()
+
+    def _reset_index(self):
+        # Maps event id on to (timestamp, segment, offset, length) of its latest record
+        self._offsets = OrderedDict()
+        # Maps segment on to (inode, position replayed up to)
+        self._positions = {}
+        self._records = 0
+
+    def _read_event_ids(self):
+        with self._locked():
+            self._update_index()
+        return set(self._offsets)
+
+    def _segment_path(self, segment):
+        return join(self.path, "segment_{:06d}.log".format(segment))
+
+    def _list_segments(self):
+        """Get a sorted list of segment numbers"""
+        segments = []
+        for filename in os.listdir(self.path):
+            match = re.match(r'^segment_(\d+)\.log$', filename)
+            if match is not None:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        """Lock the timeline for this process and (if possible) other processes"""
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _make_record(self, record_type, payload):
+        return self.record_header_struct.pack(len(payload), record_type) + payload
+
+    def _append(self, data):
+        """Append records to the active segment"""
+        with self._locked():
+            fd = os.open(self._segment_path(self._segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if size >= self.segment_size:
+                self._segment += 1
+
+    def _iter_records(self, segment, start=0):
+        """Yield (record type, offset, payload) from a segment, starting at offset `start`,
+        and ignoring an incomplete record at the end"""
+        try:
+            with open(self._segment_path(segment), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+        except IOError:
+            return
+        header_size = self.record_header_struct.size
+        unpack_from = self.record_header_struct.unpack_from
+        pos = 0
+        while pos + header_size <= len(data):
+            length, record_type = unpack_from(data, pos)
+            if pos + header_size + length > len(data):
+                break
+            yield record_type, start + pos, data[pos + header_size:pos + header_size + length]
+            pos += header_size + length
+
+    def _update_index(self):
+        """Replay records appended since the index was last updated (call with the lock held)"""
+        segments = self._list_segments()
+        positions = self._positions
+        stats = {}
+        for segment in segments:
+            try:
+                stats[segment] = os.stat(self._segment_path(segment))
+            except OSError:
+                pass
+        for segment, (inode, position) in positions.items():
+            stat = stats.get(segment)
+            if stat is None or stat.st_ino != inode or stat.st_size < position:
+                # Compacted or cleared by another process
+                self._reset_index()
+                positions = self._positions
+                break
+        offsets = self._offsets
+        header_size = self.record_header_struct.size
+        for segment in segments:
+            if segment not in stats:
+                continue
+            inode, position = positions.get(segment, (stats[segment].st_ino, 0))
+            if position >= stats[segment].st_size:
+                continue
+            for record_type, offset, payload in self._iter_records(segment, position):
+                self._records += 1
+                position = offset + header_size + len(payload)
+                if record_type == self.RECORD_EVENT:
+                    event = decode_event(payload)
+                    event_id = event['event_id']
+                    offsets.pop(event_id, None)
+                    offsets[event_id] = (event['timestamp'], segment, offset + header_size, len(payload))
+                elif record_type == self.RECORD_TOMBSTONE:
+                    for event_id in loads(payload.decode('utf-8')):
+                        offsets.pop(event_id, None)
+            positions[segment] = (inode, position)
+        self._dead = self._records - len(offsets)
+        self._event_ids = set(offsets)
+
+    def _read_records(self, locations):
+        """Read event records from a list of (segment, offset, length)"""
+        payloads = []
+        files = {}
+        try:
+            for segment, offset, length in locations:
+                if segment not in files:
+                    files[segment] = open(self._segment_path(segment), 'rb')
+                f = files[segment]
+                f.seek(offset)
+                payloads.append(f.read(length))
+        finally:
+            for f in files.values():
+                f.close()
+        return payloads
+
+    def _iter_stored_events(self, cursor=None, max_count=None):
+        with self._locked():
+            self._update_index()
+            keys = [(timestamp, event_id, segment, offset, length)
+                    for event_id, (timestamp, segment, offset, length) in self._offsets.items()]
+            if cursor is not None:
+                cursor = tuple(cursor)
+                keys = [key for key in keys if key[:2] > cursor]
+            if max_count is not None:
+                keys = heapq.nsmallest(max_count, keys)
+            payloads = self._read_records([key[2:] for key in keys])
+        for payload in payloads:
+            yield decode_event(payload)
+
+    def clear_all(self):
+        with self._locked(exclusive=True):
+            for segment in self._list_segments():
+                try:
+                    os.remove(self._segment_path(segment))
+                except OSError:
+                    pass
+            self._segment += 1
+            self._event_ids.clear()
+            self._clear_slots()
+            self._reset_index()
+            self._dead = 0
+            self._blob_hashes.clear()
+            shutil.rmtree(self.blobs_path, ignore_errors=True)
+            shutil.rmtree(self.content_path, ignore_errors=True)
+
+    def clear_events(self, event_ids):
+        event_ids = list(event_ids)
+        if not event_ids:
+            return
+        self._append(self._make_record(self.RECORD_TOMBSTONE, dumps(event_ids).encode('utf-8')))
+        self._remove_blobs(event_ids)
+        with self.lock:
+            self._dead += len(event_ids) + 1
+            self._event_ids.difference_update(event_ids)
+            if self._dead >= self.compact_threshold and self._dead > len(self._event_ids):
+                self.start_compact()
+
+    def _store_event(self, event_id, event):
+        with self.lock:
+            self._append(self._make_record(self.RECORD_EVENT, encode_event(event, compress=self.compress)))
+            if event_id in self._event_ids:
+                # Replaces an existing event
+                self._dead += 1
+            self._event_ids.add(event_id)
+
+    def start_compact(self):
+        """Compact segments in a background thread, if compaction isn't already running"""
+        with self.lock:
+            if self._compact_thread is not None and self._compact_thread.is_alive():
+                return
+            self._compact_thread = Thread(target=self._run_compact, name="compact-{}".format(self.name))
+            self._compact_thread.daemon = True
+            self._compact_thread.start()
+
+    def _run_compact(self):
+        try:
+            self.compact()
+        except Exception:
+            log.exception('error compacting timeline %s', self.name)
+
+    def compact(self):
+        """Rewrite live events to the first segment, and remove the other segments.
+
+        Writes to a segment number after the compacted segments will be replayed after the
+        compacted events, so the order of records is preserved.
+
+        """
+        with self._locked(exclusive=True):
+            segments = self._list_segments()
+            if not segments:
+                return
+            self._update_index()
+            events = list(self._offsets.items())
+            payloads = self._read_records([location[1:] for _event_id, location in events])
+            first_path = self._segment_path(segments[0])
+            header_size = self.record_header_struct.size
+            offsets = OrderedDict()
+            if events:
+                compact_path = first_path + '.compact'
+                offset = 0
+                with open(compact_path, 'wb') as f:
+                    for (event_id, location), payload in zip(events, payloads):
+                        f.write(self._make_record(self.RECORD_EVENT, payload))
+                        offsets[event_id] = (location[0], segments[0], offset + header_size, len(payload))
+                        offset += header_size + len(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(compact_path, first_path)
+                removed = segments[1:]
+            else:
+                removed = segments
+            for segment in removed:
+                try:
+                    os.remove(self._segment_path(segment))
+                except OSError:
+                    pass
+            self._reset_index()
+            if events:
+                self._offsets = offsets
+                self._positions[segments[0]] = (os.stat(first_path).st_ino, offset)
+                self._records = len(offsets)
+            self._event_ids = set(offsets)
+            self._dead = 0
+            log.debug('compacted timeline %s (%s events)', self.name, len(events))
+
+
+@register_timeline('sqlite')
+class SQLiteTimeline(Timeline):
+    """Stores events and attachments in an SQLite database shared with other timelines
+    and samplers (see dataplicity.client.sqlitestore).
+
+    Attachments are stored in chunks, so they may be written and synced without reading
+    the whole attachment in to memory. Identical attachments aren't shared in the database,
+    but are still sent by hash when `attachment_refs` is enabled.
+
+    """
+
+    def __init__(self, path, name, max_events=None, overwrite_slots=False, compress=False, database=None):
+        if database is None:
+            raise TimelineError("sqlite storage requires a database")
+        self.database = database
+        super(SQLiteTimeline, self).__init__(path, name,
+                                             max_events=max_events,
+                                             overwrite_slots=overwrite_slots,
+                                             compress=compress)
+
+    def init_storage(self):
+        pass
+
+    def _read_event_ids(self):
+        return set(row[0] for row in self.database.query("SELECT event_id FROM events WHERE timeline=?", (self.name,)))
+
+    def _store_event(self, event_id, event):
+        self.database.execute("INSERT OR REPLACE INTO events (timeline, event_id, timestamp, data) VALUES (?, ?, ?, ?)",
+                              (self.name, event_id, event['timestamp'],
+                               sqlitestore.binary(encode_event(event, compress=self.compress))))
+        self._event_ids.add(event_id)
+
+    def _iter_stored_events(self, cursor=None, max_count=None):
+        if cursor is None:
+            timestamp, event_id = None, ''
+        else:
+            timestamp, event_id = cursor
+        rows = self.database.query("SELECT data FROM events WHERE timeline=? "
+                                   "AND (? IS NULL OR timestamp>? OR (timestamp=? AND event_id>?)) "
+                                   "ORDER BY timestamp, event_id LIMIT ?",
+                                   (self.name, timestamp, timestamp, timestamp, event_id,
+                                    -1 if max_count is None else max_count))
+        for row in rows:
+            yield decode_event(row[0])
+
+    def clear_all(self):
+        with self.database.transaction() as cursor:
+            cursor.execute("DELETE FROM events WHERE timeline=?", (self.name,))
+            cursor.execute("DELETE FROM attachments WHERE timeline=?", (self.name,))
+        self._event_ids.clear()
+        self._clear_slots()
+
+    def clear_events(self, event_ids):
+        event_ids = list(event_ids)
+        with self.database.transaction() as cursor:
+            for event_id in event_ids:
+                cursor.execute("DELETE FROM events WHERE timeline=? AND event_id=?", (self.name, event_id))
+                # Blob names start with the event id
+                cursor.execute("DELETE FROM attachments WHERE timeline=? AND substr(blob, 1, ?)=?",
+                               (self.name, len(event_id) + 1, event_id + '.'))
+        self._event_ids.difference_update(event_ids)
+
+    def _write_blob(self, event_id, index, data):
+        return self._copy_blob(event_id, index, BytesIO(data))
+
+    def _copy_blob(self, event_id, index, src_file):
+        blob = self._staged_blob_name(event_id, index)
+        # Chunks are a multiple of 3 bytes, so they may be base64 encoded separately
+        chunk_size = Base64Chunks.chunk_size
+        content_hash = hashlib.sha256()
+        with self.database.transaction() as cursor:
+            cursor.execute("DELETE FROM attachments WHERE timeline=? AND blob=?", (self.name, blob))
+            chunk_index = 0
+            while 1:
+                chunk = src_file.read(chunk_size)
+                # Fill the chunk, in case of a short read
+                while chunk and len(chunk) < chunk_size:
+                    more = src_file.read(chunk_size - len(chunk))
+                    if not more:
+                        break
+                    chunk += more
+                if not chunk:
+                    break
+                content_hash.update(chunk)
+                cursor.execute("INSERT INTO attachments (timeline, blob, chunk, data) VALUES (?, ?, ?, ?)",
+                               (self.name, blob, chunk_index, sqlitestore.binary(chunk)))
+                chunk_index += 1
+        return blob, content_hash.hexdigest()
+
+    def _commit_blob(self, blob):
+        committed = blob[:-len(self.staged_blob_ext)]
+        with self.database.transaction() as cursor:
+            cursor.execute("DELETE FROM attachments WHERE timeline=? AND blob=?", (self.name, committed))
+            cursor.execute("UPDATE attachments SET blob=? WHERE timeline=? AND blob=?", (committed, self.name, blob))
+        return committed
+
+    def _set_blob_hash(self, blob, sha256):
+        # Content isn't shared, so there's nothing to find when a blob is removed
+        pass
+
+    def _remove_stale_blobs(self):
+        # Attachment rows have no modification time, staged attachments are removed by clear_all
+        pass
+
+    def _remove_blob(self, blob):
+        self.database.execute("DELETE FROM attachments WHERE timeline=? AND blob=?", (self.name, blob))
+
+    def _remove_blobs(self, event_ids):
+        with self.database.transaction() as cursor:
+            for event_id in event_ids:
+                cursor.execute("DELETE FROM attachments WHERE timeline=? AND substr(blob, 1, ?)=?",
+                               (self.name, len(event_id) + 1, event_id + '.'))
+
+    def _get_blob_size(self, blob):
+        return self.database.query_value("SELECT SUM(LENGTH(data)) FROM attachments WHERE timeline=? AND blob=?",
+                                         (self.name, blob))
+
+    def _get_blob_data(self, blob):
+        size = self._get_blob_size(blob)
+        if size is None:
+            return None
+        database = self.database
+        timeline = self.name
+
+        def iter_chunks():
+            chunk_index = 0
+            while 1:
+                chunk = database.query_value("SELECT data FROM attachments WHERE timeline=? AND blob=? AND chunk=?",
+                                             (timeline, blob, chunk_index))
+                if chunk is None:
+                    break
+                yield bytes(chunk)
+                chunk_index += 1
+        return Base64Chunks(size, iter_chunks)
 
 
 if __name__ == "__main__":
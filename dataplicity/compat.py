@@ -54,12 +54,22 @@ if PY2:
     from urlparse import urlparse, parse_qs, urlunparse
     from urllib import urlencode, quote
     from itertools import izip_longest as zip_longest
-    from urllib2 import urlopen, HTTPError
+    from urllib2 import urlopen, Request, HTTPError
+    from urllib import getproxies
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException, BadStatusLine
 else:
     from urllib.parse import urlparse, parse_qs, urlunparse
     from urllib.parse import urlencode, quote
     from itertools import zip_longest
-    from urllib.request import urlopen, HTTPError
+    from urllib.request import urlopen, Request, HTTPError, getproxies
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException, BadStatusLine
+
+
+# os.scandir is new in Python 3.5
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
 
 
 # pickle is the C version on PY3
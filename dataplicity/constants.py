@@ -7,5 +7,6 @@ CONF_PATH = "/etc/dataplicity/dataplicity.conf"
 SETTINGS_PATH = "/var/dataplicity/"
 FIRMWARE_PATH = "/srv/dataplicity/fw/"
 TIMELINE_PATH = "/tmp/dataplicitytimeline/"
+SQLITE_PATH = "/tmp/dataplicity/db/"
 PID_PATH = "/var/run/dataplicity.pid"
 M2M_URL = "wss://m2m.dataplicity.com/m2m/"
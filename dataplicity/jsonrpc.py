@@ -1,9 +1,33 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
-from dataplicity.compat import urlopen
-
+from dataplicity.compat import (urlopen, Request, HTTPError, urlparse, getproxies,
+                                HTTPConnection, HTTPSConnection, HTTPException, BadStatusLine)
+
+from base64 import b64encode
+from io import BytesIO
+from os.path import getsize
+from random import randint
+from threading import Lock
+from time import time
+import tempfile
+import socket
+import sys
 import json
+import zlib
+import re
+
+import logging
+log = logging.getLogger('dataplicity')
+
+# http.client can send chunked request bodies from Python 3.6
+CHUNKED_SUPPORTED = sys.version_info >= (3, 6)
+
+
+def gzip_compress(data, level=6):
+    """Compress bytes in gzip format"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
 class ProtocolError(Exception):
@@ -44,6 +68,322 @@ class ErrorCode(object):
               -32603: "Internal error"}
 
 
+class StreamedValue(object):
+    """Base class for values that are encoded in to the request body as it is sent,
+    rather than held in memory.
+
+    Subclasses should implement `iter_json`, and `json_size` if the size is known before
+    encoding.
+
+    """
+
+    @property
+    def json_size(self):
+        """Size of the encoded JSON in bytes, or None if it isn't known before encoding"""
+        return None
+
+    def iter_json(self):
+        """Yield chunks of encoded JSON"""
+        raise NotImplementedError
+
+
+class Base64File(StreamedValue):
+    """The contents of a file, sent as a base64 encoded string"""
+
+    # Must be a multiple of 3, so chunks encode without padding
+    chunk_size = 3 * 16 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.size = getsize(path)
+
+    def __repr__(self):
+        return "Base64File({!r})".format(self.path)
+
+    @property
+    def json_size(self):
+        return 2 + 4 * ((self.size + 2) // 3)
+
+    def iter_json(self):
+        yield b'"'
+        remaining = self.size
+        with open(self.path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield b64encode(chunk)
+        yield b'"'
+
+
+class Base64Chunks(StreamedValue):
+    """Bytes of a known size from a callable that yields chunks, sent as a base64 encoded string.
+
+    Every chunk except the last should be a multiple of `chunk_size` bytes.
+
+    """
+
+    chunk_size = Base64File.chunk_size
+
+    def __init__(self, size, iter_chunks):
+        self.size = size
+        self.iter_chunks = iter_chunks
+
+    def __repr__(self):
+        return "Base64Chunks({!r})".format(self.size)
+
+    @property
+    def json_size(self):
+        return 2 + 4 * ((self.size + 2) // 3)
+
+    def iter_json(self):
+        yield b'"'
+        for chunk in self.iter_chunks():
+            yield b64encode(chunk)
+        yield b'"'
+
+
+def _get_json_size(value):
+    """Get the encoded size of a StreamedValue, encoding it if the size isn't known"""
+    size = value.json_size
+    if size is None:
+        size = sum(len(chunk) for chunk in value.iter_json())
+    return size
+
+
+def _make_default(streamed, marker):
+    """Make a `default` function for json that replaces StreamedValue instances with a marker string"""
+    def default(value):
+        if isinstance(value, StreamedValue):
+            streamed.append(value)
+            return "{}{}__".format(marker, len(streamed) - 1)
+        raise TypeError("{!r} is not JSON serializable".format(value))
+    return default
+
+
+def encode_json(obj):
+    """Encode an object that may contain StreamedValue instances.
+
+    Returns a tuple of the size of the encoded JSON, and an iterable of byte chunks.
+
+    """
+    streamed = []
+    marker = "__streamed_{}_".format(randint(0, 2 ** 31))
+    obj_json = json.dumps(obj, default=_make_default(streamed, marker), separators=(',', ':')).encode('utf-8')
+    if not streamed:
+        return len(obj_json), [obj_json]
+    parts = re.split(br'"' + marker.encode('ascii') + br'(\d+)__"', obj_json)
+    # parts alternates between encoded JSON and the index of a streamed value
+    size = sum(len(part) for part in parts[0::2]) + sum(_get_json_size(value) for value in streamed)
+
+    def iter_chunks():
+        for index, part in enumerate(parts):
+            if index % 2:
+                for chunk in streamed[int(part)].iter_json():
+                    yield chunk
+            elif part:
+                yield part
+    return size, iter_chunks()
+
+
+def iter_encode_json(obj, chunk_size=16 * 1024):
+    """Encode an object that may contain StreamedValue instances, as a generator of byte chunks.
+
+    Nothing is encoded until it is required, so only one chunk (and the StreamedValue
+    being written) need be in memory at a time.
+
+    """
+    streamed = []
+    marker = "__streamed_{}_".format(randint(0, 2 ** 31))
+    encoder = json.JSONEncoder(default=_make_default(streamed, marker), separators=(',', ':'))
+    marker_json = '"' + marker
+    buffer = []
+    buffered = 0
+    for piece in encoder.iterencode(obj):
+        if piece.startswith(marker_json):
+            if buffer:
+                yield ''.join(buffer).encode('utf-8')
+                del buffer[:]
+                buffered = 0
+            value = streamed[int(piece[len(marker_json):-3])]
+            for chunk in value.iter_json():
+                yield chunk
+            streamed[:] = []
+            continue
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= chunk_size:
+            yield ''.join(buffer).encode('utf-8')
+            del buffer[:]
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def _gzip_chunks(chunks, level):
+    """Compress an iterable of byte chunks to a generator of gzip chunks"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class _ChunkReader(object):
+    """A file-like object that reads from an iterable of byte chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        buffer = self._buffer
+        while size < 0 or len(buffer) < size:
+            try:
+                buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(buffer)
+        self._buffer = buffer[size:]
+        return buffer[:size]
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of persistent HTTP(S) connections to the host in a URL.
+
+    Connections are returned to the pool after a request, so later requests skip the
+    TCP and TLS handshakes. Connections idle for more than `idle_timeout` seconds are
+    closed rather than reused. If the server has closed a reused connection, which is
+    detected when sending the request fails or the connection closes before any response,
+    the request is retried once on a new connection. Other errors (such as a timeout
+    reading the response) aren't retried, as the server may have processed the request.
+
+    """
+
+    def __init__(self, url, max_connections=4, idle_timeout=30.0, timeout=60.0):
+        parsed = urlparse(url)
+        self.url = url
+        self.secure = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = Lock()
+        # List of (connection, time returned to the pool)
+        self._idle = []
+        # Stats
+        self.requests = 0
+        self.connects = 0
+        self.reused = 0
+        self.connect_time = 0.0
+
+    def __repr__(self):
+        return "ConnectionPool({!r})".format(self.url)
+
+    def _connect(self):
+        connection_cls = HTTPSConnection if self.secure else HTTPConnection
+        connection = connection_cls(self.host, self.port, timeout=self.timeout)
+        start = time()
+        connection.connect()
+        connect_time = time() - start
+        with self.lock:
+            self.connects += 1
+            self.connect_time += connect_time
+        return connection
+
+    def _get_connection(self):
+        """Get a (connection, reused) tuple"""
+        now = time()
+        with self.lock:
+            while self._idle:
+                connection, idle_time = self._idle.pop()
+                if now - idle_time < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        return self._connect(), False
+
+    def _put_connection(self, connection):
+        with self.lock:
+            if len(self._idle) < self.max_connections:
+                self._idle.append((connection, time()))
+                return
+        connection.close()
+
+    def post(self, get_body, headers, chunked=False):
+        """POST to the URL, and return the response body and headers.
+
+        `get_body` should return the request body, and may be called again to retry. If
+        `chunked` is True, the body is an iterable of bytes sent with chunked transfer encoding.
+
+        """
+        for attempt in range(2):
+            connection, reused = self._get_connection()
+            retry = reused and not attempt
+            try:
+                if chunked:
+                    connection.request('POST', self.path, body=get_body(), headers=headers, encode_chunked=True)
+                else:
+                    connection.request('POST', self.path, body=get_body(), headers=headers)
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, HTTPException):
+                connection.close()
+                if retry:
+                    log.debug("connection to %s closed, reconnecting", self.host)
+                    continue
+                raise
+            try:
+                response = connection.getresponse()
+                data = response.read()
+            except BadStatusLine:
+                # Closed before the server sent a response (RemoteDisconnected on Python 3)
+                connection.close()
+                if retry:
+                    log.debug("connection to %s closed, reconnecting", self.host)
+                    continue
+                raise
+            except (socket.error, HTTPException):
+                connection.close()
+                raise
+            with self.lock:
+                self.requests += 1
+                if reused:
+                    self.reused += 1
+            if response.getheader('connection', '').lower() == 'close' or response.version < 11:
+                connection.close()
+            else:
+                self._put_connection(connection)
+            if response.status >= 400:
+                raise HTTPError(self.url, response.status, response.reason, response.msg, BytesIO(data))
+            return data, response.msg
+
+    def close(self):
+        """Close idle connections"""
+        with self.lock:
+            idle = self._idle
+            self._idle = []
+        for connection, _idle_time in idle:
+            connection.close()
+
+    def get_stats(self):
+        """Get a dict of connection statistics"""
+        with self.lock:
+            mean_connect_time = self.connect_time / self.connects if self.connects else 0.0
+            return {"requests": self.requests,
+                    "handshakes": self.connects,
+                    "reused": self.reused,
+                    "connect_time": self.connect_time,
+                    "time_saved": self.reused * mean_connect_time}
+
+
 class Batch(object):
     """An object that stores a batch of rpc calls
 
@@ -140,24 +480,103 @@ class JSONRPC(object):
 
     unknown_error_msg = "the server did not supply further information"
 
-    def __init__(self, url):
+    def __init__(self, url, pool=True, gzip=False, gzip_threshold=1024, gzip_level=1, chunked=False):
         self.url = url
         self.call_id = 1
+        # Stream request bodies with chunked transfer encoding (requires a connection pool and Python 3.6+)
+        self.chunked = chunked and CHUNKED_SUPPORTED
+        # Request bodies of at least gzip_threshold bytes are compressed, and gzipped responses accepted
+        self.gzip = gzip
+        self.gzip_threshold = gzip_threshold
+        self.gzip_level = gzip_level
+        # urlopen handles proxies
+        if pool and urlparse(url).scheme not in getproxies():
+            self.pool = ConnectionPool(url)
+        else:
+            self.pool = None
 
     def new_call_id(self):
         self.call_id += 1
         return self.call_id
 
     def _send(self, call):
-        call_json = json.dumps(call).encode('utf-8')
+        headers = {"Content-Type": "application/json"}
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+        if self.chunked and self.pool is not None:
+            response_data, response_headers = self._send_chunked(call, headers)
+        else:
+            response_data, response_headers = self._send_sized(call, headers)
+        if (response_headers.get('Content-Encoding') or '').lower() == 'gzip':
+            response_data = zlib.decompress(response_data, 16 + zlib.MAX_WBITS)
+        return response_data.decode('utf-8')
+
+    def _send_chunked(self, call, headers):
+        """Send a body generated as it is written, so its size needn't be known in advance"""
+        if self.gzip:
+            headers["Content-Encoding"] = "gzip"
+            get_body = lambda: _gzip_chunks(iter_encode_json(call), self.gzip_level)
+        else:
+            get_body = lambda: iter_encode_json(call)
+        return self.pool.post(get_body, headers, chunked=True)
+
+    def _send_sized(self, call, headers):
+        """Send a body with a Content-Length"""
+        size, chunks = encode_json(call)
+        if self.gzip and size >= self.gzip_threshold:
+            headers["Content-Encoding"] = "gzip"
+            if not isinstance(chunks, list):
+                # The compressed size isn't known until the body is compressed, so compress
+                # streamed values to a temporary file rather than in to memory
+                with tempfile.TemporaryFile() as body_file:
+                    for chunk in _gzip_chunks(chunks, self.gzip_level):
+                        body_file.write(chunk)
+                    headers["Content-Length"] = str(body_file.tell())
+
+                    def get_body():
+                        body_file.seek(0)
+                        return body_file
+
+                    return self._post(get_body, headers)
+            body = b''.join(_gzip_chunks(chunks, self.gzip_level))
+            headers["Content-Length"] = str(len(body))
+            get_body = lambda: body
+        elif isinstance(chunks, list):
+            body = b''.join(chunks)
+            headers["Content-Length"] = str(len(body))
+            get_body = lambda: body
+        else:
+            # Stream the body, without holding large values in memory (encoded again if the request is retried)
+            headers["Content-Length"] = str(size)
+            unsent = [chunks]
+
+            def get_body():
+                return _ChunkReader(unsent.pop() if unsent else encode_json(call)[1])
+
+        return self._post(get_body, headers)
+
+    def _post(self, get_body, headers):
+        """POST a request body (from `get_body`) with a known size"""
+        if self.pool is not None:
+            return self.pool.post(get_body, headers)
         url_file = None
         try:
-            url_file = urlopen(self.url, call_json)
-            response_json = url_file.read().decode('utf-8')
+            url_file = urlopen(Request(self.url, data=get_body(), headers=headers))
+            return url_file.read(), url_file.info()
         finally:
             if url_file is not None:
                 url_file.close()
-        return response_json
+
+    def get_stats(self):
+        """Get a dict of connection statistics, or None if connections aren't pooled"""
+        if self.pool is None:
+            return None
+        return self.pool.get_stats()
+
+    def close(self):
+        """Close persistent connections"""
+        if self.pool is not None:
+            self.pool.close()
 
     def call(self, method, **params):
         """Call a remote method"""
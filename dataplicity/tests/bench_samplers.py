@@ -0,0 +1,178 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Micro-benchmarks for sampler storage
+
+Run with:
+
+    python -m dataplicity.tests.bench_samplers
+
+"""
+
+from dataplicity.client import sampler as sampler_module
+from dataplicity.client import gorilla
+from dataplicity.client.sampler import Sampler
+from dataplicity.compat import py2bytes
+
+from functools import partial
+from os.path import getsize
+from time import time
+import tempfile
+import shutil
+import struct
+import random
+import json
+import os
+
+
+NUM_SAMPLES = 20000
+
+
+def _legacy_add_sample(sampler, timestamp, value):
+    """The original write path: stat, open, write and close for every sample"""
+    if getsize(sampler.samples_path) >= sampler.max_file_size:
+        return False
+    with sampler.lock:
+        with open(sampler.samples_path, 'ab') as f:
+            f.write(sampler.sample_pack(timestamp, value))
+    return True
+
+
+def _legacy_read_samples(samples_path):
+    """The original decoder: one struct unpack per sample"""
+    with open(samples_path, 'rb') as f:
+        sample_format = Sampler._read_header(f).decode('utf-8')
+        sample_struct = struct.Struct(py2bytes(sample_format))
+        read_sample = partial(f.read, sample_struct.size)
+        unpack = sample_struct.unpack
+        samples = [unpack(sample) for sample in iter(read_sample, b'')]
+    return samples
+
+
+def _time_samples(add_sample, count):
+    start = time()
+    for i in range(count):
+        add_sample(float(i), float(i))
+    return time() - start
+
+
+def report(name, count, ellapsed):
+    print("{:<32} {:>10.0f} samples/s".format(name, count / ellapsed))
+
+
+def bench_add_sample(temp_dir, count=NUM_SAMPLES):
+    """Compare samples per second with the legacy and persistent write paths"""
+
+    def make_sampler(name, **kwargs):
+        path = os.path.join(temp_dir, name)
+        os.mkdir(path)
+        return Sampler(path, name, max_samples=count, **kwargs)
+
+    sampler = make_sampler('legacy')
+    report('open/close per sample', count, _time_samples(lambda t, v: _legacy_add_sample(sampler, t, v), count))
+
+    for name, kwargs in [('flush every sample', {}),
+                         ('flush every 100 samples', {'flush_samples': 100}),
+                         ('flush every 1000ms', {'flush_samples': count, 'flush_interval': 1000}),
+                         ('fsync every 100 samples', {'flush_samples': 100, 'fsync': True})]:
+        sampler = make_sampler(name.replace(' ', '_'), **kwargs)
+        report(name, count, _time_samples(sampler.add_sample, count))
+        sampler.close()
+
+
+def bench_read_samples(temp_dir, count=NUM_SAMPLES * 5, repeat=10):
+    """Compare the legacy decoder with the bulk decoder"""
+
+    def time_read(read):
+        start = time()
+        for _ in range(repeat):
+            read()
+        return time() - start
+
+    for time_format, value_format in [('d', 'd'), ('d', 'l')]:
+        name = 'read_{}{}'.format(time_format, value_format)
+        path = os.path.join(temp_dir, name)
+        os.mkdir(path)
+        sampler = Sampler(path, name,
+                          time_format=time_format,
+                          value_format=value_format,
+                          max_samples=count,
+                          flush_samples=count)
+        for i in range(count):
+            sampler.add_sample(float(i), i)
+        sampler.flush()
+
+        fmt = "<{}{}".format(time_format, value_format)
+        report('{} unpack per sample'.format(fmt), count * repeat,
+               time_read(lambda: _legacy_read_samples(sampler.samples_path)))
+        report('{} bulk decode'.format(fmt), count * repeat,
+               time_read(lambda: sampler.read_samples()))
+        report('{} bulk decode + jsonify'.format(fmt), count * repeat,
+               time_read(lambda: sampler.read_samples().jsonify()))
+        if sampler_module.numpy is not None:
+            numpy = sampler_module.numpy
+            sampler_module.numpy = None
+            try:
+                report('{} bulk decode (no numpy)'.format(fmt), count * repeat,
+                       time_read(lambda: sampler.read_samples()))
+            finally:
+                sampler_module.numpy = numpy
+        sampler.close()
+
+
+def bench_query(temp_dir, count=NUM_SAMPLES * 10, repeat=100):
+    """Compare reading a whole samples file and filtering, with an indexed query for the last minute"""
+    path = os.path.join(temp_dir, 'query')
+    os.mkdir(path)
+    sampler = Sampler(path, 'query', max_samples=count, flush_samples=count)
+    sampler.add_samples((float(i), float(i)) for i in range(count))
+    sampler.flush()
+    start_time = float(count - 60)
+
+    def time_query(query):
+        start = time()
+        for _ in range(repeat):
+            query()
+        return time() - start
+
+    print("{:<32} {:>10.1f} queries/s".format('read and filter', repeat / time_query(
+        lambda: sampler.read_samples().between(start_time))))
+    print("{:<32} {:>10.1f} queries/s".format('indexed query', repeat / time_query(
+        lambda: sampler.query(start_time))))
+    print("{:<32} {:>10.1f} queries/s".format('indexed aggregate (all)', repeat / time_query(
+        lambda: sampler.aggregate())))
+    sampler.close()
+
+
+def bench_encoding(count=NUM_SAMPLES):
+    """Compare the size of raw, JSON and compressed samples from a periodic sampler"""
+    random.seed(1)
+    start = 1400000000.0
+    # Polled every 10 seconds with some scheduling jitter
+    timestamps = [start + i * 10 + random.random() * 0.005 for i in range(count)]
+    series = {
+        'constant (memory_total)': [3951.0] * count,
+        'slowly changing (memory_available)': [float(2000 + (i // 30)) for i in range(count)],
+        'noisy (cpu_percent)': [round(random.uniform(0, 30), 1) for i in range(count)]
+    }
+    for name, values in sorted(series.items()):
+        raw_size = count * struct.calcsize(b'<dd')
+        json_size = len(json.dumps([[t, v] for t, v in zip(timestamps, values)]))
+        block_start = time()
+        block = gorilla.encode_block(timestamps, values)
+        encode_time = time() - block_start
+        print("{:<36} raw {:>7} json {:>7} gorilla {:>7} ({:.1f}x raw, {:.1f}x json, {:.0f} samples/s)".format(
+            name, raw_size, json_size, len(block),
+            float(raw_size) / len(block), float(json_size) / len(block), count / encode_time))
+
+
+if __name__ == "__main__":
+    temp_dir = tempfile.mkdtemp('dpbench')
+    try:
+        bench_add_sample(temp_dir)
+        bench_read_samples(temp_dir)
+        bench_query(temp_dir)
+        bench_encoding()
+    finally:
+        shutil.rmtree(temp_dir)
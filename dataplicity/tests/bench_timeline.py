@@ -0,0 +1,110 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Micro-benchmarks for timeline storage
+
+Run with:
+
+    python -m dataplicity.tests.bench_timeline
+
+"""
+
+from dataplicity.client.timeline import Timeline, decode_event, encode_event
+
+from os.path import splitext
+from time import time
+import tempfile
+import shutil
+import os
+
+try:
+    from fs.osfs import OSFS
+    from fs.errors import FSError
+except ImportError:
+    OSFS = None
+
+
+NUM_EVENTS = 10000
+
+
+class LegacyTimeline(Timeline):
+    """The original storage, which went through pyfilesystem for every event"""
+
+    def init_storage(self):
+        self.fs = OSFS(self.path, create=True)
+
+    def _read_event_ids(self):
+        return set(splitext(filename)[0] for filename in self.fs.listdir(wildcard="*.json"))
+
+    def _iter_stored_events(self, cursor=None, max_count=None):
+        event_filenames = self.fs.listdir(wildcard="*.json")
+        self._event_ids = set(splitext(filename)[0] for filename in event_filenames)
+        for event_filename in event_filenames:
+            try:
+                with self.fs.open(event_filename, 'rb') as f:
+                    yield decode_event(f.read())
+            except FSError:
+                continue
+
+    def clear_all(self):
+        for filename in self.fs.listdir(wildcard="*.json"):
+            try:
+                self.fs.remove(filename)
+            except FSError:
+                pass
+        self._event_ids.clear()
+
+    def clear_events(self, event_ids):
+        for event_id in event_ids:
+            try:
+                self.fs.remove("{}.json".format(event_id))
+            except FSError:
+                pass
+            self._event_ids.discard(event_id)
+
+    def _store_event(self, event_id, event):
+        with self.fs.open("{}.json".format(event_id), 'wb') as f:
+            f.write(encode_event(event))
+        self._event_ids.add(event_id)
+
+
+def report(name, count, ellapsed):
+    print("{:<32} {:>10.0f} events/s".format(name, count / ellapsed))
+
+
+def bench_timeline(temp_dir, timeline_cls, count=NUM_EVENTS, page=100):
+    """Time writing, reading, clearing in pages, and clearing all events"""
+    name = timeline_cls.__name__
+    timeline = timeline_cls(os.path.join(temp_dir, name), name)
+
+    start = time()
+    for i in range(count):
+        timeline.new_event('TEXT', timestamp=i, title='event', text='x' * 100).write()
+    report('{} write'.format(name), count, time() - start)
+
+    start = time()
+    events = timeline.get_events()
+    report('{} get_events'.format(name), count, time() - start)
+
+    start = time()
+    event_ids = [event['event_id'] for event in events]
+    for offset in range(0, count // 2, page):
+        timeline.clear_events(event_ids[offset:offset + page])
+    report('{} clear_events'.format(name), count // 2, time() - start)
+
+    start = time()
+    timeline.clear_all()
+    report('{} clear_all'.format(name), count - count // 2, time() - start)
+
+
+if __name__ == "__main__":
+    temp_dir = tempfile.mkdtemp('dpbench')
+    try:
+        if OSFS is None:
+            print("pyfilesystem isn't installed, skipping the legacy timeline")
+        else:
+            bench_timeline(temp_dir, LegacyTimeline)
+        bench_timeline(temp_dir, Timeline)
+    finally:
+        shutil.rmtree(temp_dir)
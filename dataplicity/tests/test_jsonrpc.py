@@ -0,0 +1,226 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+import threading
+import tempfile
+import shutil
+import json
+import os
+import socket
+import time
+import zlib
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from dataplicity.client.sampler import Samples, SamplesJSON
+from dataplicity.jsonrpc import (JSONRPC, RemoteMethodError, StreamedValue, Base64File, gzip_compress,
+                                 CHUNKED_SUPPORTED)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Echoes the method name, closes the connection if the method is 'close', and
+    responds late if the method is 'slow'"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self._read_chunked()
+        else:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.server.bodies.append((self.headers.get('Content-Encoding'), len(body)))
+        self.server.requests.append(body)
+        request = json.loads(body.decode('utf-8'))
+        calls = request if isinstance(request, list) else [request]
+        responses = []
+        for call in calls:
+            if call['method'] == 'fail':
+                responses.append({"jsonrpc": "2.0", "id": call['id'], "error": {"code": 1, "message": "failed"}})
+            else:
+                responses.append({"jsonrpc": "2.0", "id": call['id'], "result": call['method']})
+        response_json = json.dumps(responses if isinstance(request, list) else responses[0]).encode('utf-8')
+        if calls[0]['method'] == 'slow':
+            time.sleep(0.5)
+        self.send_response(200)
+        if self.headers.get('Accept-Encoding') == 'gzip':
+            response_json = gzip_compress(response_json)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(response_json)))
+        self.end_headers()
+        self.wfile.write(response_json)
+        # Close without telling the client, like a server timing out an idle connection
+        self.close_connection = calls[0]['method'] == 'close'
+
+    def _read_chunked(self):
+        chunks = []
+        while 1:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if not size:
+                self.rfile.readline()
+                break
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        return b''.join(chunks)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    bodies = None
+    requests = None
+
+    def handle_error(self, request, client_address):
+        # The client may close the connection before a response
+        pass
+
+
+class _Numbers(StreamedValue):
+    """A list of numbers, which may only be encoded once"""
+
+    def __init__(self, count):
+        self.count = count
+        self.encoded = 0
+
+    def iter_json(self):
+        self.encoded += 1
+        yield b'['
+        for number in range(self.count):
+            yield '{}{}'.format(',' if number else '', number).encode('utf-8')
+        yield b']'
+
+
+class TestJSONRPC(unittest.TestCase):
+    """Test the JSONRPC client"""
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.bodies = []
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.remote = JSONRPC('http://127.0.0.1:{}/jsonrpc/'.format(self.server.server_port))
+
+    def tearDown(self):
+        self.remote.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """Test connections are reused, and reopened when the server closes them"""
+        for _ in range(5):
+            self.assertEqual(self.remote.call('hello'), 'hello')
+        with self.remote.batch() as batch:
+            batch.call_with_id('greet', 'greet')
+        self.assertEqual(batch.get_result('greet'), 'greet')
+        with self.assertRaises(RemoteMethodError):
+            self.remote.call('fail')
+        stats = self.remote.get_stats()
+        self.assertEqual((stats['requests'], stats['handshakes'], stats['reused']), (7, 1, 6))
+
+        self.assertEqual(self.remote.call('close'), 'close')
+        self.assertEqual(self.remote.call('hello'), 'hello')
+        self.assertEqual(self.remote.get_stats()['handshakes'], 2)
+
+    def test_no_retry_timeout(self):
+        """Test a request that times out waiting for the response isn't sent again"""
+        remote = JSONRPC(self.remote.url)
+        remote.pool.timeout = 0.1
+        self.assertEqual(remote.call('hello'), 'hello')
+        with self.assertRaises(socket.timeout):
+            remote.call('slow')
+        remote.close()
+        self.assertEqual([json.loads(body.decode('utf-8'))['method'] for body in self.server.requests],
+                         ['hello', 'slow'])
+
+    def test_gzip(self):
+        """Test large request bodies are gzipped, and gzipped responses decoded"""
+        remote = JSONRPC(self.remote.url, gzip=True, gzip_threshold=200)
+        self.assertEqual(remote.call('small'), 'small')
+        self.assertEqual(remote.call('large', values=list(range(100))), 'large')
+        self.assertEqual([encoding for encoding, _size in self.server.bodies], [None, 'gzip'])
+        remote.close()
+
+    def test_gzip_streamed(self):
+        """Test requests containing streamed values, such as samples, are gzipped"""
+        remote = JSONRPC(self.remote.url, gzip=True, gzip_threshold=1024)
+        samples = Samples([float(i) for i in range(500)], [i / 2.0 for i in range(500)])
+        with remote.batch() as batch:
+            batch.call_with_id('samples', 'device.add_samples', samples=SamplesJSON(samples))
+        self.assertEqual(batch.get_result('samples'), 'device.add_samples')
+        self.assertEqual(self.server.bodies[-1][0], 'gzip')
+        request = json.loads(self.server.requests[-1].decode('utf-8'))
+        self.assertEqual(request[0]['params']['samples'], samples.jsonify())
+        remote.close()
+
+    @unittest.skipIf(tracemalloc is None, "requires tracemalloc")
+    def test_gzip_attachment(self):
+        """Test a gzipped request with an attachment isn't held in memory in full"""
+        temp_dir = tempfile.mkdtemp('dptest')
+        try:
+            path = os.path.join(temp_dir, 'photo.jpg')
+            with open(path, 'wb') as f:
+                for _ in range(64):
+                    f.write(os.urandom(64 * 1024))
+            remote = JSONRPC(self.remote.url, gzip=True, gzip_threshold=1024)
+            received = []
+
+            def post(get_body, headers):
+                # Read the body in chunks, like a connection sending it
+                body = get_body()
+                self.assertNotIsInstance(body, bytes)
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                compressed_size = size = 0
+                for chunk in iter(lambda: body.read(64 * 1024), b''):
+                    compressed_size += len(chunk)
+                    size += len(decompressor.decompress(chunk))
+                received.append((headers['Content-Encoding'], int(headers['Content-Length']), compressed_size, size))
+                response = {"jsonrpc": "2.0", "id": remote.call_id, "result": True}
+                return json.dumps(response).encode('utf-8'), {}
+
+            remote.pool.post = post
+            tracemalloc.start()
+            try:
+                self.assertTrue(remote.call('device.add_photo', photo=Base64File(path)))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            encoding, content_length, compressed_size, size = received[0]
+            self.assertEqual(encoding, 'gzip')
+            self.assertEqual(content_length, compressed_size)
+            self.assertGreater(size, 4 * 1024 * 1024)
+            self.assertLess(peak, 1024 * 1024)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(CHUNKED_SUPPORTED, "chunked requests require Python 3.6")
+    def test_chunked(self):
+        """Test requests are streamed with chunked transfer encoding"""
+        for gzip in (False, True):
+            remote = JSONRPC(self.remote.url, chunked=True, gzip=gzip, gzip_threshold=0)
+            numbers = _Numbers(10000)
+            with remote.batch() as batch:
+                batch.call_with_id('numbers', 'numbers', numbers=numbers, text='x' * 100000)
+            self.assertEqual(batch.get_result('numbers'), 'numbers')
+            # Encoded once, while the request was sent
+            self.assertEqual(numbers.encoded, 1)
+            request = json.loads(self.server.requests[-1].decode('utf-8'))
+            self.assertEqual(request[0]['params']['numbers'], list(range(10000)))
+            self.assertEqual(self.server.bodies[-1][0], 'gzip' if gzip else None)
+            remote.close()
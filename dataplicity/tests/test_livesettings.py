@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+
+from dataplicity.client.livesettings import LiveSettingsManager, get_hash
+
+
+class _Settings(object):
+    """Settings held in memory, in place of a settings file"""
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.synced_hash = None
+
+    @property
+    def content_hash(self):
+        return get_hash(self.contents)
+
+    @property
+    def settings(self):
+        return self.contents
+
+    def check(self, reload=False):
+        return self
+
+    def write(self, contents):
+        self.contents = contents
+
+
+class _Tasks(object):
+
+    def __init__(self):
+        self.signals = []
+
+    def send_signal_from(self, sender, name, *args):
+        self.signals.append((name,) + args)
+
+
+class TestLiveSettings(unittest.TestCase):
+    """Test syncing settings with the server"""
+
+    def setUp(self):
+        self.manager = LiveSettingsManager(None, 'test')
+        self.manager._settings['waves'] = _Settings('[wave]\nperiod = 1\n')
+
+    def _sync(self):
+        """Get the sync call, and acknowledge the hashes as the server would"""
+        method, params = self.manager.get_sync_call()
+        self.assertEqual(method, 'device.check_conf_hashes')
+        self.manager.ack_hashes(params['conf_hashes'], [])
+        return params
+
+    def test_hashes(self):
+        """Test contents are sent only when they change"""
+        self.assertEqual(self._sync()['conf_map'], {'waves': '[wave]\nperiod = 1\n'})
+        self.assertEqual(self._sync()['conf_map'], {})
+        self.manager._settings['waves'].contents = '[wave]\nperiod = 2\n'
+        self.assertEqual(self._sync()['conf_map'], {'waves': '[wave]\nperiod = 2\n'})
+
+    def test_server_update(self):
+        """Test settings written from the server aren't sent back on the next sync"""
+        self._sync()
+        tasks = _Tasks()
+        contents = '[wave]\nperiod = 5\n'
+        self.manager.update({'waves': contents}, tasks)
+        self.assertEqual(tasks.signals, [('waves', 'waves', contents)])
+        params = self._sync()
+        self.assertEqual(params['conf_hashes'], {'waves': get_hash(contents)})
+        self.assertEqual(params['conf_map'], {})
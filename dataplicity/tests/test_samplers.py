@@ -6,8 +6,14 @@ import tempfile
 import shutil
 
 import os
+import struct
+import json
 
-from dataplicity.client.sampler import Sampler
+from dataplicity.client.sampler import Sampler, RingSampler, GorillaSampler, SegmentSampler, SQLiteSampler, Samples
+from dataplicity.client.segments import SegmentStore
+from dataplicity.client.sqlitestore import Database
+from dataplicity.client import gorilla
+from dataplicity.jsonrpc import encode_json, iter_encode_json
 
 
 class TestSamplers(unittest.TestCase):
@@ -122,3 +128,436 @@ class TestSamplers(unittest.TestCase):
             do_check('signed', time_format, convert(test_signed_integer_samples), ['h', 'l', 'q'])
             do_check('unsigned', time_format, convert(test_unsigned_integer_samples), ['h', 'l', 'q'])
             do_check('float', time_format, convert(test_float_samples), ['f', 'd'])
+
+    def test_group_commit(self):
+        """Test samples are flushed in groups, and the file is re-opened after a snapshot"""
+        path = os.path.join(self.temp_dir, 'sampler_group')
+        os.mkdir(path)
+        sampler = Sampler(path, 'group', max_samples=100, flush_samples=10)
+        header_size = len(sampler.header)
+
+        for i in range(9):
+            sampler.add_sample(float(i), float(i))
+        self.assertEqual(sampler.sample_count, 9)
+        self.assertEqual(os.path.getsize(sampler.samples_path), header_size)
+        sampler.add_sample(9.0, 9.0)
+        self.assertEqual(os.path.getsize(sampler.samples_path), header_size + 10 * sampler.sample_size)
+
+        sampler.add_sample(10.0, 10.0)
+        samples = sampler.snapshot_samples()
+        self.assertEqual(len(samples), 11)
+        self.assertEqual(sampler.sample_count, 0)
+
+        sampler.add_sample(11.0, 11.0)
+        sampler.flush()
+        self.assertEqual(list(sampler.read_samples()), [(11.0, 11.0)])
+        sampler.remove_snapshot()
+        sampler.close()
+
+    def test_full(self):
+        """Test samples are rejected when the sampler is full"""
+        path = os.path.join(self.temp_dir, 'sampler_full')
+        os.mkdir(path)
+        sampler = Sampler(path, 'full', max_samples=5)
+        for i in range(5):
+            self.assertTrue(sampler.add_sample(float(i), 1.0))
+        self.assertTrue(sampler.full)
+        self.assertFalse(sampler.add_sample(5.0, 1.0))
+        sampler.close()
+
+        # Sample count is recovered when the file is re-opened
+        sampler = Sampler(path, 'full', max_samples=5)
+        self.assertEqual(sampler.sample_count, 5)
+        self.assertFalse(sampler.add_sample(5.0, 1.0))
+        sampler.close()
+
+    def test_ring_sampler(self):
+        """Test the ring buffer overwrites the oldest samples"""
+        path = os.path.join(self.temp_dir, 'sampler_ring')
+        os.mkdir(path)
+        sampler = RingSampler(path, 'ring', time_format='d', value_format='l', max_samples=4)
+
+        for i in range(6):
+            self.assertTrue(sampler.add_sample(float(i), i))
+        self.assertFalse(sampler.full)
+        self.assertEqual(list(sampler.read_samples()), [(2.0, 2), (3.0, 3), (4.0, 4), (5.0, 5)])
+
+        samples = sampler.snapshot_samples()
+        self.assertEqual(list(samples), [(2.0, 2), (3.0, 3), (4.0, 4), (5.0, 5)])
+        sampler.add_sample(6.0, 6)
+        sampler.remove_snapshot()
+        self.assertEqual(list(sampler.snapshot_samples()), [(6.0, 6)])
+        sampler.close()
+
+        # Counters persist when the ring is re-opened
+        sampler = RingSampler(path, 'ring', time_format='d', value_format='l', max_samples=4)
+        self.assertEqual(list(sampler.read_samples()), [(6.0, 6)])
+        sampler.remove_snapshot()
+        self.assertEqual(list(sampler.snapshot_samples()), [])
+        sampler.close()
+
+        # A change of format discards the ring
+        sampler = RingSampler(path, 'ring', time_format='d', value_format='l', max_samples=8)
+        sampler.add_sample(7.0, 7)
+        self.assertEqual(list(sampler.read_samples()), [(7.0, 7)])
+        sampler.close()
+
+    def test_decode_samples(self):
+        """Test bulk decoding of samples in to columns"""
+        for fmt, samples in [('<dd', [(1.0, 1.5), (2.0, -2.5)]),
+                             ('<dl', [(1.0, 1), (2.0, -2)]),
+                             ('<fH', [(1.0, 1), (2.0, 65535)])]:
+            packed = b''.join(struct.pack(fmt.encode('ascii'), t, v) for t, v in samples)
+            # Trailing incomplete samples are ignored
+            decoded = Samples.decode(fmt, packed + b'\0')
+            self.assertEqual(len(decoded), len(samples))
+            self.assertEqual(list(decoded), samples)
+            self.assertEqual(decoded.jsonify(), [list(sample) for sample in samples])
+            self.assertEqual(list(decoded[1:]), samples[1:])
+        self.assertFalse(Samples.decode('<dd', b''))
+
+    def test_gorilla_encoding(self):
+        """Test compressed blocks decode to the original samples"""
+        timestamps = [1400000000.0 + i * 10 + (i % 3) * 0.001 for i in range(200)]
+        values = [50.0 + (i // 20) * 0.5 for i in range(200)]
+        values[100:103] = [float('inf'), -0.0, 1e300]
+        block = gorilla.encode_block(timestamps, values)
+        self.assertLess(len(block), len(timestamps) * 16 // 8)
+        decoded_timestamps, decoded_values = gorilla.decode_block(block)
+        self.assertEqual(decoded_values, values)
+        for t, dt in zip(timestamps, decoded_timestamps):
+            self.assertAlmostEqual(t, dt, places=3)
+        self.assertEqual(gorilla.decode_block(gorilla.encode_block([], [])), ([], []))
+        self.assertRaises(gorilla.EncodingError, gorilla.decode_block, block[:-4])
+
+    def test_gorilla_sampler(self):
+        """Test the compressed sampler storage"""
+        path = os.path.join(self.temp_dir, 'sampler_gorilla')
+        os.mkdir(path)
+        sampler = GorillaSampler(path, 'gorilla', value_format='l', max_samples=100, flush_samples=8)
+        samples = [(1000.0 + i * 60, i // 4) for i in range(20)]
+        for t, v in samples:
+            sampler.add_sample(t, v)
+        self.assertEqual(list(sampler.read_samples()), samples)
+        sampler.close()
+
+        sampler = GorillaSampler(path, 'gorilla', value_format='l', max_samples=100, flush_samples=8)
+        self.assertEqual(sampler.sample_count, 20)
+        snapshot = sampler.snapshot_samples()
+        self.assertEqual(list(snapshot), samples)
+        self.assertEqual(len(sampler.read_samples()), 0)
+        sampler.remove_snapshot()
+        sampler.close()
+
+    def test_sync_encoding(self):
+        """Test samples are encoded for the server"""
+        from base64 import b64decode
+        path = os.path.join(self.temp_dir, 'sampler_sync')
+        os.mkdir(path)
+        sampler = Sampler(path, 'sync', sync_encoding='gorilla')
+        sampler.add_sample(1.0, 2.0)
+        sampler.add_sample(2.0, 3.0)
+        samples = sampler.snapshot_samples()
+        params = sampler.get_sync_params(samples)
+        self.assertEqual(params['samples_encoding'], 'gorilla')
+        self.assertEqual(gorilla.decode_block(b64decode(params['samples'])), ([1.0, 2.0], [2.0, 3.0]))
+        sampler.sync_encoding = 'json'
+        size, chunks = encode_json(sampler.get_sync_params(samples))
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')), {"samples": [[1.0, 2.0], [2.0, 3.0]]})
+        self.assertEqual(json.loads(b''.join(iter_encode_json(sampler.get_sync_params(samples[:0]))).decode('utf-8')),
+                         {"samples": []})
+        sampler.close()
+
+    def test_resume_snapshot(self):
+        """Test snapshots are read in chunks, and resume from the last acknowledged chunk"""
+        for sampler_cls in (Sampler, RingSampler, GorillaSampler):
+            path = os.path.join(self.temp_dir, 'sampler_chunks_' + sampler_cls.storage)
+            os.mkdir(path)
+            sampler = sampler_cls(path, 'chunks', max_samples=100, flush_samples=4)
+            for i in range(25):
+                sampler.add_sample(float(i), float(i))
+
+            chunks = sampler.iter_snapshot(10)
+            position, samples = next(chunks)
+            self.assertEqual([v for t, v in samples], [float(i) for i in range(10)])
+            sampler.ack_snapshot(position)
+            position, samples = next(chunks)
+            self.assertEqual(len(samples), 10)
+            # Second chunk is not acknowledged
+            chunks.close()
+
+            chunks = list(sampler.iter_snapshot(10))
+            resumed = [v for _position, samples in chunks for t, v in samples]
+            self.assertEqual(resumed, [float(i) for i in range(10, 25)])
+            sampler.ack_snapshot(chunks[-1][0])
+            sampler.add_sample(25.0, 25.0)
+            sampler.remove_snapshot()
+            self.assertEqual(list(sampler.snapshot_samples()), [(25.0, 25.0)])
+            sampler.close()
+
+    def test_add_samples(self):
+        """Test adding a batch of samples"""
+        batch = [(float(i), float(i * 2)) for i in range(8)]
+        for sampler_cls in (Sampler, GorillaSampler):
+            path = os.path.join(self.temp_dir, 'sampler_batch_' + sampler_cls.storage)
+            os.mkdir(path)
+            sampler = sampler_cls(path, 'batch', max_samples=10)
+            self.assertEqual(sampler.add_samples(iter(batch)), 8)
+            # Only 2 more samples fit
+            self.assertEqual(sampler.add_samples(batch), 2)
+            self.assertTrue(sampler.full)
+            self.assertEqual(list(sampler.read_samples()), batch + batch[:2])
+            sampler.close()
+
+        path = os.path.join(self.temp_dir, 'sampler_batch_ring')
+        os.mkdir(path)
+        sampler = RingSampler(path, 'batch', max_samples=5)
+        self.assertEqual(sampler.add_samples(batch[:3]), 3)
+        self.assertEqual(sampler.add_samples(Samples.decode('<dd', b''.join(
+            struct.pack(b'<dd', t, v) for t, v in batch[3:]))), 5)
+        self.assertEqual(list(sampler.read_samples()), batch[3:])
+        self.assertEqual(sampler.add_samples(batch), 8)
+        self.assertEqual(list(sampler.read_samples()), batch[3:])
+        sampler.close()
+
+    def test_rollups(self):
+        """Test rollups are maintained as samples arrive"""
+        path = os.path.join(self.temp_dir, 'sampler_rollup')
+        os.mkdir(path)
+        sampler = Sampler(path, 'rollup', max_samples=100, rollups=['1m', '1h'],
+                          sync_tier='1m', sync_tier_backlog=50)
+        # Two minutes of samples every second, with the values 0 to 59
+        for i in range(120):
+            if i == 50:
+                self.assertIsNone(sampler.get_sync_rollup())
+            sampler.add_sample(float(i), float(i % 60))
+        sampler.add_samples((float(i), 1.0) for i in range(120, 200))
+        # The sampler is full, but the rollups are still maintained
+        self.assertEqual(sampler.backlog, 100)
+        rollup = sampler.get_sync_rollup()
+        self.assertEqual(rollup.name, '1m')
+
+        records = sampler.snapshot_rollup(rollup)
+        self.assertEqual(records, [(0.0, 0.0, 59.0, 29.5, 60), (60.0, 0.0, 59.0, 29.5, 60), (120.0, 1.0, 1.0, 1.0, 60)])
+        params = rollup.get_sync_params(records)
+        self.assertEqual(params['samples'], [[0.0, 29.5], [60.0, 29.5], [120.0, 1.0]])
+        self.assertEqual(params['rollup']['count'], [60, 60, 60])
+
+        sampler.remove_snapshot()
+        self.assertEqual(sampler.backlog, 0)
+        self.assertEqual(rollup.snapshot_records(), [])
+        sampler.close()
+        # The incomplete bucket is written on close
+        self.assertEqual(rollup.read_records(), [(180.0, 1.0, 1.0, 1.0, 20)])
+
+    def test_deadband(self):
+        """Test samples inside the deadband are dropped"""
+        path = os.path.join(self.temp_dir, 'sampler_deadband')
+        os.mkdir(path)
+        sampler = Sampler(path, 'deadband', deadband=0.5, heartbeat=10)
+        for t, v in [(0.0, 1.0), (1.0, 1.2), (2.0, 1.6), (3.0, 1.0), (4.0, 1.0), (13.0, 1.0)]:
+            self.assertTrue(sampler.add_sample(t, v))
+        self.assertEqual(list(sampler.read_samples()), [(0.0, 1.0), (2.0, 1.6), (3.0, 1.0), (13.0, 1.0)])
+
+        self.assertEqual(sampler.add_samples([(14.0, 1.1), (15.0, 2.0), (16.0, 2.1)]), 3)
+        self.assertEqual(list(sampler.read_samples())[-1], (15.0, 2.0))
+        sampler.close()
+
+        path = os.path.join(self.temp_dir, 'sampler_change')
+        os.mkdir(path)
+        sampler = Sampler(path, 'change', deadband_relative=0.1)
+        sampler.add_samples([(0.0, 100.0), (1.0, 105.0), (2.0, 111.0), (3.0, 111.0)])
+        self.assertEqual(list(sampler.read_samples()), [(0.0, 100.0), (2.0, 111.0)])
+
+        # The check and the write are made together, so threads can't both pass the check
+        check_deadband = sampler._check_deadband
+        locked = []
+
+        def check(*args):
+            locked.append(sampler.lock._is_owned())
+            return check_deadband(*args)
+
+        sampler._check_deadband = check
+        sampler.add_sample(4.0, 200.0)
+        self.assertEqual(locked, [True])
+        sampler.close()
+
+    def test_segment_samplers(self):
+        """Test samplers sharing a segment store"""
+        path = os.path.join(self.temp_dir, 'segments')
+        store = SegmentStore(path)
+        wave = SegmentSampler(os.path.join(path, 'wave'), 'wave', store=store, max_samples=20, flush_samples=4)
+        load = SegmentSampler(os.path.join(path, 'load'), 'load', store=store, value_format='i')
+        for i in range(25):
+            wave.add_sample(float(i), float(i))
+            load.add_sample(float(i), i * 2)
+        self.assertTrue(wave.full)
+        self.assertEqual(load.sample_count, 25)
+        self.assertEqual(list(load.read_samples())[-1], (24.0, 48))
+        self.assertEqual(sorted(os.listdir(path)), ['active.seg', 'samplers.idx'])
+
+        # Re-open the store, and resume from the last acknowledged chunk
+        store.close()
+        store = SegmentStore(path)
+        wave = SegmentSampler(os.path.join(path, 'wave'), 'wave', store=store, max_samples=20)
+        load = SegmentSampler(os.path.join(path, 'load'), 'load', store=store, value_format='i')
+        self.assertEqual(wave.sample_count, 20)
+        position, samples = next(wave.iter_snapshot(10))
+        wave.ack_snapshot(position)
+        load.add_sample(25.0, 50)
+        self.assertEqual(wave.backlog, 10)
+        self.assertEqual(load.backlog, 26)
+
+        resumed = [v for _position, samples in wave.iter_snapshot(10) for t, v in samples]
+        self.assertEqual(resumed, [float(i) for i in range(10, 20)])
+        wave.remove_snapshot()
+        self.assertEqual(wave.backlog, 0)
+        # The snapshot remains until all samplers are synced
+        self.assertEqual(len(load.snapshot_samples()), 25)
+        load.remove_snapshot()
+        self.assertEqual(list(load.snapshot_samples()), [(25.0, 50)])
+        store.close()
+
+    def test_segment_stalled_sampler(self):
+        """Test a sampler that doesn't sync doesn't prevent other samplers syncing new samples"""
+        path = os.path.join(self.temp_dir, 'segments_stalled')
+        store = SegmentStore(path)
+        store.max_snapshots = 3
+        wave = SegmentSampler(os.path.join(path, 'wave'), 'wave', store=store)
+        load = SegmentSampler(os.path.join(path, 'load'), 'load', store=store, value_format='i')
+
+        for sync in range(3):
+            for i in range(5):
+                wave.add_sample(float(sync * 5 + i), float(i))
+                load.add_sample(float(sync * 5 + i), i)
+            synced = [t for _position, samples in wave.iter_snapshot(100) for t, v in samples]
+            self.assertEqual(synced, [float(sync * 5 + i) for i in range(5)])
+            wave.remove_snapshot()
+            self.assertEqual(wave.backlog, 0)
+        # The unsynced samples are kept
+        self.assertEqual(len([name for name in os.listdir(path) if name.startswith('snapshot.')]), 4)
+        self.assertEqual(load.backlog, 15)
+
+        # A partially synced sampler resumes, before starting a new snapshot
+        position, samples = next(load.iter_snapshot(7))
+        load.ack_snapshot(position)
+        load.add_sample(15.0, 0)
+        remaining = [t for _position, samples in load.iter_snapshot(100) for t, v in samples]
+        self.assertEqual(remaining, [float(i) for i in range(7, 15)])
+        load.remove_snapshot()
+        self.assertEqual([t for t, v in load.snapshot_samples()], [15.0])
+
+        # Snapshots over max_snapshots are discarded
+        for sync in range(5):
+            wave.add_sample(100.0 + sync, 0.0)
+            load.add_sample(100.0 + sync, 0)
+            list(wave.iter_snapshot(100))
+            wave.remove_snapshot()
+        self.assertEqual(len(store._snapshot_numbers), 3)
+        self.assertEqual([t for t, v in load.snapshot_samples()], [102.0, 103.0, 104.0])
+        load.remove_snapshot()
+        self.assertEqual(os.listdir(path).count('snapshot.acks'), 0)
+        store.close()
+
+    def test_query(self):
+        """Test querying a time range with the time index"""
+        path = os.path.join(self.temp_dir, 'sampler_query')
+        os.mkdir(path)
+        sampler = Sampler(path, 'query', max_samples=1000, index_samples=10)
+        sampler.add_samples((float(i), float(i % 7)) for i in range(95))
+        self.assertEqual(len(sampler._index.blocks), 9)
+
+        samples = sampler.query(12, 31.5)
+        self.assertEqual(list(samples.timestamps), [float(i) for i in range(12, 32)])
+        self.assertEqual(len(sampler.query(90)), 5)
+        self.assertEqual(len(sampler.query(end=4)), 5)
+        self.assertFalse(sampler.query(200, 300))
+        values = [float(i % 7) for i in range(12, 32)]
+        self.assertEqual(sampler.aggregate(12, 31.5), (0.0, 6.0, sum(values) / len(values), len(values)))
+        self.assertIsNone(sampler.aggregate(-10, -1))
+
+        # The snapshot is queried too, and its index is kept in memory
+        sampler.snapshot_samples()
+        sampler.add_sample(95.0, 1.0)
+        sampler.close()
+        os.remove(sampler.samples_snapshot_index_path)
+        self.assertEqual(list(sampler.query(93).timestamps), [93.0, 94.0, 95.0])
+        self.assertEqual(sampler.aggregate()[3], 96)
+        sampler.close()
+
+        # A missing snapshot index is rebuilt, but queries don't write it
+        sampler = Sampler(path, 'query', max_samples=1000, index_samples=10)
+        self.assertEqual(list(sampler.query(end=1).timestamps), [0.0, 1.0])
+        self.assertEqual(sampler.aggregate()[3], 96)
+        self.assertFalse(os.path.exists(sampler.samples_snapshot_index_path))
+
+        # Samples the server has acknowledged aren't included
+        sampler.ack_snapshot(25)
+        self.assertEqual(list(sampler.query(end=30).timestamps), [float(i) for i in range(25, 31)])
+        self.assertEqual(sampler.aggregate()[3], 71)
+        sampler.close()
+
+        # An index left from a different samples file isn't used
+        sampler.remove_snapshot()
+        sampler.add_samples((float(i), 1.0) for i in range(25))
+        sampler.close()
+        shutil.copyfile(sampler.samples_index_path, os.path.join(path, 'old.idx'))
+        sampler.reset()
+        sampler.add_samples((float(i), 2.0) for i in range(1000, 1025))
+        sampler.close()
+        shutil.copyfile(os.path.join(path, 'old.idx'), sampler.samples_index_path)
+        sampler = Sampler(path, 'query', max_samples=1000, index_samples=10)
+        self.assertEqual(list(sampler.query(1000, 1011).timestamps), [float(i) for i in range(1000, 1012)])
+        self.assertEqual(sampler.aggregate(1000, 1019), (2.0, 2.0, 2.0, 20))
+        sampler.close()
+
+    def test_query_snapshot(self):
+        """Test unsynced samples in the snapshot are queried, for every storage"""
+        path = os.path.join(self.temp_dir, 'query_snapshot')
+        for storage in ('ring', 'gorilla', 'segment', 'file'):
+            os.makedirs(os.path.join(path, storage))
+        store = SegmentStore(os.path.join(path, 'segment'))
+        samplers = [RingSampler(os.path.join(path, 'ring'), 'ring', max_samples=100),
+                    GorillaSampler(os.path.join(path, 'gorilla'), 'gorilla', max_samples=100, flush_samples=4),
+                    SegmentSampler(os.path.join(path, 'segment'), 'segment', store=store),
+                    Sampler(os.path.join(path, 'file'), 'file', index_samples=4)]
+        for sampler in samplers:
+            sampler.add_samples((float(i), float(i)) for i in range(10))
+            position, _samples = next(sampler.iter_snapshot(4))
+            sampler.ack_snapshot(position)
+            sampler.add_samples((float(i), float(i)) for i in range(10, 15))
+            self.assertEqual(list(sampler.query().timestamps), [float(i) for i in range(4, 15)], sampler)
+            self.assertEqual(list(sampler.query(8, 11).timestamps), [8.0, 9.0, 10.0, 11.0], sampler)
+            self.assertEqual(sampler.aggregate(), (4.0, 14.0, 9.0, 11), sampler)
+            sampler.close()
+        store.close()
+
+    def test_sqlite_sampler(self):
+        """Test samplers stored in an SQLite database"""
+        database = Database(os.path.join(self.temp_dir, 'samples.db'))
+        wave = SQLiteSampler(os.path.join(self.temp_dir, 'wave'), 'wave', database=database, max_samples=20, flush_samples=4)
+        load = SQLiteSampler(os.path.join(self.temp_dir, 'load'), 'load', database=database, value_format='i')
+        for i in range(25):
+            wave.add_sample(float(i), float(i))
+            load.add_sample(float(i), i * 2)
+        self.assertTrue(wave.full)
+        self.assertEqual(list(load.read_samples())[-1], (24.0, 48))
+        self.assertEqual(load.aggregate(10, 14), (20, 28, 24.0, 5))
+        self.assertEqual(list(load.query(23).timestamps), [23.0, 24.0])
+
+        # Resume the snapshot from the last acknowledged chunk
+        wave.close()
+        wave = SQLiteSampler(os.path.join(self.temp_dir, 'wave'), 'wave', database=database, max_samples=20)
+        self.assertEqual(wave.sample_count, 20)
+        position, samples = next(wave.iter_snapshot(10))
+        wave.ack_snapshot(position)
+        wave.add_sample(20.0, 20.0)
+        self.assertEqual(wave.backlog, 11)
+        resumed = [v for _position, samples in wave.iter_snapshot(10) for t, v in samples]
+        self.assertEqual(resumed, [float(i) for i in range(10, 20)])
+        wave.remove_snapshot()
+        self.assertEqual(list(wave.snapshot_samples()), [(20.0, 20.0)])
+        self.assertEqual(load.sample_count, 25)
+        load.close()
+        wave.close()
+        database.close()
@@ -0,0 +1,132 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+import json
+
+from dataplicity.jsonrpc import JSONRPC, ErrorCode, RemoteMethodError
+from dataplicity.client.session import Session
+
+
+class _Client(object):
+    device_class = 'test'
+    serial = 'serial'
+    auth_token = 'auth'
+
+
+class _Remote(JSONRPC):
+    """Handles calls in process, like a server that issues session tokens"""
+
+    def __init__(self, sessions=True):
+        super(_Remote, self).__init__('http://127.0.0.1/jsonrpc/', pool=False)
+        self.sessions = sessions
+        self.tokens = set()
+        self.methods = []
+        self.added = []
+
+    def _call(self, method, params):
+        if method in ('device.check_auth', 'device.open_session') and params['auth_token'] != 'auth':
+            raise ValueError("bad auth token")
+        if method == 'device.check_auth':
+            return True
+        if method == 'device.open_session':
+            if not self.sessions:
+                raise KeyError(method)
+            token = 'token{}'.format(len(self.methods))
+            self.tokens.add(token)
+            return {"session": token, "expires": 60}
+        if method == 'device.check_session':
+            if params['session'] not in self.tokens:
+                raise ValueError("session expired")
+            return True
+        self.added.append(params['value'])
+        return True
+
+    def _send(self, calls):
+        self.methods.append([call['method'] for call in calls])
+        responses = []
+        authenticated = False
+        for call in calls:
+            try:
+                if call['method'] == 'device.add' and not authenticated:
+                    raise ValueError("not authenticated")
+                result = self._call(call['method'], call['params'])
+                authenticated = True
+            except KeyError:
+                error = {"code": ErrorCode.method_not_found}
+                responses.append({"jsonrpc": "2.0", "id": call['id'], "error": error})
+            except ValueError as e:
+                error = {"code": 1, "message": str(e)}
+                responses.append({"jsonrpc": "2.0", "id": call['id'], "error": error})
+            else:
+                responses.append({"jsonrpc": "2.0", "id": call['id'], "result": result})
+        return json.dumps(responses)
+
+
+class TestSession(unittest.TestCase):
+    """Test authenticating batches"""
+
+    def _add(self, session, remote, value):
+        with remote.batch() as batch:
+            session.authenticate(batch)
+            batch.call_with_id('add_result', 'device.add', value=value)
+        result = session.check(batch)
+        batch.get_result('add_result')
+        return result
+
+    def test_check_auth(self):
+        """Test every batch is authenticated with check_auth without sessions"""
+        remote = _Remote()
+        session = Session(_Client())
+        for value in range(3):
+            self.assertTrue(self._add(session, remote, value))
+        self.assertEqual(remote.methods, [['device.check_auth', 'device.add']] * 3)
+
+    def test_session(self):
+        """Test a session token is reused, and renewed when it is rejected"""
+        remote = _Remote()
+        session = Session(_Client(), enabled=True)
+        for value in range(3):
+            self.assertTrue(self._add(session, remote, value))
+        self.assertEqual(remote.methods,
+                         [['device.open_session', 'device.add']] +
+                         [['device.check_session', 'device.add']] * 2)
+
+        # Server forgets the session, the batch is sent again with full authentication
+        remote.tokens.clear()
+        del remote.methods[:]
+        self.assertTrue(self._add(session, remote, 3))
+        self.assertTrue(self._add(session, remote, 4))
+        self.assertEqual(remote.methods,
+                         [['device.check_session', 'device.add'],
+                          ['device.open_session', 'device.add'],
+                          ['device.check_session', 'device.add']])
+        self.assertEqual(session.token, 'token2')
+
+        # Token expires on the client
+        session.expires = 0
+        del remote.methods[:]
+        self.assertTrue(self._add(session, remote, 5))
+        self.assertEqual(remote.methods, [['device.open_session', 'device.add']])
+        self.assertEqual(remote.added, [0, 1, 2, 3, 4, 5])
+
+    def test_unsupported(self):
+        """Test falling back to check_auth when the server doesn't support sessions"""
+        remote = _Remote(sessions=False)
+        session = Session(_Client(), enabled=True)
+        self.assertTrue(self._add(session, remote, 0))
+        self.assertTrue(self._add(session, remote, 1))
+        self.assertFalse(session.enabled)
+        self.assertEqual(remote.methods,
+                         [['device.open_session', 'device.add'],
+                          ['device.check_auth', 'device.add'],
+                          ['device.check_auth', 'device.add']])
+
+    def test_auth_failed(self):
+        """Test errors from full authentication are raised"""
+        remote = _Remote()
+        client = _Client()
+        client.auth_token = 'wrong'
+        session = Session(client, enabled=True)
+        with self.assertRaises(RemoteMethodError):
+            self._add(session, remote, 0)
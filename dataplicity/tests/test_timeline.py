@@ -0,0 +1,399 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+import tempfile
+import shutil
+
+from dataplicity.client import timeline as timeline_module
+from dataplicity.client.timeline import (TimelineManager, LogTimeline, SQLiteTimeline, TimelineFullError,
+                                         EventWriter, encode_event, decode_event, EVENT_TAG_ZLIB)
+from dataplicity.client.sqlitestore import Database
+from dataplicity.jsonrpc import Base64File, Base64Chunks, encode_json
+
+import os
+import io
+import json
+import base64
+import gzip
+import hashlib
+import threading
+import subprocess
+import sys
+
+
+class TestTimeline(unittest.TestCase):
+    """Test timeline storage"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp('dptest')
+        self.timelines = TimelineManager(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_log_timeline(self):
+        """Test events are appended to segments, and cleared with tombstones"""
+        self.timelines.new_timeline('log', storage='log', segment_size=1024)
+        timeline = self.timelines.get_timeline('log')
+        self.assertIsInstance(timeline, LogTimeline)
+        for i in range(20):
+            with timeline.new_event('TEXT', timestamp=1000 + i, title='event {}'.format(i), text='x' * 100):
+                pass
+        # Overwrite events replace the previous event with the same id
+        timeline.new_event('TEXT', timestamp=2000, title='status 1', event_id='status', overwrite=True).write()
+        timeline.new_event('TEXT', timestamp=2001, title='status 2', event_id='status', overwrite=True).write()
+
+        events = timeline.get_events()
+        self.assertEqual(len(events), 21)
+        self.assertEqual(events[-1]['title'], 'status 2')
+        self.assertEqual(events[-1]['event_id'], 'status')
+        self.assertTrue(len(timeline._list_segments()) > 1)
+
+        timeline.clear_events([event['event_id'] for event in events[:15]])
+        self.assertEqual([event['title'] for event in timeline.get_events()],
+                         ['event {}'.format(i) for i in range(15, 20)] + ['status 2'])
+
+        # Compaction keeps the live events in a single segment
+        timeline.compact()
+        self.assertEqual(timeline._list_segments(), [1])
+        self.assertEqual(len(timeline.get_events()), 6)
+        timeline.new_event('TEXT', timestamp=3000, title='after').write()
+        self.assertEqual(timeline.get_events()[-1]['title'], 'after')
+
+        # Events are read back by another instance
+        reopened = LogTimeline(timeline.path, 'log')
+        self.assertEqual(len(reopened.get_events()), 7)
+        reopened.clear_all()
+        self.assertEqual(timeline.get_events(), [])
+
+    def test_background_compact(self):
+        """Test compaction runs in the background when most records are dead"""
+        self.timelines.new_timeline('compact', storage='log', segment_size=4096)
+        timeline = self.timelines.get_timeline('compact')
+        for i in range(LogTimeline.compact_threshold + 10):
+            timeline.new_event('TEXT', timestamp=i, title='event').write()
+        events = timeline.get_events()
+        timeline.clear_events([event['event_id'] for event in events[:-1]])
+        timeline._compact_thread.join()
+        self.assertEqual(len(timeline._list_segments()), 1)
+        self.assertEqual(len(timeline.get_events()), 1)
+
+    def test_max_events(self):
+        """Test the event count is maintained, and max_events enforced"""
+        for storage in ('file', 'log'):
+            self.timelines.new_timeline(storage, max_events=3, storage=storage)
+            timeline = self.timelines.get_timeline(storage)
+            for i in range(3):
+                timeline.new_event('TEXT', timestamp=i, event_id='event{}'.format(i)).write()
+            self.assertEqual(timeline.count_events(), 3)
+            with self.assertRaises(TimelineFullError):
+                timeline.new_event('TEXT')
+            # Replacing an existing event is allowed
+            timeline.new_event('TEXT', event_id='event2', overwrite=True).write()
+            self.assertEqual(timeline.count_events(), 3)
+
+            timeline.clear_events(['event0', 'event1'])
+            self.assertEqual(timeline.count_events(), 1)
+            timeline.new_event('TEXT').write()
+            # The count is rebuilt on startup
+            reopened = type(timeline)(timeline.path, storage, max_events=3)
+            self.assertEqual(reopened.count_events(), 2)
+            timeline.clear_all()
+            self.assertEqual(timeline.count_events(), 0)
+
+    def test_attachments(self):
+        """Test attachments are stored in blob files, and streamed in to requests"""
+        data = os.urandom(100001)
+        attachment_path = os.path.join(self.temp_dir, 'photo.jpg')
+        with open(attachment_path, 'wb') as f:
+            f.write(data)
+        for storage in ('file', 'log'):
+            self.timelines.new_timeline(storage, storage=storage)
+            timeline = self.timelines.get_timeline(storage)
+            with timeline.new_event('IMAGE', event_id='photo') as event:
+                event.attach_file(attachment_path, name='photo')
+                event.attach_bytes(b'hello', name='greeting')
+            self.assertEqual(sorted(os.listdir(timeline.blobs_path)), ['photo.0', 'photo.1'])
+
+            events = timeline.get_events()
+            attachment = events[0]['attachments'][0]
+            self.assertEqual(attachment['ext'], '.jpg')
+            self.assertIsInstance(attachment['data'], Base64File)
+            size, chunks = encode_json({'events': events})
+            body = b''.join(chunks)
+            self.assertEqual(len(body), size)
+            decoded = json.loads(body.decode('utf-8'))['events'][0]['attachments']
+            self.assertEqual(base64.b64decode(decoded[0]['data']), data)
+            self.assertEqual(base64.b64decode(decoded[1]['data']), b'hello')
+
+            timeline.clear_events(['photo'])
+            self.assertEqual(os.listdir(timeline.blobs_path), [])
+
+    def test_unwritten_attachments(self):
+        """Test attachments of events that are never written are staged, and removed once stale"""
+        self.timelines.new_timeline('photos')
+        timeline = self.timelines.get_timeline('photos')
+        timeline.new_event('IMAGE', event_id='lost').attach_bytes(b'lost', name='photo')
+        with timeline.new_event('IMAGE', event_id='kept') as event:
+            event.attach_bytes(b'kept', name='photo')
+        self.assertEqual(sorted(os.listdir(timeline.blobs_path)), ['kept.0', 'lost.0.new'])
+        self.assertEqual(timeline.get_events()[0]['attachments'][0]['name'], 'photo')
+
+        # Recently staged blobs may belong to an event in another process
+        type(timeline)(timeline.path, 'photos')
+        self.assertEqual(sorted(os.listdir(timeline.blobs_path)), ['kept.0', 'lost.0.new'])
+        stale = os.path.getmtime(timeline._blob_path('lost.0.new')) - timeline.stale_blob_age - 1
+        os.utime(timeline._blob_path('lost.0.new'), (stale, stale))
+        reopened = type(timeline)(timeline.path, 'photos')
+        self.assertEqual(os.listdir(timeline.blobs_path), ['kept.0'])
+        self.assertEqual(sorted(os.listdir(timeline.content_path)), [hashlib.sha256(b'kept').hexdigest()])
+        reopened.clear_all()
+
+    def test_overwrite_slots(self):
+        """Test overwrite events are held in memory, and identical events skipped"""
+        for storage in ('file', 'log'):
+            self.timelines.new_timeline(storage, storage=storage, overwrite_slots=True)
+            timeline = self.timelines.get_timeline(storage)
+            writes = []
+            store_event = timeline._store_event
+            timeline._store_event = lambda event_id, event: (writes.append(event_id), store_event(event_id, event))
+
+            for timestamp, text in [(1, 'a'), (2, 'b'), (3, 'c')]:
+                timeline.new_event('TEXT', timestamp=timestamp, text=text, event_id='status', overwrite=True).write()
+            timeline.new_event('TEXT', timestamp=4, text='other', event_id='other').write()
+            self.assertEqual(writes, ['other'])
+            self.assertEqual(timeline.count_events(), 2)
+
+            # Only the latest value is written, when events are read for a sync
+            events = timeline.get_events()
+            self.assertEqual(writes, ['other', 'status'])
+            self.assertEqual([(event['event_id'], event['text']) for event in events],
+                             [('status', 'c'), ('other', 'other')])
+            timeline.clear_events(['status', 'other'])
+
+            # The same content with a new timestamp is skipped
+            timeline.new_event('TEXT', timestamp=5, text='c', event_id='status', overwrite=True).write()
+            self.assertEqual(timeline.get_events(), [])
+            timeline.new_event('TEXT', timestamp=6, text='d', event_id='status', overwrite=True).write()
+            timeline.close()
+            self.assertEqual(writes, ['other', 'status', 'status'])
+
+    def test_get_events_pages(self):
+        """Test reading events in pages after a cursor"""
+        for storage in ('file', 'log'):
+            self.timelines.new_timeline(storage, storage=storage)
+            timeline = self.timelines.get_timeline(storage)
+            for i in range(10):
+                timeline.new_event('TEXT', timestamp=100 - i, text='x' * 100).write()
+
+            page = timeline.get_events(max_count=4)
+            self.assertEqual([event['timestamp'] for event in page], [91, 92, 93, 94])
+            page = timeline.get_events(cursor=timeline.get_cursor(page[-1]), max_count=4)
+            self.assertEqual([event['timestamp'] for event in page], [95, 96, 97, 98])
+            # The byte budget limits the page, but at least one event is returned
+            size = len(json.dumps(timeline.get_events(max_count=1)[0]))
+            self.assertEqual(len(timeline.get_events(max_bytes=size * 2 + 10)), 2)
+            self.assertEqual(len(timeline.get_events(max_bytes=1)), 1)
+            self.assertEqual(timeline.get_events(cursor=timeline.get_cursor(page[-1]), max_count=4)[-1]['timestamp'], 100)
+            self.assertEqual(timeline.get_events(cursor=[100, '~']), [])
+
+    def test_page_decodes(self):
+        """Test a sync in pages decodes each event a bounded number of times"""
+        decoded = []
+
+        def counting_decode(event_bin):
+            decoded.append(1)
+            return decode_event(event_bin)
+
+        for storage in ('file', 'log'):
+            self.timelines.new_timeline(storage, storage=storage)
+            writer = self.timelines.get_timeline(storage)
+            for i in range(200):
+                writer.new_event('TEXT', timestamp=1000 - i, text='x' * 10).write()
+            # A second timeline on the same path, as if another process wrote the events
+            timeline = type(writer)(writer.path, storage)
+            del decoded[:]
+            timeline_module.decode_event = counting_decode
+            try:
+                timestamps = []
+                cursor = None
+                while 1:
+                    page = timeline.get_events(cursor=cursor, max_count=20)
+                    if not page:
+                        break
+                    timestamps.extend(event['timestamp'] for event in page)
+                    cursor = timeline.get_cursor(page[-1])
+            finally:
+                timeline_module.decode_event = decode_event
+            self.assertEqual(timestamps, list(range(801, 1001)))
+            # Each event is decoded once to index it, and once when its page is read
+            self.assertLessEqual(len(decoded), 400)
+
+            # Events written and cleared by the other timeline are seen
+            writer.clear_events([event['event_id'] for event in writer.get_events(max_count=100)])
+            writer.new_event('TEXT', timestamp=1, text='new').write()
+            page = timeline.get_events(max_count=10)
+            self.assertEqual([event['timestamp'] for event in page][:3], [1, 901, 902])
+            self.assertEqual(timeline.count_events(), 101)
+
+    def test_sqlite_timeline(self):
+        """Test events and attachments stored in an SQLite database"""
+        database = Database(os.path.join(self.temp_dir, 'events.db'))
+        self.timelines.new_timeline('sqlite', max_events=20, storage='sqlite', database=database)
+        timeline = self.timelines.get_timeline('sqlite')
+        self.assertIsInstance(timeline, SQLiteTimeline)
+        for i in range(10):
+            timeline.new_event('TEXT', timestamp=100 - i, title='event {}'.format(i)).write()
+        data = os.urandom(Base64Chunks.chunk_size * 2 + 100)
+        with timeline.new_event('IMAGE', timestamp=200, event_id='photo') as event:
+            event.attach_bytes(data, name='photo', filename='photo.jpg')
+
+        page = timeline.get_events(max_count=4)
+        self.assertEqual([event['timestamp'] for event in page], [91, 92, 93, 94])
+        page = timeline.get_events(cursor=timeline.get_cursor(page[-1]), max_count=10)
+        self.assertEqual([event['timestamp'] for event in page], [95, 96, 97, 98, 99, 100, 200])
+        attachment = page[-1]['attachments'][0]
+        self.assertIsInstance(attachment['data'], Base64Chunks)
+        size, chunks = encode_json({'events': page})
+        body = b''.join(chunks)
+        self.assertEqual(len(body), size)
+        decoded = json.loads(body.decode('utf-8'))['events'][-1]['attachments'][0]
+        self.assertEqual(base64.b64decode(decoded['data']), data)
+
+        # Events are read back by another instance
+        timeline.clear_events(['photo'])
+        self.assertEqual(database.query_value("SELECT COUNT(*) FROM attachments"), 0)
+        reopened = SQLiteTimeline(timeline.path, 'sqlite', database=database)
+        self.assertEqual(reopened.count_events(), 10)
+        reopened.clear_all()
+        self.assertEqual(timeline.get_events(), [])
+        database.close()
+
+    def test_compress(self):
+        """Test events are compressed in storage and in the sync request"""
+        text = "\n".join("package-{} 1.0.{}".format(i, i % 10) for i in range(500))
+        event = {'event_id': 'packages', 'timestamp': 1, 'text': text}
+        self.assertTrue(encode_event(event, compress=True).startswith(EVENT_TAG_ZLIB))
+        self.assertTrue(len(encode_event(event, compress=True)) * 4 < len(encode_event(event)))
+        self.assertEqual(decode_event(encode_event(event, compress=True)), event)
+        # Small events aren't compressed, and JSON from earlier versions still loads
+        self.assertEqual(encode_event({'a': 1}, compress=True), b'{"a":1}')
+        self.assertEqual(decode_event(json.dumps(event, indent=4).encode('utf-8')), event)
+
+        database = Database(os.path.join(self.temp_dir, 'events.db'))
+        for storage in ('file', 'log', 'sqlite'):
+            options = {'database': database} if storage == 'sqlite' else {}
+            self.timelines.new_timeline(storage, storage=storage, compress=True, **options)
+            timeline = self.timelines.get_timeline(storage)
+            timeline.new_event('TEXT', timestamp=1, text=text, event_id='packages').write()
+            self.assertEqual(timeline.get_events()[0]['text'], text)
+        with open(os.path.join(self.temp_dir, 'file', 'packages.json'), 'rb') as f:
+            self.assertTrue(f.read().startswith(EVENT_TAG_ZLIB))
+
+        # Pages of events are gzipped when sync_gzip is set
+        events = timeline.get_events()
+        self.assertEqual(self.timelines.get_sync_params(events), {'events': events})
+        self.timelines.sync_gzip = True
+        params = self.timelines.get_sync_params(events)
+        self.assertEqual(params['encoding'], 'gzip')
+        events_json = gzip.GzipFile(fileobj=io.BytesIO(base64.b64decode(params['events']))).read()
+        self.assertEqual(json.loads(events_json.decode('utf-8')), events)
+        database.close()
+
+    def test_write_behind(self):
+        """Test events are written in the background, and dropped when the queue is full"""
+        for policy, expected in [('drop_new', ['0', '1', '2']), ('drop_oldest', ['0', '2', '3'])]:
+            timelines = TimelineManager(os.path.join(self.temp_dir, policy), writer=EventWriter(max_queue=2, policy=policy))
+            timelines.new_timeline('queue')
+            timeline = timelines.get_timeline('queue')
+            writing = threading.Event()
+            resume = threading.Event()
+            store_event = timeline._store_event
+
+            def slow_store_event(event_id, event):
+                writing.set()
+                resume.wait()
+                store_event(event_id, event)
+            timeline._store_event = slow_store_event
+
+            with timeline.new_event('TEXT', timestamp=0, event_id='0') as event:
+                event.attach_bytes(b'first')
+            writing.wait()
+            for i in range(1, 4):
+                with timeline.new_event('TEXT', timestamp=i, event_id=str(i)) as event:
+                    event.attach_bytes(b'queued')
+            self.assertEqual(timelines.get_write_stats()['depth'], 3)
+            self.assertEqual(timeline.count_events(), 3)
+            resume.set()
+            timelines.flush()
+            self.assertEqual([event['event_id'] for event in timeline.get_events()], expected)
+            self.assertEqual(sorted(os.listdir(timeline.blobs_path)), [event_id + '.0' for event_id in expected])
+            stats = timelines.get_write_stats()
+            self.assertEqual((stats['depth'], stats['max_depth'], stats['written'], stats['dropped']), (0, 2, 3, 1))
+            timelines.close()
+
+    def test_write_behind_exit(self):
+        """Test queued events are written when the process exits without closing the writer"""
+        script = ("import sys\n"
+                  "from dataplicity.client.timeline import TimelineManager, EventWriter\n"
+                  "timelines = TimelineManager(sys.argv[1], writer=EventWriter())\n"
+                  "timelines.new_timeline('exit')\n"
+                  "timeline = timelines.get_timeline('exit')\n"
+                  "for i in range(100):\n"
+                  "    timeline.new_event('TEXT', timestamp=i, text='x' * 1000).write()\n")
+        env = os.environ.copy()
+        package_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_path, env.get('PYTHONPATH')]))
+        subprocess.check_call([sys.executable, '-c', script, self.temp_dir], env=env)
+        self.timelines.new_timeline('exit')
+        self.assertEqual(self.timelines.get_timeline('exit').count_events(), 100)
+
+    def test_attachment_dedupe(self):
+        """Test identical attachments are stored once, and sent by hash once acknowledged"""
+        frame = os.urandom(1000)
+        for storage in ('file', 'log'):
+            self.timelines.new_timeline(storage, storage=storage)
+            timeline = self.timelines.get_timeline(storage)
+            for i, data in enumerate([frame, frame, b'other', frame]):
+                with timeline.new_event('IMAGE', timestamp=i, event_id='frame{}'.format(i)) as event:
+                    event.attach_bytes(data, name='frame')
+            with open(os.path.join(self.temp_dir, 'frame.jpg'), 'wb') as f:
+                f.write(frame)
+            with timeline.new_event('IMAGE', timestamp=4, event_id='frame4') as event:
+                event.attach_file(os.path.join(self.temp_dir, 'frame.jpg'))
+            self.assertEqual(len(os.listdir(timeline.content_path)), 2)
+            self.assertEqual(os.stat(timeline._blob_path('frame0.0')).st_nlink, 5)
+
+            # Only the content of removed blobs is checked
+            stray = '0' * 64
+            open(timeline._content_file_path(stray), 'wb').close()
+            timeline.clear_events(['frame0', 'frame1', 'frame2'])
+            self.assertEqual(sorted(os.listdir(timeline.content_path)), sorted([hashlib.sha256(frame).hexdigest(), stray]))
+            events = timeline.get_events()
+            self.assertEqual([base64.b64decode(b''.join(event['attachments'][0]['data'].iter_json())[1:-1])
+                              for event in events], [frame, frame])
+            # Blobs that haven't been read are hashed when they are removed
+            reopened = type(timeline)(timeline.path, storage)
+            reopened.clear_events(['frame3', 'frame4'])
+            self.assertEqual(os.listdir(timeline.content_path), [stray])
+
+        # Attachments are sent by hash after the server acknowledges them
+        timelines = TimelineManager(os.path.join(self.temp_dir, 'refs'), attachment_refs=True)
+        timelines.new_timeline('camera')
+        timeline = timelines.get_timeline('camera')
+        for i in range(3):
+            with timeline.new_event('IMAGE', timestamp=i, event_id='frame{}'.format(i)) as event:
+                event.attach_bytes(frame if i < 2 else b'other', name='frame')
+        events = timeline.get_events(max_count=2)
+        attachments = [event['attachments'][0] for event in timelines.get_sync_params(events)['events']]
+        self.assertEqual([attachment['encoding'] for attachment in attachments], ['base64', 'sha256'])
+        self.assertNotIn('data', attachments[1])
+        timelines.clear_synced(timeline, events, ['frame0', 'frame1'])
+
+        with timeline.new_event('IMAGE', timestamp=3, event_id='frame3') as event:
+            event.attach_bytes(frame, name='frame')
+        reopened = TimelineManager(timelines.path, attachment_refs=True)
+        events = reopened.get_sync_params(timeline.get_events())['events']
+        self.assertEqual([event['attachments'][0]['encoding'] for event in events], ['base64', 'sha256'])
+        self.assertEqual(events[1]['attachments'][0]['sha256'], hashlib.sha256(frame).hexdigest())